@@ -0,0 +1,54 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""benchmark exporting a ranked stats table and its top 10
+
+Usage: python benchmarks/bench_export.py [rows]
+"""
+
+from __future__ import annotations
+
+import sys
+import tempfile
+from pathlib import Path
+from timeit import default_timer
+
+import duckdb
+
+from elxr_metrics.export import publish, table_checksum
+
+
+def _two_sorts(conn: duckdb.DuckDBPyConnection, full: Path, top: Path) -> None:
+    with publish() as pub:
+        pub.copy(conn, "SELECT * FROM stats ORDER BY Download DESC, Name ASC", full)
+        pub.copy(conn, "SELECT * FROM stats ORDER BY Download DESC, Name ASC LIMIT 10", top)
+
+
+def _one_sort(conn: duckdb.DuckDBPyConnection, full: Path, top: Path) -> None:
+    with publish() as pub:
+        pub.copy_ranked(conn, "stats", "Download DESC, Name ASC", full, top)
+
+
+def main(rows: int = 1_000_000) -> None:
+    """time the export strategies on a stats table with `rows` packages"""
+    conn = duckdb.connect(":memory:")
+    conn.execute(
+        f"""
+        CREATE TABLE stats AS
+        SELECT 'package-' || i::VARCHAR AS Name, (random() * 100000)::INTEGER AS Download FROM range({rows}) t(i);"""
+    )
+    for label, func in (("two sorts (before)", _two_sorts), ("one sort", _one_sort)):
+        with tempfile.TemporaryDirectory() as d:
+            start = default_timer()
+            func(conn, Path(d) / "package_stats.csv", Path(d) / "package_top_10.csv")
+            print(f"{label:<28} {default_timer() - start:8.3f} sec")
+    start = default_timer()
+    table_checksum(conn, "stats")
+    print(f"{'unchanged (checksum only)':<28} {default_timer() - start:8.3f} sec")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
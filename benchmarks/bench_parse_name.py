@@ -0,0 +1,60 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""benchmark deb/image name extraction over distinct URIs
+
+Usage: python benchmarks/bench_parse_name.py [count]
+"""
+
+from __future__ import annotations
+
+import re
+import sys
+from pathlib import Path
+from timeit import default_timer
+
+from elxr_metrics.elxr_image import _parse_image_name
+from elxr_metrics.elxr_package import _parse_deb_file
+
+_OLD_DEB_NAME_RE = re.compile(r"^([a-zA-Z0-9\-\+\.]+)_", re.ASCII)
+_OLD_IMAGE_NAME_RE = re.compile(r"elxr-.+\.(img\.zst|tar\.gz|img|iso|qcow2)$", re.ASCII)
+
+
+def _old_parse_deb_name(path: str) -> str | None:
+    match = _OLD_DEB_NAME_RE.match(Path(path).name)
+    return match.group(1) if match else None
+
+
+def _old_parse_image_name(path: str) -> str | None:
+    file_name = Path(path).name
+    return file_name if _OLD_IMAGE_NAME_RE.search(file_name) else None
+
+
+def _run(label: str, func, uris: list[str]) -> None:
+    start = default_timer()
+    for uri in uris:
+        func(uri)
+    elapsed = default_timer() - start
+    print(f"{label:<24} {elapsed:8.3f} sec  {len(uris) / elapsed:12,.0f} uri/sec")
+
+
+def main(count: int = 1_000_000) -> None:
+    """time old and new extractors on `count` distinct URIs (cache disabled)"""
+    arches = ("amd64", "arm64", "all")
+    debs = [
+        f"/elxr/pool/main/l/lib{i % 997}/lib{i}-dev_{i % 13}.{i % 7}-{i % 3}elxr1_{arches[i % 3]}.deb"
+        for i in range(count)
+    ]
+    images = [f"/elxr-12.{i % 10}.{i}.0-{arches[i % 2]}-CD-1.iso" for i in range(count)]
+
+    _run("deb: Path + regex", _old_parse_deb_name, debs)
+    _run("deb: partition", _parse_deb_file.__wrapped__, debs)
+    _run("image: Path + regex", _old_parse_image_name, images)
+    _run("image: partition", _parse_image_name.__wrapped__, images)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,76 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""benchmark parsing a mirror log with and without the raw line prefilter
+
+Usage: python benchmarks/bench_prefilter.py [lines] [deb share]
+
+Most mirror requests are index files, redirects and errors; the deb share sets the fraction of lines that are
+deb downloads, 0.05 by default.
+"""
+
+from __future__ import annotations
+
+import gzip
+import sys
+import tempfile
+from pathlib import Path
+from timeit import default_timer
+
+from elxr_metrics.cloudfront_log import parse_cloudfront_log
+from elxr_metrics.elxr_package import _match_deb_download, _package_line_filter
+
+_LINE = (
+    "2024-09-20\t18:39:{s:02d}\tYUL62-P1\t1400848\t74.12.5.{i}\tGET\tabc.cloudfront.net\t{uri}\t{status}\t-\t"
+    "Debian%20APT-HTTP/1.3%20(2.6.1)\t-\t-\tHit\tYsv1ngI4T1vff6joqoT31sRrsmdkyrEGYqzrGt94Ewl9ymjMs-6gTw==\t"
+    "mirror.elxr.dev\thttps\t148\t0.144\t-\tTLSv1.3\tTLS_AES_128_GCM_SHA256\tHit\tHTTP/1.1\t-\t-\t41202\t0.009\t"
+    "Hit\t{content_type}\t1400264\t-\t-\n"
+)
+_REJECTS = (
+    ("/elxr/dists/aria/InRelease", 200, "text/plain"),
+    ("/elxr/dists/aria/main/binary-amd64/Packages.xz", 304, "application/x-xz"),
+    ("/elxr/pool/main/g/glib2.0/libglib2.0-0_2.74.6-2_amd64.deb", 404, "text/html"),
+    ("/elxr/dists/aria/main/i18n/Translation-en", 404, "text/html"),
+)
+
+
+def _write_log(path: Path, lines: int, deb_share: float) -> None:
+    step = max(1, round(1 / deb_share)) if deb_share else lines + 1
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for i in range(lines):
+            if i % step == 0:
+                uri, status, content_type = (
+                    f"/elxr/pool/main/l/lib{i % 997}/lib{i % 997}_1.{i % 7}-1_amd64.deb",
+                    200,
+                    "application/vnd.debian.binary-package",
+                )
+            else:
+                uri, status, content_type = _REJECTS[i % len(_REJECTS)]
+            f.write(_LINE.format(s=i % 60, i=i % 256, uri=uri, status=status, content_type=content_type))
+
+
+def _run(label: str, path: Path, line_filter) -> int:
+    start = default_timer()
+    count = sum(1 for entry in parse_cloudfront_log(path, line_filter) if _match_deb_download(entry))
+    elapsed = default_timer() - start
+    print(f"{label:<16} {elapsed:8.3f} sec  {count:10,} debs")
+    return count
+
+
+def main(lines: int = 200_000, deb_share: float = 0.05) -> None:
+    """time counting deb downloads of a log of `lines` lines, `deb_share` of them deb downloads"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "E1.2024-09-20-18.bench.gz"
+        _write_log(path, lines, deb_share)
+        full = _run("full parse", path, None)
+        line_filter = _package_line_filter()
+        filtered = _run("prefilter", path, line_filter)
+        assert full == filtered
+        print(f"prefilter kept {line_filter.kept:,} of {line_filter.lines:,} lines")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000, float(sys.argv[2]) if len(sys.argv) > 2 else 0.05)
@@ -8,29 +8,79 @@ const chartCanvas3 = document.getElementById('my-chart-3');
 const trackingMap = document.getElementById('tracking-map');
 
 let chartData = [];
+let trendIndex = null;
+const trendShards = {};
+const trendShardDays = { '7d': 7, '30d': 30, '90d': 90 };
 let top10Data = [];
 let imageTop10Data = [];
 let viewChart;
 let viewChartTop10;
 let viewChartImageTop10;
 
-// Fetch CSV data on page load
+// Fetch the shard index on page load, fall back to the full CSV data
 window.addEventListener('load', () => {
-    fetch('elxr_org_view.csv')
-        .then(response => response.text())
-        .then(csvData => {
-            chartData = parseCSV(csvData);
+    fetchText('elxr_org_view/index.json')
+        .then(text => JSON.parse(text))
+        .then(index => {
+            trendIndex = index;
             dateRangeSelect.selectedIndex = 2;
             dateRangeSelect.dispatchEvent(new Event('change'));
         })
         .catch(error => {
-            console.error('Error fetching CSV data:', error);
+            console.warn('Error fetching shard index, use CSV data:', error);
+            fetchText('elxr_org_view.csv')
+                .then(csvData => {
+                    chartData = parseCSV(csvData);
+                    dateRangeSelect.selectedIndex = 2;
+                    dateRangeSelect.dispatchEvent(new Event('change'));
+                })
+                .catch(error => {
+                    console.error('Error fetching CSV data:', error);
+                });
         });
 });
 
+// Names of the smallest pre-aggregated shards covering the date range
+function trendShardNames(startDate, endDate) {
+    for (const [name, days] of Object.entries(trendShardDays)) {
+        const shard = trendIndex[name];
+        if (shard && shard.end && new Date(shard.end).getTime() - days * 24 * 60 * 60 * 1000 <= startDate.getTime()) {
+            return [name];
+        }
+    }
+    const years = [];
+    for (let year = startDate.getFullYear(); year <= endDate.getFullYear(); year++) {
+        if (trendIndex[year]) {
+            years.push(String(year));
+        }
+    }
+    return years.length > 0 && years.length <= 2 ? years : ['all'];
+}
+
+// Load a column oriented shard once, as rows like the CSV data
+function loadTrendShard(name) {
+    if (!trendShards[name]) {
+        trendShards[name] = fetchText('elxr_org_view/' + name + '.json')
+            .then(text => JSON.parse(text))
+            .then(shard => shard.TimeBucket.map((timeBucket, i) => ({
+                TimeBucket: timeBucket,
+                ViewCount: shard.ViewCount[i],
+                UniqueUser: shard.UniqueUser[i]
+            })));
+    }
+    return trendShards[name];
+}
+
+async function loadTrendData(startDate, endDate) {
+    if (!trendIndex) {
+        return chartData;
+    }
+    const shards = await Promise.all(trendShardNames(startDate, endDate).map(loadTrendShard));
+    return shards.flat();
+}
+
 window.addEventListener('load', () => {
-    fetch('package_top_10.csv')
-        .then(response => response.text())
+    fetchText('package_top_10.csv')
         .then(csvData => {
             top10Data = parseCSV(csvData);
             drawTop10Chart(top10Data);
@@ -41,8 +91,7 @@ window.addEventListener('load', () => {
 });
 
 window.addEventListener('load', () => {
-    fetch('image_top_10.csv')
-        .then(response => response.text())
+    fetchText('image_top_10.csv')
         .then(csvData => {
             imageTop10Data = parseCSV(csvData);
             drawImageTop10Chart(imageTop10Data);
@@ -52,12 +101,13 @@ window.addEventListener('load', () => {
         });
 });
 
-function rangeChange() {
+async function rangeChange() {
     if (startDateInput.value != '' && endDateInput.value != '') {
         startDate = new Date(startDateInput.value);
         endDate = new Date(endDateInput.value);
+        const data = await loadTrendData(startDate, endDate);
         // Filter the data based on the date range
-        filteredData = chartData.filter(item => {
+        filteredData = data.filter(item => {
             const itemDate = new Date(item.TimeBucket);
             return itemDate >= startDate && itemDate <= endDate;
         });
@@ -314,8 +364,7 @@ var map = new maplibregl.Map({
 window.addEventListener('load', () => {
     async function loadCountryData() {
         try {
-            const response = await fetch('country.csv');
-            const csvData = await response.text();
+            const csvData = await fetchText('country.csv');
             countryData = parseCSV(csvData);
             return countryData;
         } catch (error) {
@@ -325,8 +374,7 @@ window.addEventListener('load', () => {
 
     async function loadCountryCord() {
         try {
-            const response = await fetch('countries.csv');
-            const csvData = await response.text();
+            const csvData = await fetchText('countries.csv');
             countryCord = parseCSV(csvData);
             return countryCord;
         } catch (error) {
@@ -336,26 +384,25 @@ window.addEventListener('load', () => {
 
     async function placeMarkers() {
         const countryData = await loadCountryData();
-        const countryCord = await loadCountryCord();
+        // country.csv carries the coordinates since they are joined server-side;
+        // older files without them are joined with countries.csv here.
+        const countryCord = countryData.length && 'Latitude' in countryData[0] ? [] : await loadCountryCord();
 
         let i = 0;
         while (countryData[i]['Code']) {
-            let cordIndex = -1;
+            let long = countryData[i]['Longitude'];
+            let lat = countryData[i]['Latitude'];
 
             let j = 0;
-            while (countryCord[j]['country']) {
-                let countryCode = countryCord[j]['country'];
-                if (countryCode == countryData[i]['Code']) {
-                    cordIndex = j;
-                    break;
+            while (!long && countryCord[j] && countryCord[j]['country']) {
+                if (countryCord[j]['country'] == countryData[i]['Code']) {
+                    long = countryCord[j]['longitude'];
+                    lat = countryCord[j]['latitude'];
                 }
                 j++;
             }
 
-            if (cordIndex >= 0) {
-                long = countryCord[cordIndex]['longitude'];
-                lat = countryCord[cordIndex]['latitude'];
-
+            if (long && lat) {
                 const popupString = '<div style="height:40px;"><p style="text-align:center; vertical-align: middle; margin:auto; font-size:12px;"><b>' + countryData[i]['Name'] + '</b><br>Visits: ' + countryData[i]['Count'] + '</p></div>';
 
                 let popup = new maplibregl.Popup({ closeButton: false, closeOnClick: false })
@@ -375,6 +422,16 @@ window.addEventListener('load', () => {
     map.touchZoomRotate.disableRotation();
 });
 
+// Fetch a text file. Servers that negotiate Content-Encoding (e.g. GitLab Pages with .br/.gz siblings)
+// send the smaller encoding, and the browser decodes it.
+async function fetchText(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(url + ': ' + response.statusText);
+    }
+    return response.text();
+}
+
 function parseCSV(csvData) {
     const normalized = csvData.replace(/\r\n|\r/g, '\n');
     const lines = normalized.split('\n');
@@ -12,11 +12,27 @@ from __future__ import annotations
 import argparse
 import stat
 import sys
+from functools import partial
 from pathlib import Path
+from typing import Any, Callable
 
+from elxr_metrics.backfill import backfill
+from elxr_metrics.bot import DEFAULT_CLASSIFIER, BotClassifier
+from elxr_metrics.cloudfront_log import BUCKET_WIDTHS
+from elxr_metrics.completion import DEFAULT_COMPLETION
+from elxr_metrics.dedup import DEDUP_WINDOW
+from elxr_metrics.edge_performance import parse_edge_performance_logs
 from elxr_metrics.elxr_image import parse_downloads_elxr_dev_logs
 from elxr_metrics.elxr_org_trend import parse_elxr_org_logs
 from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.jobs import load_jobs, run_jobs
+from elxr_metrics.log_source import S3_SCHEME, open_log_source
+from elxr_metrics.metric import DEFAULT_METRIC_SPECS, MetricSpec, load_metric_specs, parse_metrics_logs
+from elxr_metrics.partial import PARTIAL_LOG_TYPES, map_logs, reduce_partials
+from elxr_metrics.pipeline import LOG_TYPES, Pipeline, get_pipeline
+from elxr_metrics.realtime import DEFAULT_FIELD_ORDER, ingest_stream, load_field_order
+from elxr_metrics.sample import ESTIMATE_DIR, SAMPLE_FIELDS
+from elxr_metrics.watch import watch
 
 
 def is_dir(parser: argparse.ArgumentParser, path: str) -> Path:
@@ -31,6 +47,13 @@ def is_dir(parser: argparse.ArgumentParser, path: str) -> Path:
     return d
 
 
+def is_log_location(parser: argparse.ArgumentParser, path: str) -> Path | str:
+    """check if path is a directory, or keep an s3://bucket/prefix URL as is"""
+    if path.startswith(S3_SCHEME):
+        return path
+    return is_dir(parser, path)
+
+
 def is_file(parser: argparse.ArgumentParser, path: str) -> Path:
     """check if path is a readable file"""
     if not path:
@@ -47,28 +70,34 @@ def is_file(parser: argparse.ArgumentParser, path: str) -> Path:
     return d
 
 
-def main(args: list[str] | None = None) -> int:
-    """
-    The main routine to parse cloudfront logs and store into csv file.
+def is_index(parser: argparse.ArgumentParser, path: str) -> Path:
+    """check if path is an existing index or database file"""
+    d = Path(path)
+    if not d.is_file():
+        parser.error(f"The file does not exist! ({path})")
+    return d
 
-    It requires 3 command line argument:
-    log_path -- the log file directory
-    csv_path -- the csv file to load and store
-    log_type -- the log type, one of elxr_org_view, package_download, image_download
-    """
-    if args is None:
-        args = sys.argv[1:]
 
-    parser = argparse.ArgumentParser(
-        description="parse CloudFront log files",
-        epilog="Example: python3 %(prog)s ../logs/elxr_org ../public/elxr_org_view.csv elxr_org_view",
-    )
-    parser.add_argument(
-        "log_path",
-        nargs=1,
-        type=lambda x: is_dir(parser, x),
-        help="the directory contains log files",
-    )
+def is_fraction(parser: argparse.ArgumentParser, value: str) -> float:
+    """check if value is a number in (0, 1]"""
+    try:
+        f = float(value)
+    except ValueError:
+        f = 0.0
+    if not 0 < f <= 1:
+        parser.error(f"The fraction must be in (0, 1]! ({value})")
+    return f
+
+
+def _add_arguments(parser: argparse.ArgumentParser, log_path: bool = True) -> None:
+    """add the log path, csv path, log type and the shared options of the one-shot, watch and stream commands"""
+    if log_path:
+        parser.add_argument(
+            "log_path",
+            nargs=1,
+            type=lambda x: is_log_location(parser, x),
+            help="the directory contains log files, or an s3://bucket/prefix URL",
+        )
     parser.add_argument(
         "csv_path",
         nargs=1,
@@ -78,21 +107,410 @@ def main(args: list[str] | None = None) -> int:
     parser.add_argument(
         "log_type",
         nargs=1,
-        choices=["elxr_org_view", "package_download", "image_download"],
+        choices=LOG_TYPES,
         help="the log type",
     )
-    pa = parser.parse_args(args)
+    _add_options(parser)
+
+
+def _add_options(parser: argparse.ArgumentParser) -> None:
+    """add the options shared by all commands"""
+    parser.add_argument(
+        "--packages-index",
+        action="append",
+        type=lambda x: is_index(parser, x),
+        help="Debian Packages/Sources index file to roll up package downloads by source package (repeatable)",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="also write pre-compressed .gz/.br files for the dashboard",
+    )
+    parser.add_argument(
+        "--city-db",
+        type=lambda x: is_index(parser, x),
+        help="MaxMind City database to also count website views by region and city into city.csv",
+    )
+    parser.add_argument(
+        "--bot-networks",
+        type=lambda x: is_index(parser, x),
+        help="file of client networks (one CIDR per line) to count as bots, in addition to bot user agents",
+    )
+    parser.add_argument(
+        "--dedup-window",
+        type=float,
+        default=DEDUP_WINDOW,
+        help="seconds within which image requests of the same client and user agent count as one download, "
+        f"0 to count every request (default: {DEDUP_WINDOW:.0f})",
+    )
+    parser.add_argument(
+        "--completion",
+        type=lambda x: is_fraction(parser, x),
+        default=DEFAULT_COMPLETION,
+        help="fraction of an image a client must fetch, in one or many range requests, to count a download "
+        f"(default: {DEFAULT_COMPLETION})",
+    )
+    parser.add_argument(
+        "--bucket-width",
+        choices=BUCKET_WIDTHS,
+        default="6h",
+        help="width of the time buckets of elxr_org_view and edge_performance (default: 6h)",
+    )
+    parser.add_argument(
+        "--metrics-config",
+        type=lambda x: is_index(parser, x),
+        help="TOML file of [[metric]] tables to count for the metrics log type, "
+        "instead of the default status_trend and tls_trend",
+    )
+
+
+def _classifier(pa: argparse.Namespace) -> BotClassifier:
+    """the bot classifier of the parsed options"""
+    return BotClassifier.from_file(pa.bot_networks) if pa.bot_networks else DEFAULT_CLASSIFIER
+
+
+def _metric_specs(parser: argparse.ArgumentParser, pa: argparse.Namespace) -> tuple[MetricSpec, ...]:
+    """the metric specs of the parsed options"""
+    if not pa.metrics_config:
+        return DEFAULT_METRIC_SPECS
+    try:
+        return load_metric_specs(pa.metrics_config)
+    except (ValueError, KeyError, ImportError) as e:
+        parser.error(f"Invalid metrics config! ({pa.metrics_config}: {e})")
+    return ()  # pragma: no cover
+
+
+def _pipeline(parser: argparse.ArgumentParser, pa: argparse.Namespace) -> Pipeline:
+    """the pipeline of the parsed log type and options"""
+    return get_pipeline(
+        pa.log_type[0],
+        pa.csv_path[0],
+        compress=pa.compress,
+        index_files=pa.packages_index,
+        city_db=pa.city_db,
+        classifier=_classifier(pa),
+        dedup_window=pa.dedup_window,
+        completion=pa.completion,
+        metric_specs=_metric_specs(parser, pa),
+        bucket_width=BUCKET_WIDTHS[pa.bucket_width],
+    )
+
+
+def _one_shot_parser(prog: str | None = None) -> argparse.ArgumentParser:
+    """the parser of the arguments of a one-shot run"""
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="parse CloudFront log files",
+        epilog="Example: python3 %(prog)s ../logs/elxr_org ../public/elxr_org_view.csv elxr_org_view; "
+        "run %(prog)s watch --help to update metrics continuously, "
+        "%(prog)s backfill --help to rebuild them from an archive, "
+        "%(prog)s stream --help to ingest real-time logs, "
+        "%(prog)s map --help and %(prog)s reduce --help to split the counting across machines, "
+        "%(prog)s run --help to run several one-shot runs at once",
+    )
+    _add_arguments(parser)
+    parser.add_argument(
+        "--sample",
+        type=lambda x: is_fraction(parser, x),
+        default=1.0,
+        metavar="RATE",
+        help="count a deterministic share of the log lines and scale it up, writing estimates with 95%% confidence "
+        f"intervals into an estimated folder next to csv_path ({', '.join(SAMPLE_FIELDS)}; default: 1, exact)",
+    )
+    return parser
+
 
-    log_path: Path = pa.log_path[0]
+def _one_shot(parser: argparse.ArgumentParser, pa: argparse.Namespace) -> Callable[[], Any]:
+    """the one-shot run of the parsed arguments, with its options checked and loaded before it is called"""
+    log_path: Path | str = pa.log_path[0]
     csv_path: Path = pa.csv_path[0]
     log_type: str = pa.log_type[0]
+    if pa.sample < 1 and log_type not in SAMPLE_FIELDS:
+        parser.error(f"{log_type} cannot be sampled!")
 
     if log_type == "elxr_org_view":
-        parse_elxr_org_logs(log_path, csv_path)
-    elif log_type == "package_download":
-        parse_mirror_elxr_dev_logs(log_path, csv_path)
-    else:  # must be "image_download"
-        parse_downloads_elxr_dev_logs(log_path, csv_path)
+        return partial(
+            parse_elxr_org_logs,
+            log_path,
+            csv_path,
+            compress=pa.compress,
+            city_db=pa.city_db,
+            classifier=_classifier(pa),
+            bucket_width=BUCKET_WIDTHS[pa.bucket_width],
+            sample_rate=pa.sample,
+        )
+    if log_type == "package_download":
+        return partial(
+            parse_mirror_elxr_dev_logs,
+            log_path,
+            csv_path,
+            index_files=pa.packages_index,
+            compress=pa.compress,
+            classifier=_classifier(pa),
+            sample_rate=pa.sample,
+        )
+    if log_type == "edge_performance":
+        return partial(
+            parse_edge_performance_logs,
+            log_path,
+            csv_path,
+            compress=pa.compress,
+            bucket_width=BUCKET_WIDTHS[pa.bucket_width],
+        )
+    if log_type == "metrics":
+        return partial(parse_metrics_logs, log_path, csv_path, _metric_specs(parser, pa), compress=pa.compress)
+    # must be "image_download"
+    return partial(
+        parse_downloads_elxr_dev_logs,
+        log_path,
+        csv_path,
+        compress=pa.compress,
+        dedup_window=pa.dedup_window,
+        completion=pa.completion,
+        sample_rate=pa.sample,
+    )
+
+
+def watch_main(args: list[str]) -> int:
+    """
+    The routine to watch a log directory and update the csv file continuously.
+
+    It takes the same arguments as main, plus the poll interval and the debounce interval.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics watch",
+        description="watch a directory of CloudFront log files and update metrics continuously",
+        epilog="Example: %(prog)s ../logs/elxr_org ../public/elxr_org_view.csv elxr_org_view --debounce 300",
+    )
+    _add_arguments(parser)
+    parser.add_argument("--poll-interval", type=float, default=10.0, help="seconds between polls (default: 10)")
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=60.0,
+        help="seconds without new log files before the csv files are written (default: 60)",
+    )
+    pa = parser.parse_args(args)
+    if not isinstance(pa.log_path[0], Path):
+        parser.error("watch needs a local directory")
+    watch(pa.log_path[0], _pipeline(parser, pa), poll_interval=pa.poll_interval, debounce=pa.debounce)
+    return 0
+
+
+def backfill_main(args: list[str]) -> int:
+    """
+    The routine to count an archive of log files in resumable chunks.
+
+    It takes the same arguments as main, plus the chunk size and the checkpoint file.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics backfill",
+        description="count an archive of CloudFront log files chunk by chunk, resuming from a checkpoint",
+        epilog="Example: %(prog)s s3://bucket/elxr_org/ ../public/elxr_org_view.csv elxr_org_view --chunk-size 1000",
+    )
+    _add_arguments(parser)
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="number of log files counted per checkpoint (default: 500)"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="the checkpoint file listing counted log files (default: <csv_path>.backfill.json)",
+    )
+    pa = parser.parse_args(args)
+    if pa.chunk_size < 1:
+        parser.error("The chunk size must be positive!")
+    csv_path: Path = pa.csv_path[0]
+    checkpoint = pa.checkpoint or csv_path.with_name(csv_path.name + ".backfill.json")
+    backfill(open_log_source(pa.log_path[0]), _pipeline(parser, pa), checkpoint, chunk_size=pa.chunk_size)
+    return 0
+
+
+def stream_main(args: list[str]) -> int:
+    """
+    The routine to ingest CloudFront real-time log records from a stream and update the csv file continuously.
+
+    It takes the same arguments as main, with a stream in place of the log path, plus the field order and the
+    micro-batch options.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics stream",
+        description="ingest CloudFront real-time log records from stdin, a named pipe or a Unix socket",
+        epilog="Example: kinesis-consumer | %(prog)s - ../public/package_download.csv package_download "
+        "--field-order realtime_fields.txt",
+    )
+    parser.add_argument("source", help='"-" for stdin, a named pipe, or a Unix socket to connect to')
+    _add_arguments(parser, log_path=False)
+    parser.add_argument(
+        "--field-order",
+        type=lambda x: is_index(parser, x),
+        help="file listing the fields of the real-time log configuration in order (default: all fields)",
+    )
+    parser.add_argument("--batch-size", type=int, default=10_000, help="most records ingested at once (default: 10000)")
+    parser.add_argument(
+        "--batch-interval",
+        type=float,
+        default=5.0,
+        help="most seconds a record waits to be ingested (default: 5)",
+    )
+    parser.add_argument(
+        "--publish-interval", type=float, default=60.0, help="seconds between writing the csv files (default: 60)"
+    )
+    pa = parser.parse_args(args)
+    if pa.batch_size < 1:
+        parser.error("The batch size must be positive!")
+    if pa.source != "-" and not Path(pa.source).exists():
+        parser.error(f"The path does not exist! ({pa.source})")
+    field_order = DEFAULT_FIELD_ORDER
+    if pa.field_order:
+        try:
+            field_order = load_field_order(pa.field_order)
+        except ValueError as e:
+            parser.error(str(e))
+    ingest_stream(
+        pa.source,
+        _pipeline(parser, pa),
+        field_order,
+        batch_size=pa.batch_size,
+        batch_interval=pa.batch_interval,
+        publish_interval=pa.publish_interval,
+    )
+    return 0
+
+
+def map_main(args: list[str]) -> int:
+    """
+    The routine to count a shard of log files into a partial aggregate file.
+
+    It takes the same arguments as main, with the partial file in place of the csv path.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics map",
+        description="count a shard of CloudFront log files into a partial aggregate file for reduce",
+        epilog="Example: %(prog)s logs/elxr_org/2024-10-01/ partials/2024-10-01.json.gz elxr_org_view",
+    )
+    parser.add_argument(
+        "log_path",
+        nargs=1,
+        type=lambda x: is_log_location(parser, x),
+        help="the directory contains the log files of the shard, or an s3://bucket/prefix URL",
+    )
+    parser.add_argument(
+        "partial_path", nargs=1, type=lambda x: is_file(parser, x), help="the partial aggregate file to write"
+    )
+    parser.add_argument("log_type", nargs=1, choices=PARTIAL_LOG_TYPES, help="the log type")
+    _add_options(parser)
+    pa = parser.parse_args(args)
+    map_logs(
+        pa.log_path[0],
+        pa.partial_path[0],
+        pa.log_type[0],
+        city_db=pa.city_db,
+        classifier=_classifier(pa),
+        dedup_window=pa.dedup_window,
+        completion=pa.completion,
+        bucket_width=BUCKET_WIDTHS[pa.bucket_width],
+    )
+    return 0
+
+
+def reduce_main(args: list[str]) -> int:
+    """
+    The routine to merge partial aggregate files into the csv file.
+
+    It takes the csv path, then the partial files; the log type and counting options are those of the partials.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics reduce",
+        description="merge partial aggregate files written by map and add their counts into the csv files",
+        epilog="Example: %(prog)s public/elxr_org_view.csv partials/*.json.gz --city-db GeoLite2-City.mmdb",
+    )
+    parser.add_argument("csv_path", nargs=1, type=lambda x: is_file(parser, x), help="the csv file to load and store")
+    parser.add_argument(
+        "partial_path", nargs="+", type=lambda x: is_index(parser, x), help="the partial aggregate files to merge"
+    )
+    _add_options(parser)
+    pa = parser.parse_args(args)
+    try:
+        reduce_partials(
+            pa.partial_path, pa.csv_path[0], compress=pa.compress, index_files=pa.packages_index, city_db=pa.city_db
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    return 0
+
+
+def run_main(args: list[str]) -> int:
+    """
+    The routine to run the one-shot runs listed in a jobs file concurrently.
+
+    It takes the jobs file, each line the arguments of main, and returns 1 if any job failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog="elxr-metrics run",
+        description="run the one-shot runs listed in a jobs file concurrently, and report how long each took",
+        epilog="Example: %(prog)s jobs.txt",
+    )
+    parser.add_argument(
+        "jobs_path",
+        nargs=1,
+        type=lambda x: is_index(parser, x),
+        help="file listing a one-shot run per line: log_path csv_path log_type [options]",
+    )
+    parser.add_argument("--workers", type=int, help="most jobs run at once (default: all)")
+    pa = parser.parse_args(args)
+    if pa.workers is not None and pa.workers < 1:
+        parser.error("The number of workers must be positive!")
+    try:
+        lines = load_jobs(pa.jobs_path[0])
+    except ValueError as e:
+        parser.error(str(e))
+    jobs: dict[str, Callable[[], Any]] = {}
+    outputs: dict[tuple[Path, str], int] = {}
+    for lineno, job_args in lines:
+        job_parser = _one_shot_parser(prog=f"{pa.jobs_path[0]}:{lineno}")
+        job = job_parser.parse_args(job_args)
+        csv_path: Path = job.csv_path[0]
+        folder = csv_path.resolve().parent / (ESTIMATE_DIR if job.sample < 1 else "")
+        for output in ((folder, job.log_type[0]), (folder, csv_path.name)):
+            if output in outputs:
+                parser.error(f"jobs at lines {outputs[output]} and {lineno} write the same files! ({csv_path})")
+            outputs[output] = lineno
+        jobs[f"{lineno}:{job.log_type[0]}"] = _one_shot(job_parser, job)
+    results = run_jobs(jobs, pa.workers)
+    return 1 if any(result.error for result in results) else 0
+
+
+def main(args: list[str] | None = None) -> int:
+    """
+    The main routine to parse cloudfront logs and store into csv file.
+
+    It requires 3 command line argument:
+    log_path -- the log file directory
+    csv_path -- the csv file to load and store
+    log_type -- the log type, one of elxr_org_view, package_download, image_download, edge_performance, metrics
+
+    With "watch", "backfill", "stream", "map", "reduce" or "run" as the first argument, it runs watch_main,
+    backfill_main, stream_main, map_main, reduce_main or run_main instead.
+    """
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["watch"]:
+        return watch_main(args[1:])
+    if args[:1] == ["backfill"]:
+        return backfill_main(args[1:])
+    if args[:1] == ["stream"]:
+        return stream_main(args[1:])
+    if args[:1] == ["map"]:
+        return map_main(args[1:])
+    if args[:1] == ["reduce"]:
+        return reduce_main(args[1:])
+    if args[:1] == ["run"]:
+        return run_main(args[1:])
+
+    parser = _one_shot_parser()
+    pa = parser.parse_args(args)
+    _one_shot(parser, pa)()
     return 0
 
 
@@ -0,0 +1,69 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module of the common interface of in-memory metric aggregators"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import Any, Iterable, TypeVar
+
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry
+
+try:
+    import pyarrow
+except ImportError:  # optional, pip install elxr-metrics[arrow]
+    pyarrow = None
+
+Rows = list[dict[str, Any]]
+A = TypeVar("A", bound="Aggregator")
+
+
+class Aggregator(ABC):
+    """
+    Count metrics of log entries in memory, without a database or files.
+
+    Entries are fed one at a time or in batches, aggregators fed with different entries of the same log type
+    merge into one, and snapshot returns the results as tables of rows, keyed by the name of the csv file the
+    command line writes them to. The parse_*_logs functions feed an aggregator and merge its results into the
+    csv files, so both give the same numbers.
+    """
+
+    @abstractmethod
+    def feed(self, entry: CloudFrontLogEntry) -> None:
+        """count one log entry."""
+
+    def feed_batch(self: A, entries: Iterable[CloudFrontLogEntry]) -> A:
+        """count log entries, and return the aggregator."""
+        feed = self.feed
+        for entry in entries:
+            feed(entry)
+        return self
+
+    @abstractmethod
+    def merge(self: A, other: A) -> A:
+        """add the counts of another aggregator of the same kind, and return the aggregator."""
+
+    @abstractmethod
+    def snapshot(self) -> dict[str, Rows]:
+        """
+        the current results.
+
+        :return: rows of each table, sorted like the csv files
+        :rtype: dict[str, Rows]
+        """
+
+    def to_arrow(self) -> dict[str, Any]:
+        """
+        the current results as Arrow tables.
+
+        :return: a pyarrow.Table of each table of snapshot
+        :rtype: dict[str, pyarrow.Table]
+        :raises ImportError: if pyarrow is not installed
+        """
+        if pyarrow is None:
+            raise ImportError("Arrow results require pyarrow, pip install elxr-metrics[arrow]")
+        return {name: pyarrow.Table.from_pylist(rows) for name, rows in self.snapshot().items()}
@@ -0,0 +1,116 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to rebuild metrics from an archive of logs in resumable chunks"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+from pathlib import Path
+from typing import Generator, Iterable
+
+import duckdb
+
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry
+from elxr_metrics.elapsed import elapsed_timer
+from elxr_metrics.export import publish
+from elxr_metrics.log_source import LocalLogSource, S3LogSource, log_order
+from elxr_metrics.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def load_checkpoint(checkpoint: Path) -> set[str]:
+    """
+    Read the keys of log files already counted into the csv files.
+
+    :param checkpoint: the checkpoint file
+    :type checkpoint: Path
+    :return: the done keys, empty if there is no checkpoint
+    :rtype: set[str]
+    """
+    if not checkpoint.exists():
+        return set()
+    return set(json.loads(checkpoint.read_text(encoding="utf-8"))["done"])
+
+
+class _Progress:  # pylint: disable=too-few-public-methods
+    """count entries passing through and report throughput and ETA."""
+
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.files = 0
+        self.entries = 0
+
+    def count(self, entries: Iterable[CloudFrontLogEntry]) -> Generator[CloudFrontLogEntry, None, None]:
+        """pass entries through, counting them."""
+        for entry in entries:
+            self.entries += 1
+            yield entry
+
+    def report(self, files: int, seconds: float) -> None:
+        """log the progress after files more were done in seconds since the start."""
+        self.files += files
+        rate = self.files / seconds if seconds > 0 else 0.0
+        eta = datetime.timedelta(seconds=round((self.total - self.files) / rate)) if rate else "unknown"
+        logger.info(
+            "backfill %d/%d files, %d entries, %.1f files/s, %.0f entries/s, ETA %s",
+            self.files,
+            self.total,
+            self.entries,
+            rate,
+            self.entries / seconds if seconds > 0 else 0.0,
+            eta,
+        )
+
+
+def backfill(
+    source: LocalLogSource | S3LogSource,
+    pipeline: Pipeline,
+    checkpoint: Path,
+    chunk_size: int = 500,
+) -> None:
+    """
+    Count an archive of log files chunk by chunk, resuming after the files of checkpoint.
+
+    Files are taken in the order of the hour in their CloudFront file name. After each chunk, the csv files and
+    the checkpoint listing all counted files are published together, so an interruption loses at most the chunk
+    in progress, and a rerun with the same checkpoint skips the counted files. The csv files must not be updated
+    by another run in the meantime. With the last chunk, the pipeline is flushed, e.g. image downloads still in
+    progress are judged on the bytes fetched.
+
+    :param source: the log files to count
+    :type source: LocalLogSource | S3LogSource
+    :param pipeline: the pipeline of the log type
+    :type pipeline: Pipeline
+    :param checkpoint: the checkpoint file, created if missing
+    :type checkpoint: Path
+    :param chunk_size: number of files per chunk, default to 500
+    :type chunk_size: int
+    :return: None
+    """
+    done = load_checkpoint(checkpoint)
+    keys = sorted((key for key in source.keys() if key not in done), key=log_order)
+    logger.info("backfill %d files from %s, %d already done", len(keys), source, len(done))
+    progress = _Progress(len(keys))
+    conn = duckdb.connect(":memory:")
+    try:
+        state = pipeline.load(conn)
+        with elapsed_timer() as et:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start : start + chunk_size]
+                pipeline.ingest(conn, progress.count(source.entries(chunk, pipeline.line_filter)))
+                if pipeline.flush is not None and start + chunk_size >= len(keys):
+                    pipeline.flush(conn)
+                done.update(chunk)
+                with publish() as pub:
+                    state = pipeline.save(conn, state)
+                    pub.write_text(checkpoint, json.dumps({"done": sorted(done)}, indent=0))
+                progress.report(len(chunk), et())
+    finally:
+        conn.close()
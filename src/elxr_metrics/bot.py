@@ -0,0 +1,129 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to classify log entries as bot or human traffic"""
+
+from __future__ import annotations
+
+import ipaddress
+import logging
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+# case-insensitive regular expressions for the user agents of crawlers, scanners, monitors and scripted clients;
+# generic words are anchored or replaced by known tokens, as bare "bot" or "scan" also match browsers on devices
+# like Cubot phones
+BOT_AGENT_PATTERNS = (
+    r"(?<!cu)(?<!ro)bot(?![a-z])",  # Googlebot-Image, bingbot/2.0, Slackbot-LinkExpanding, TelegramBot
+    "crawl",
+    "spider",
+    "slurp",
+    "censys",
+    "masscan",
+    "zgrab",
+    "nmap",
+    r"\bscanner\b",
+    "google-inspectiontool",
+    "uptime",
+    "pingdom",
+    "nagios",
+    "site24x7",
+    "statuscake",
+    "headless",
+    "lighthouse",
+    "facebookexternalhit",
+    "skypeuripreview",
+    "whatsapp/",
+    "curl/",
+    "wget/",
+    "python-requests",
+    "python-urllib",
+    "aiohttp",
+    "go-http-client",
+    "java/",
+    "okhttp",
+    "libwww",
+    "httpclient",
+    "gitlab-runner",
+)
+# all patterns are matched in one pass of a single compiled alternation
+_BOT_AGENT_RE = re.compile("|".join(BOT_AGENT_PATTERNS), re.IGNORECASE)
+_VERDICT_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=_VERDICT_CACHE_SIZE)
+def is_bot_agent(user_agent: str | None) -> bool:
+    """
+    Check whether a user agent belongs to a bot.
+
+    A missing user agent is a bot, as browsers and package managers always send one.
+    Verdicts are cached, and the distinct user agents of a log are few, so most lines cost one cache hit.
+
+    :param user_agent: the user agent of the request
+    :type user_agent: str | None
+    :return: True if it is a bot
+    :rtype: bool
+    """
+    if not user_agent:
+        return True
+    return _BOT_AGENT_RE.search(user_agent) is not None
+
+
+class BotClassifier:
+    """
+    Classify requests by user agent and, optionally, by client network.
+
+    Networks are for clients that do not announce themselves, e.g. CI systems downloading packages with apt.
+    The IP verdicts are cached in a bounded LRU cache.
+    """
+
+    def __init__(self, networks: Iterable[str] = ()) -> None:
+        self.networks = tuple(ipaddress.ip_network(n.strip(), strict=False) for n in networks if n.strip())
+        self._ip_is_bot = lru_cache(maxsize=_VERDICT_CACHE_SIZE)(self._match_ip)
+
+    def __reduce__(self):
+        # the verdict cache is not pickled, e.g. for a job in another process, and starts empty there
+        return BotClassifier, (self.identity,)
+
+    @classmethod
+    def from_file(cls, path: Path) -> BotClassifier:
+        """create a classifier with the networks of a file, one CIDR per line, # starts a comment."""
+        lines = (line.partition("#")[0] for line in path.read_text(encoding="utf-8").splitlines())
+        return cls(lines)
+
+    @property
+    def identity(self) -> list[str]:
+        """the sorted networks, the same for classifiers that tell the same requests apart."""
+        return sorted({str(network) for network in self.networks})
+
+    def _match_ip(self, ip: str | None) -> bool:
+        if not ip:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def is_bot(self, user_agent: str | None, ip: str | None) -> bool:
+        """
+        Check whether a request comes from a bot.
+
+        :param user_agent: the user agent of the request
+        :type user_agent: str | None
+        :param ip: the client IP address
+        :type ip: str | None
+        :return: True if the user agent or the client network belongs to a bot
+        :rtype: bool
+        """
+        return is_bot_agent(user_agent) or (bool(self.networks) and self._ip_is_bot(ip))
+
+
+DEFAULT_CLASSIFIER = BotClassifier()
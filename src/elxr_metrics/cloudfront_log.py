@@ -10,11 +10,36 @@ from __future__ import annotations
 
 import datetime
 import gzip
+import io
+import logging
+import re
+import threading
 import urllib.parse
+import zlib
+from contextlib import ExitStack, contextmanager
 from dataclasses import Field, dataclass, fields
+from functools import lru_cache
 from http import cookies
 from pathlib import Path
-from typing import Any, Generator
+from typing import IO, Any, Generator, Iterable
+
+try:
+    import zstandard
+except ImportError:  # optional, pip install elxr-metrics[zstd]
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# suffixes of log files: CloudFront's gzip, zstd recompressed archives and uncompressed exports
+LOG_FILE_SUFFIXES = (".gz", ".zst", ".log")
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# widths of time buckets in seconds, by the name used on the command line
+BUCKET_WIDTHS = {"1h": 3600, "6h": 6 * 3600, "1d": 24 * 3600}
+DEFAULT_BUCKET_WIDTH = BUCKET_WIDTHS["6h"]
+
+_EPOCH_DAY = datetime.date(1970, 1, 1).toordinal()
 
 
 @dataclass(frozen=True)
@@ -62,6 +87,42 @@ class CloudFrontLogEntry:  # pylint: disable=too-many-instance-attributes
             self.date or datetime.date.min, self.time or datetime.time.min, datetime.timezone.utc
         )
 
+    @property
+    def epoch(self) -> int:
+        """return the seconds since the Unix epoch, the same instant as timestamp without building a datetime."""
+        t = self.time
+        seconds = t.hour * 3600 + t.minute * 60 + t.second if t is not None else 0
+        return _day_epoch(self.date or datetime.date.min) + seconds
+
+
+@lru_cache(maxsize=1024)
+def _day_epoch(date: datetime.date) -> int:
+    """the seconds since the Unix epoch at the start of date in UTC."""
+    return (date.toordinal() - _EPOCH_DAY) * 86400
+
+
+@lru_cache(maxsize=4096)
+def _bucket_datetime(epoch: int) -> datetime.datetime:
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=epoch)
+
+
+def time_bucket(epoch: int, width: int = DEFAULT_BUCKET_WIDTH) -> datetime.datetime:
+    """
+    Put a time in its time bucket.
+
+    Buckets are aligned to the Unix epoch, so a bucket of 1h, 6h or 1d starts at a full hour, at 0, 6, 12 or 18
+    o'clock, or at midnight UTC. The bucket is found by integer arithmetic, and the datetime of each bucket is
+    built once and cached.
+
+    :param epoch: the seconds since the Unix epoch, e.g. CloudFrontLogEntry.epoch
+    :type epoch: int
+    :param width: the bucket width in seconds, one of BUCKET_WIDTHS, default to 6 hours
+    :type width: int
+    :return: the start of the bucket, a naive datetime in UTC as stored in TIMESTAMP columns
+    :rtype: datetime.datetime
+    """
+    return _bucket_datetime(epoch - epoch % width)
+
 
 def _to_datetime(value: str) -> datetime.datetime:
     """convert str to datetime."""
@@ -75,7 +136,7 @@ def _to_cookie(value: str) -> dict[str, str]:
     return {urllib.parse.unquote(key): urllib.parse.unquote(morsel.value) for key, morsel in cookie.items()}
 
 
-def _to_object(value: str, field: Field):  # noqa: C901 # pylint: disable=too-many-return-statements
+def to_object(value: str, field: Field):  # noqa: C901 # pylint: disable=too-many-return-statements
     """convert str to python object."""
     value = value.strip('"')
     field_type = field.type.partition("|")[0].strip()
@@ -107,46 +168,235 @@ def _to_object(value: str, field: Field):  # noqa: C901 # pylint: disable=too-ma
     raise ValueError(f"unhandled value:type {value}:{field_type}")
 
 
-# Function to parse CloudFront log file (supports .gz files)
-def parse_cloudfront_log(file_path: Path) -> Generator[CloudFrontLogEntry, Any, None]:
+class LineFilter:
+    """
+    Cheap checks of a raw log line, run before it is decoded, split and converted.
+
+    A line is kept if it contains one of any_of, e.g. the allowed content types, its status is one of statuses,
+    and its decoded uri contains all of uri_contains. Only values logged verbatim are matched against the raw
+    bytes; the status and uri are read from a split of the first columns, the uri unquoted like cs_uri_stem, so
+    the filter never drops a line the full check of a pipeline would accept, unless it is sampled. The lines seen
+    and kept are counted across files and threads for report.
+    """
+
+    def __init__(
+        self, any_of: Iterable[str] = (), statuses: Iterable[int] | None = None, uri_contains: Iterable[str] = ()
+    ) -> None:
+        self.any_of = tuple(s.encode() for s in any_of)
+        self.statuses = None if statuses is None else frozenset(str(s).encode() for s in statuses)
+        self.uri_contains = tuple(uri_contains)
+        self.sample_rate = 1.0
+        self.sample_field: str | None = None
+        self._sample_column: int | None = None
+        self._sample_threshold = 1 << 32
+        self._split = 9
+        self.lines = 0
+        self.kept = 0
+        self._lock = threading.Lock()
+
+    def sampled(self, rate: float, field: str) -> LineFilter:
+        """
+        a copy of the filter that also keeps only a share rate of the lines, chosen by the CRC-32 of a field.
+
+        The choice depends on the raw value of field alone, so it is the same in every run, file and thread, and
+        all lines of a value are kept or dropped together, e.g. all requests of a client when sampled by c_ip.
+
+        :param rate: the share of lines to keep, in (0, 1]
+        :type rate: float
+        :param field: the field hashed, a field of CloudFrontLogEntry other than date and time
+        :type field: str
+        :return: the sampling filter
+        :rtype: LineFilter
+        :raises ValueError: if rate is out of range or field is unknown
+        """
+        if not 0 < rate <= 1:
+            raise ValueError(f"sample rate must be in (0, 1]: {rate}")
+        names = [f.name for f in fields(CloudFrontLogEntry)]
+        if field not in names[2:]:
+            raise ValueError(f"unknown sample field: {field}")
+        sampled = LineFilter()
+        sampled.__dict__.update(self.__dict__)
+        sampled.sample_rate = rate
+        sampled.sample_field = field
+        sampled._sample_column = names.index(field)  # pylint: disable=protected-access
+        sampled._sample_threshold = int(rate * (1 << 32))  # pylint: disable=protected-access
+        sampled._split = max(9, names.index(field) + 1)  # pylint: disable=protected-access
+        sampled.lines = sampled.kept = 0
+        sampled._lock = threading.Lock()  # pylint: disable=protected-access
+        return sampled
+
+    def __call__(self, line: bytes) -> bool:
+        if self.any_of and not any(s in line for s in self.any_of):
+            return False
+        if self.statuses is None and not self.uri_contains and self._sample_column is None:
+            return True
+        col = line.split(b"\t", self._split)
+        if len(col) < 9:  # malformed, leave it to the parser
+            return True
+        if self.statuses is not None and col[8] not in self.statuses:
+            return False
+        if self._sample_column is not None and (
+            len(col) <= self._sample_column or zlib.crc32(col[self._sample_column]) >= self._sample_threshold
+        ):
+            return False
+        if self.uri_contains:
+            uri = col[7].decode("utf-8", "replace")
+            if "%" in uri:
+                uri = urllib.parse.unquote(urllib.parse.unquote(uri))
+            return all(s in uri for s in self.uri_contains)
+        return True
+
+    def record(self, lines: int, kept: int) -> None:
+        """add the lines seen and kept of a file."""
+        with self._lock:
+            self.lines += lines
+            self.kept += kept
+
+    def report(self) -> None:
+        """log the share of lines kept."""
+        share = self.kept / self.lines if self.lines else 0.0
+        logger.info("prefilter kept %d of %d log lines (%.2f%%)", self.kept, self.lines, share * 100)
+
+
+def is_log_file(name: str) -> bool:
+    """check if a file or object name has a log file suffix."""
+    return name.endswith(LOG_FILE_SUFFIXES)
+
+
+class _Prefixed(io.RawIOBase):
+    """a stream with the bytes read ahead of it put back in front."""
+
+    def __init__(self, head: bytes, stream: IO[bytes]) -> None:
+        super().__init__()
+        self._head = head
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:  # type: ignore[override]
+        if self._head:
+            n = min(len(buffer), len(self._head))
+            buffer[:n] = self._head[:n]
+            self._head = self._head[n:]
+            return n
+        data = self._stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+@contextmanager
+def _open_lines(file_path: Path | IO[bytes], name: str | None = None) -> Generator[Iterable[bytes], None, None]:
+    """
+    open the raw lines of a log file, detecting its format by its magic bytes.
+
+    gzip and zstd are decompressed as they are read, anything else is read as plain text through a buffered reader.
+    A .gz or .zst file that is neither is corrupt, not plain text.
+    """
+    with ExitStack() as stack:
+        if isinstance(file_path, (str, Path)):
+            name = str(file_path)
+            raw: IO[bytes] = stack.enter_context(open(file_path, "rb"))
+            magic = raw.read(4)
+            raw.seek(0)
+        else:
+            magic = file_path.read(4)
+            raw = io.BufferedReader(_Prefixed(magic, file_path))
+        compressed = magic.startswith(_GZIP_MAGIC) or magic.startswith(_ZSTD_MAGIC)
+        if not compressed and name is not None and name.endswith((".gz", ".zst")):
+            raise OSError(f"not a gzip or zstd file: {name}")
+        if magic.startswith(_GZIP_MAGIC):
+            lines: Iterable[bytes] = stack.enter_context(gzip.open(raw, "rb"))
+        elif magic.startswith(_ZSTD_MAGIC):
+            if zstandard is None:
+                raise ImportError("reading zstd log files requires zstandard, pip install elxr-metrics[zstd]")
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            lines = io.BufferedReader(stack.enter_context(reader))
+        else:
+            lines = raw
+        yield lines
+
+
+# Function to parse CloudFront log file (supports .gz, .zst and plain files)
+def parse_cloudfront_log(
+    file_path: Path | IO[bytes], line_filter: LineFilter | None = None, name: str | None = None
+) -> Generator[CloudFrontLogEntry, Any, None]:
     """
     Parse CloudFront log.
 
-    file_path is the gz log file.
+    file_path is the log file, or a binary stream of it. gzip and zstd (pip install elxr-metrics[zstd]) files are
+    decompressed as they are read, whatever their name; other files are read as plain text.
+    Lines are read as bytes; with a line_filter, only the lines it keeps are decoded and parsed.
 
-    :param file_path: the path of cloudfront log file, compressed by gzip
-    :type file_path: Path
+    :param file_path: the path of cloudfront log file, compressed by gzip or zstd or not, or a readable binary stream
+    :type file_path: Path | IO[bytes]
+    :param line_filter: the checks of raw lines, default to None to parse every line
+    :type line_filter: LineFilter | None
+    :param name: the name of a stream, e.g. its object key, to tell a corrupt .gz or .zst from plain text
+    :type name: str | None
     :return: generator of log entries
     :rtype: CloudFrontLogEntry
     :raises Exception: if file_path does not exist, not a file
     """
 
     model_fields = fields(CloudFrontLogEntry)
-    # Open and read .gz files
-    with gzip.open(file_path, "rt", encoding="utf-8") as file:  # 'rt' mode for reading text
-        for line in file:
-            # Skip comments or empty lines
-            line = line.strip()
-            if line.startswith("#") or not line:
-                continue
-            # Split the line into columns
-            col = line.split("\t")
-
-            yield CloudFrontLogEntry(
-                *[_to_object(value, field) for value, field in zip(col, model_fields)]  # type: ignore[valid-type]
-            )
-
-
-def webpage_timebucket(t: datetime.datetime) -> datetime.datetime:
-    """Put timestamp in 4 time buckets (6-hour interval).
-
-    This function takes a datetime object and return the containing timebucket.
-    The resulting datetime will have the hour set to 0, 6, 12, or 18, with minutes, seconds,
-    and microseconds set to 0, and the timezone set to UTC.
-
-    :param t: The original timestamp.
-    :type t: datetime.datetime
-    :return: The timestamp representing the containing timebucket (6-hour interval).
-    :rtype: datetime.datetime
+    # one log file covers about an hour, so dates and times repeat and are parsed once per file
+    dates: dict[str, datetime.date | None] = {}
+    times: dict[str, datetime.time | None] = {}
+    lines = kept = 0
+    with _open_lines(file_path, name) as file:
+        try:
+            for raw in file:
+                # Skip comments or empty lines
+                raw = raw.strip()
+                if raw.startswith(b"#") or not raw:
+                    continue
+                lines += 1
+                if line_filter is not None and not line_filter(raw):
+                    continue
+                kept += 1
+                yield _to_entry(raw.decode("utf-8"), model_fields, dates, times)
+        finally:
+            if line_filter is not None:
+                line_filter.record(lines, kept)
+
+
+def _to_entry(
+    line: str,
+    model_fields: tuple[Field, ...],
+    dates: dict[str, datetime.date | None],
+    times: dict[str, datetime.time | None],
+) -> CloudFrontLogEntry:
+    """convert a log line to an entry, parsing its date and time through the caches of the file."""
+    date_field, time_field = model_fields[:2]
+    # Split the line into columns
+    col = line.split("\t")
+    if col[0] not in dates:
+        dates[col[0]] = to_object(col[0], date_field)
+    if len(col) > 1 and col[1] not in times:
+        times[col[1]] = to_object(col[1], time_field)
+
+    return CloudFrontLogEntry(
+        dates[col[0]],
+        times.get(col[1]) if len(col) > 1 else None,
+        *[to_object(value, field) for value, field in zip(col[2:], model_fields[2:])],  # type: ignore[misc]
+    )
+
+
+# standard CloudFront log file name: <distribution-id>.<YYYY-MM-DD-HH>.<unique-id>.gz, or .zst/.log if converted
+_LOG_FILE_TIME_RE = re.compile(r"\.(\d{4}-\d{2}-\d{2}-\d{2})\.[^.]+\.(?:gz|zst|log)$")
+
+
+def log_file_time(file_path: Path) -> datetime.datetime | None:
+    """
+    Get the hour a CloudFront log file covers from its file name.
+
+    :param file_path: the path of cloudfront log file, e.g. A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0.gz
+    :type file_path: Path
+    :return: the start of the hour in UTC, or None if the file name does not follow the CloudFront pattern
+    :rtype: datetime.datetime | None
     """
-    return t.replace(hour=t.hour // 6 * 6, second=0, microsecond=0, minute=0, tzinfo=datetime.timezone.utc)
+    m = _LOG_FILE_TIME_RE.search(file_path.name)
+    if not m:
+        return None
+    return datetime.datetime.strptime(m.group(1), r"%Y-%m-%d-%H").replace(tzinfo=datetime.timezone.utc)
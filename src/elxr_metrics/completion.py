@@ -0,0 +1,161 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to reassemble the byte ranges fetched by a client and tell when a download is complete"""
+
+from __future__ import annotations
+
+import datetime
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Hashable
+
+DEFAULT_COMPLETION = 0.9  # fraction of the file a client must fetch to count a download
+STALE_AFTER = 3600.0  # seconds without a request after which a partial download is given up
+_MAX_KEYS = 1 << 20
+
+# a completed download: file name, client and the time of its last request
+Download = tuple[str, Hashable, "datetime.datetime | None"]
+
+
+class _Coverage:  # pylint: disable=too-few-public-methods
+    """the disjoint, sorted [start, end) byte intervals fetched by one client from one file."""
+
+    __slots__ = ("starts", "ends", "covered", "last", "time")
+
+    def __init__(self) -> None:
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        self.covered = 0
+        self.last = float("-inf")  # the time of the latest request in seconds
+        self.time: datetime.datetime | None = None
+
+    def add(self, start: int, end: int) -> None:
+        """merge [start, end) with the intervals it overlaps or touches."""
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            self.covered -= sum(self.ends[k] - self.starts[k] for k in range(i, j))
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+        self.covered += end - start
+
+    def copy(self) -> _Coverage:
+        """a copy of the intervals that does not change with them."""
+        other = _Coverage()
+        other.starts, other.ends = self.starts.copy(), self.ends.copy()
+        other.covered, other.last, other.time = self.covered, self.last, self.time
+        return other
+
+
+class DownloadTracker:
+    """
+    Track the bytes each client fetched of each file, and report a download once enough of the file is covered.
+
+    Whole responses, range requests, parallel segments and resumed transfers of a client are merged into one set
+    of byte intervals. A download is complete when the intervals cover completion of the file size. The size is
+    confirmed by the Content-Length of a whole response; until then it is estimated by the largest byte end seen
+    of the file, and a partial download is only judged when it is dropped. Partial downloads are dropped once
+    their last request is stale_after seconds older than the latest request seen, or the least recently seen
+    first when more than max_keys are tracked; completed ones are dropped at once, so memory is bounded by the
+    downloads in progress.
+    """
+
+    def __init__(
+        self, completion: float = DEFAULT_COMPLETION, stale_after: float = STALE_AFTER, max_keys: int = _MAX_KEYS
+    ) -> None:
+        self.completion = completion
+        self.stale_after = stale_after
+        self.max_keys = max_keys
+        self._pending: OrderedDict[tuple[str, Hashable], _Coverage] = OrderedDict()
+        self._sizes: dict[str, int] = {}  # file sizes confirmed by whole responses
+        self._ends: dict[str, int] = {}  # the largest byte end fetched of each file
+        self._watermark = float("-inf")  # the latest request time seen
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def copy(self) -> DownloadTracker:
+        """a copy of the tracker that does not change with it, to restore after a failed ingest."""
+        other = DownloadTracker(self.completion, self.stale_after, self.max_keys)
+        other._pending = OrderedDict((key, coverage.copy()) for key, coverage in self._pending.items())
+        other._sizes = self._sizes.copy()
+        other._ends = self._ends.copy()
+        other._watermark = self._watermark
+        return other
+
+    def _complete(self, name: str, coverage: _Coverage, final: bool) -> bool:
+        size = self._sizes.get(name)
+        if size is None and final:
+            size = self._ends.get(name)
+        return bool(size) and coverage.covered >= self.completion * size
+
+    def _expire(self) -> list[Download]:
+        done = []
+        horizon = self._watermark - self.stale_after
+        while self._pending:
+            key, coverage = next(iter(self._pending.items()))
+            if coverage.last >= horizon and len(self._pending) <= self.max_keys:
+                break
+            del self._pending[key]
+            if self._complete(key[0], coverage, True):
+                done.append((key[0], key[1], coverage.time))
+        return done
+
+    def add(
+        self,
+        name: str,
+        client: Hashable,
+        start: int,
+        end: int,
+        timestamp: datetime.datetime | None,
+        size: int | None = None,
+    ) -> list[Download]:
+        """
+        Record the bytes [start, end) of file name sent to client.
+
+        :param name: the file name
+        :type name: str
+        :param client: the client, e.g. its IP address and user agent
+        :type client: Hashable
+        :param start: the first byte sent
+        :type start: int
+        :param end: the byte after the last one sent
+        :type end: int
+        :param timestamp: the request time, default to the latest request time seen
+        :type timestamp: datetime.datetime | None
+        :param size: the file size, if the response was the whole file
+        :type size: int | None
+        :return: the downloads completed by this request or judged when dropped
+        :rtype: list[Download]
+        """
+        if size:
+            self._sizes[name] = size
+        if end > self._ends.get(name, 0):
+            self._ends[name] = end
+        key = (name, client)
+        coverage = self._pending.pop(key, None) or _Coverage()
+        coverage.add(start, end)
+        t = timestamp.timestamp() if timestamp is not None else self._watermark
+        if t >= coverage.last:
+            coverage.last = t
+            coverage.time = timestamp
+        self._watermark = max(self._watermark, t)
+        done = []
+        if self._complete(name, coverage, False):
+            done.append((name, client, coverage.time))
+        else:
+            self._pending[key] = coverage
+        done.extend(self._expire())
+        return done
+
+    def flush(self) -> list[Download]:
+        """drop all partial downloads, e.g. at the end of the logs, and return the complete ones."""
+        done = [(name, client, c.time) for (name, client), c in self._pending.items() if self._complete(name, c, True)]
+        self._pending.clear()
+        return done
@@ -0,0 +1,123 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to map binary package names to source package names with Debian index files"""
+
+from __future__ import annotations
+
+import bz2
+import gzip
+import logging
+import lzma
+from pathlib import Path
+from typing import IO, Generator, Iterable
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+_OPENERS = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}
+_CACHE_SUFFIX = ".srcmap.parquet"
+
+
+def _open_index(index_file: Path) -> IO[str]:
+    """open a Packages/Sources index file, decompressing by file suffix."""
+    opener = _OPENERS.get(index_file.suffix, open)
+    return opener(index_file, "rt", encoding="utf-8")  # type: ignore[operator]
+
+
+def _parse_stanzas(lines: Iterable[str]) -> Generator[dict[str, str], None, None]:
+    """split deb822 formatted lines into stanzas of field name to value, folding continuation lines."""
+    stanza: dict[str, str] = {}
+    field = ""
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line.strip():
+            if stanza:
+                yield stanza
+            stanza, field = {}, ""
+        elif line[0] in " \t":
+            if field:
+                stanza[field] += " " + line.strip()
+        else:
+            field, _, value = line.partition(":")
+            stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+
+def parse_index(lines: Iterable[str]) -> Generator[tuple[str, str], None, None]:
+    """
+    Extract (binary, source) package name pairs from a Debian index.
+
+    Packages stanzas map Package to its Source field (version stripped), or to itself when Source is absent.
+    Sources stanzas map every name listed in the Binary field to Package.
+
+    :param lines: lines of a Packages or Sources index
+    :type lines: Iterable[str]
+    :return: generator of (binary, source) pairs
+    :rtype: tuple[str, str]
+    """
+    for stanza in _parse_stanzas(lines):
+        package = stanza.get("Package")
+        if not package:
+            continue
+        if "Binary" in stanza:  # Sources index
+            for binary in stanza["Binary"].split(","):
+                if binary.strip():
+                    yield binary.strip(), package
+        else:  # Packages index
+            source = stanza.get("Source", "").partition(" ")[0]
+            yield package, source or package
+
+
+def _cache_file(index_file: Path) -> Path:
+    return index_file.with_name(index_file.name + _CACHE_SUFFIX)
+
+
+def _build_cache(conn: duckdb.DuckDBPyConnection, index_file: Path, cache_file: Path) -> None:
+    """parse the text index once and save the binary to source pairs in parquet format."""
+    with _open_index(index_file) as f:
+        pairs = sorted(set(parse_index(f)))
+    conn.execute("""DROP TABLE IF EXISTS temp_source_map;""")
+    conn.execute("""CREATE TEMP TABLE temp_source_map (Package VARCHAR, Source VARCHAR);""")
+    if pairs:
+        conn.executemany("INSERT INTO temp_source_map VALUES (?, ?);", pairs)
+    conn.execute(f"""COPY temp_source_map TO '{cache_file}' (FORMAT PARQUET);""")
+    conn.execute("""DROP TABLE temp_source_map;""")
+    logger.info("cached %d binary packages of %s into %s", len(pairs), index_file, cache_file)
+
+
+def load_source_map(conn: duckdb.DuckDBPyConnection, index_files: Iterable[Path]) -> None:
+    """
+    Load Debian index files into the source_map table (Package, Source).
+
+    Each index (plain, .gz, .xz or .bz2) is parsed once and cached next to it as <index>.srcmap.parquet;
+    later runs read the parquet file directly unless the index is newer than the cache.
+    If a binary package appears in several indexes, the first mapping wins.
+
+    :param conn: the connection to the DuckDB database
+    :type conn: duckdb.DuckDBPyConnection
+    :param index_files: Packages or Sources index files
+    :type index_files: Iterable[Path]
+    :return: None
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS source_map (
+        Package VARCHAR PRIMARY KEY,
+        Source VARCHAR
+    );"""
+    )
+    for index_file in index_files:
+        cache_file = _cache_file(index_file)
+        if not cache_file.exists() or cache_file.stat().st_mtime < index_file.stat().st_mtime:
+            _build_cache(conn, index_file, cache_file)
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO source_map
+            SELECT Package, any_value(Source) FROM read_parquet('{cache_file}') GROUP BY Package;"""
+        )
@@ -0,0 +1,74 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to suppress repeated requests of one download within a sliding time window"""
+
+from __future__ import annotations
+
+import datetime
+from collections import OrderedDict
+from typing import Hashable
+
+DEDUP_WINDOW = 3600.0  # seconds between two requests of a client still counted as the same download
+_MAX_KEYS = 1 << 20
+
+
+class DedupWindow:
+    """
+    An expiring hash of recently seen request keys, e.g. (client IP, uri, user agent).
+
+    A key seen again within window seconds of its last request is a duplicate, and the request slides its window,
+    so the range requests and retries of one long download count once. Keys are kept in the order of their last
+    request and expire once the latest request time seen is more than window seconds past them; at most max_keys
+    keys are kept, the least recently seen ones are dropped first. Memory is bounded by the requests of one window,
+    not by the whole log.
+    """
+
+    def __init__(self, window: float = DEDUP_WINDOW, max_keys: int = _MAX_KEYS) -> None:
+        self.window = window
+        self.max_keys = max_keys
+        self._last: OrderedDict[Hashable, float] = OrderedDict()
+        self._watermark = float("-inf")  # the latest request time seen
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+    def copy(self) -> DedupWindow:
+        """a copy of the window that does not change with it, to restore after a failed ingest."""
+        other = DedupWindow(self.window, self.max_keys)
+        other._last = self._last.copy()
+        other._watermark = self._watermark
+        return other
+
+    def _expire(self) -> None:
+        horizon = self._watermark - self.window
+        while self._last:
+            key, last = next(iter(self._last.items()))
+            if last >= horizon and len(self._last) <= self.max_keys:
+                break
+            del self._last[key]
+
+    def seen(self, key: Hashable, timestamp: datetime.datetime | None) -> bool:
+        """
+        Record a request and check whether it repeats a request of the window.
+
+        :param key: the request key
+        :type key: Hashable
+        :param timestamp: the request time, a request without time is never a duplicate
+        :type timestamp: datetime.datetime | None
+        :return: True if key was seen within window seconds before or after timestamp
+        :rtype: bool
+        """
+        if timestamp is None or self.window <= 0:
+            return False
+        t = timestamp.timestamp()
+        last = self._last.pop(key, None)
+        # entries of concurrently read log files interleave, so the last request may also be a later one
+        self._last[key] = t if last is None else max(t, last)
+        if t > self._watermark:
+            self._watermark = t
+        self._expire()
+        return last is not None and abs(t - last) <= self.window
@@ -0,0 +1,219 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to parse cloudfront logs and update cache, egress and latency metrics per edge location"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Generator, Iterable
+
+import duckdb
+from duckdb import DuckDBPyConnection
+
+from elxr_metrics.cloudfront_log import DEFAULT_BUCKET_WIDTH, CloudFrontLogEntry, time_bucket
+from elxr_metrics.elapsed import timing
+from elxr_metrics.export import publish
+from elxr_metrics.log_source import read_logs
+from elxr_metrics.sketch import DDSketch
+
+EDGE_PERFORMANCE_CSV = Path("public/edge_performance.csv")
+
+logger = logging.getLogger(__name__)
+
+_HIT_RESULTS = frozenset(("Hit", "RefreshHit"))
+_QUANTILES = (50, 95, 99)
+
+
+def load_edge(conn: DuckDBPyConnection, csv_file: Path) -> None:
+    """create edge tables, and load the counts from csv_file and the latency sketches from edge_ttfb_sketch.csv."""
+    sketch_file = csv_file.parent / "edge_ttfb_sketch.csv"
+    conn.execute("""DROP TABLE IF EXISTS edge;""")
+    conn.execute("""DROP TABLE IF EXISTS edge_ttfb;""")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS edge (
+        TimeBucket TIMESTAMP,
+        Location VARCHAR,
+        Requests BIGINT,
+        Hits BIGINT,
+        EgressBytes BIGINT,
+        PRIMARY KEY (TimeBucket, Location)
+    );"""
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS edge_ttfb (
+        TimeBucket TIMESTAMP,
+        Location VARCHAR,
+        Bin INTEGER,
+        Count BIGINT,
+        PRIMARY KEY (TimeBucket, Location, Bin)
+    );"""
+    )
+    # expect header "TimeBucket,Location,Requests,Hits,HitRatio,EgressBytes,TtfbP50Ms,TtfbP95Ms,TtfbP99Ms"
+    if csv_file.exists() and csv_file.stat().st_size > 84:
+        conn.execute(
+            f"""
+            INSERT INTO edge
+            SELECT TimeBucket, Location, Requests, Hits, EgressBytes
+            FROM read_csv('{csv_file}', header = true, types = {{'TimeBucket': 'TIMESTAMP', 'Location': 'VARCHAR'}});"""
+        )
+    if sketch_file.exists() and sketch_file.stat().st_size > 29:  # expect header "TimeBucket,Location,Bin,Count"
+        conn.execute(
+            f"""
+            COPY edge_ttfb
+            FROM '{sketch_file}'
+            WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
+        )
+
+
+def save_edge(conn: DuckDBPyConnection, csv_file: Path, compress: bool = False) -> None:
+    """
+    publish the counts, hit ratio and TTFB quantiles per time bucket and edge location into csv_file,
+    and the latency sketches into edge_ttfb_sketch.csv.
+
+    The quantiles are read from the cumulative bin counts of each sketch, the same as DDSketch.quantile.
+    """
+    sketch_file = csv_file.parent / "edge_ttfb_sketch.csv"
+    gamma = DDSketch().gamma
+    quantiles = ", ".join(f"MIN(Bin) FILTER (WHERE Seen > {q / 100} * (Total - 1)) AS Bin{q}" for q in _QUANTILES)
+    latencies = ", ".join(
+        f"ROUND(2 * pow({gamma!r}, Bin{q}) / ({gamma!r} + 1) * 1000, 1) AS TtfbP{q}Ms" for q in _QUANTILES
+    )
+    with publish(compress) as pub:
+        pub.copy(
+            conn,
+            f"""
+            WITH ranked AS (
+                SELECT TimeBucket, Location, Bin,
+                SUM(Count) OVER (PARTITION BY TimeBucket, Location ORDER BY Bin) AS Seen,
+                SUM(Count) OVER (PARTITION BY TimeBucket, Location) AS Total
+                FROM edge_ttfb
+            ), bins AS (
+                SELECT TimeBucket, Location, {quantiles} FROM ranked GROUP BY TimeBucket, Location
+            )
+            SELECT TimeBucket, Location, Requests, Hits, ROUND(Hits / Requests, 4) AS HitRatio, EgressBytes,
+            {latencies}
+            FROM edge LEFT JOIN bins USING (TimeBucket, Location)
+            ORDER BY TimeBucket ASC, Location ASC""",
+            csv_file,
+        )
+        pub.copy(conn, "SELECT * FROM edge_ttfb ORDER BY TimeBucket ASC, Location ASC, Bin ASC", sketch_file)
+
+
+@contextmanager
+def _edge_performance(csv_file: Path, compress: bool = False) -> Generator[DuckDBPyConnection, Any, None]:
+    """
+    load and save edge metrics into csv_file.
+    edge_ttfb_sketch.csv is also updated at the save folder.
+    The files are published together only if the processing succeeds.
+    """
+    conn = duckdb.connect(":memory:")
+    try:
+        load_edge(conn, csv_file)
+        yield conn
+        save_edge(conn, csv_file, compress)
+    finally:
+        conn.close()
+
+
+class _EdgeCounts:  # pylint: disable=too-few-public-methods
+    """
+    in-memory aggregation of requests per time bucket and edge location.
+
+    Latencies go straight into a DDSketch per key, so no raw value is kept; _merge_edge writes the counts and
+    sketch bins once.
+    """
+
+    def __init__(self, bucket_width: int = DEFAULT_BUCKET_WIDTH) -> None:
+        self.bucket_width = bucket_width
+        self.requests: Counter[tuple[datetime.datetime, str]] = Counter()
+        self.hits: Counter[tuple[datetime.datetime, str]] = Counter()
+        self.egress: Counter[tuple[datetime.datetime, str]] = Counter()
+        self.ttfb: dict[tuple[datetime.datetime, str], DDSketch] = {}
+
+    def add(self, log_entry: CloudFrontLogEntry) -> None:
+        """count one request."""
+        location = log_entry.x_edge_location
+        if not location:
+            return
+        key = time_bucket(log_entry.epoch, self.bucket_width), location
+        self.requests[key] += 1
+        if log_entry.x_edge_result_type in _HIT_RESULTS:
+            self.hits[key] += 1
+        self.egress[key] += log_entry.sc_bytes or 0
+        if log_entry.time_to_first_byte is not None:
+            sketch = self.ttfb.get(key)
+            if sketch is None:
+                sketch = self.ttfb[key] = DDSketch()
+            sketch.add(log_entry.time_to_first_byte)
+
+
+def _merge_edge(conn: DuckDBPyConnection, counts: _EdgeCounts) -> None:
+    """merge collected counts and sketch bins into edge and edge_ttfb tables"""
+    if not counts.requests:
+        return
+    conn.executemany(
+        """
+        INSERT INTO edge (TimeBucket, Location, Requests, Hits, EgressBytes) values (?, ?, ?, ?, ?)
+        ON CONFLICT (TimeBucket, Location) DO UPDATE SET
+        Requests = edge.Requests + EXCLUDED.Requests,
+        Hits = edge.Hits + EXCLUDED.Hits,
+        EgressBytes = edge.EgressBytes + EXCLUDED.EgressBytes;""",
+        [(t, loc, n, counts.hits[t, loc], counts.egress[t, loc]) for (t, loc), n in counts.requests.items()],
+    )
+    bins = [(t, loc, b, n) for (t, loc), sketch in counts.ttfb.items() for b, n in sketch.bins.items()]
+    if not bins:
+        return
+    conn.executemany(
+        """
+        INSERT INTO edge_ttfb (TimeBucket, Location, Bin, Count) values (?, ?, ?, ?)
+        ON CONFLICT (TimeBucket, Location, Bin) DO UPDATE SET Count = edge_ttfb.Count + EXCLUDED.Count;""",
+        bins,
+    )
+
+
+def ingest_edge(
+    conn: DuckDBPyConnection, entries: Iterable[CloudFrontLogEntry], bucket_width: int = DEFAULT_BUCKET_WIDTH
+) -> None:
+    """count requests of log entries into edge tables in one transaction."""
+    counts = _EdgeCounts(bucket_width)
+    for entry in entries:
+        counts.add(entry)
+    conn.execute("BEGIN TRANSACTION;")
+    _merge_edge(conn, counts)
+    conn.execute("COMMIT;")
+
+
+@timing
+def parse_edge_performance_logs(
+    log_folder: Path | str,
+    csv_file: Path = EDGE_PERFORMANCE_CSV,
+    compress: bool = False,
+    bucket_width: int = DEFAULT_BUCKET_WIDTH,
+) -> None:
+    """
+    parse cloudfront log files and update cache hit ratio, egress bytes and time to first byte per edge location.
+
+    :param log_folder: the parent folder path of log files (compressed by gzip), or an s3://bucket/prefix URL
+    :type log_folder: Path | str
+    :param csv_file: the path of CSV file, default to EDGE_PERFORMANCE_CSV
+    :type csv_file: Path
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param bucket_width: seconds per time bucket, one of BUCKET_WIDTHS, default to 6 hours
+    :type bucket_width: int
+    :return: None
+    :raises Exception: if log_folder does not exist, not a directory.
+                       if csv_file is not a file
+    """
+    with _edge_performance(csv_file, compress) as conn:
+        ingest_edge(conn, read_logs(log_folder), bucket_width)
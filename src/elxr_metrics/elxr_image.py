@@ -9,88 +9,119 @@
 from __future__ import annotations
 
 import logging
-import re
+from collections import Counter
 from contextlib import contextmanager
 from functools import cache
 from pathlib import Path
+from typing import Iterable
 
 import duckdb
 
-from elxr_metrics.cloudfront_log import CloudFrontLogEntry, parse_cloudfront_log
+from elxr_metrics.aggregate import Aggregator, Rows
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry, LineFilter
+from elxr_metrics.completion import DEFAULT_COMPLETION, Download, DownloadTracker
+from elxr_metrics.dedup import DEDUP_WINDOW, DedupWindow
 from elxr_metrics.elapsed import timing
+from elxr_metrics.export import publish, table_checksum
+from elxr_metrics.log_source import read_logs
+from elxr_metrics.sample import SAMPLE_FIELDS, Counts, clear_counts, estimated_csv, scale_counts
 
 DOWNLOADS_ELXR_DEV_CSV = Path("public/image_stats.csv")
+_IMAGE_COUNTS: Counts = {"images": (("Name",), ("Download",))}
 
 logger = logging.getLogger(__name__)
 
 
+def load_image(conn: duckdb.DuckDBPyConnection, csv_file: Path) -> tuple[int, int]:
+    """
+    create images table and load it from csv_file.
+
+    :return: checksum of the loaded table, to tell save_image whether it changed
+    """
+    conn.execute("""DROP TABLE IF EXISTS images;""")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS images (
+        Name VARCHAR PRIMARY KEY,
+        Download INTEGER
+    );"""
+    )
+    if csv_file.exists() and csv_file.stat().st_size > 13:  # expect header "Name,Download"
+        conn.execute(
+            f"""
+            COPY images
+            FROM '{csv_file}'
+            WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
+        )
+    return table_checksum(conn, "images")
+
+
+def save_image(
+    conn: duckdb.DuckDBPyConnection, csv_file: Path, loaded: tuple[int, int], compress: bool = False
+) -> tuple[int, int]:
+    """
+    publish images table into csv_file and image_top_10.csv.
+
+    :return: checksum of the saved table, to pass as loaded on the next save
+    """
+    top_10 = csv_file.parent / "image_top_10.csv"
+    saved = table_checksum(conn, "images")
+    with publish(compress) as pub:
+        # skip sorting and writing unless a row changed or a file is missing
+        if saved != loaded or not (csv_file.exists() and top_10.exists()):
+            pub.copy_ranked(conn, "images", "Download DESC, Name ASC", csv_file, top_10)
+    return saved
+
+
 @contextmanager
-def _popular_image(csv_file: Path):
+def popular_image(csv_file: Path, compress: bool = False):
     """
     load and save new image download into csv_file.
     image_top_10.csv is also updated at the save folder.
+    The files are published together only if the processing succeeds.
+    With compress, they get pre-compressed .gz/.br siblings.
     """
-    top_10 = csv_file.parent / "image_top_10.csv"
     conn = duckdb.connect(":memory:")
     try:
-        conn.execute("""DROP TABLE IF EXISTS images;""")
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS images (
-            Name VARCHAR PRIMARY KEY,
-            Download INTEGER
-        );"""
-        )
-        if not csv_file.exists():  # create if not exist
-            conn.execute(
-                f"""
-                COPY (SELECT * FROM images LIMIT 0)
-                TO '{csv_file}'
-                WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-            )
-        if csv_file.stat().st_size > 13:  # expect header "Name,Download"
-            conn.execute(
-                f"""
-                COPY images
-                FROM '{csv_file}'
-                WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
-            )
+        loaded = load_image(conn, csv_file)
         yield conn
+        save_image(conn, csv_file, loaded, compress)
     finally:
-        conn.execute(
-            f"""
-            COPY (SELECT * FROM images ORDER BY Download DESC, Name ASC)
-            TO '{csv_file}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-        )
-        conn.execute(
-            f"""
-            COPY (SELECT * FROM images ORDER BY Download DESC, Name ASC LIMIT 10)
-            TO '{top_10}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-        )
         conn.close()
 
 
-_IMAGE_NAME_RE = re.compile(r"elxr-.+\.(img\.zst|tar\.gz|img|iso|qcow2)$", re.ASCII)
+_IMAGE_PREFIX = "elxr-"
+_IMAGE_SUFFIXES = (".img.zst", ".tar.gz", ".img", ".iso", ".qcow2")
 
 
 @cache
 def _parse_image_name(path: str) -> str | None:
-    """Extract image name from uri path"""
-    #
-    assert path
-    file_name = Path(path).name
-    if _IMAGE_NAME_RE.search(file_name):
-        # If there's a match, remove the extension and return the result
-        return file_name
-        # return _IMAGE_NAME_RE.sub("", file_name)
+    """Extract image name from uri path.
 
+    The file name must end with one of _IMAGE_SUFFIXES and contain "elxr-" followed by at least one character
+    before the suffix. Plain string checks are used instead of Path construction and a regular expression.
+    """
+    assert path
+    file_name = path.rpartition("/")[2]
+    for suffix in _IMAGE_SUFFIXES:
+        if file_name.endswith(suffix):
+            start = file_name.find(_IMAGE_PREFIX)
+            if 0 <= start and start + len(_IMAGE_PREFIX) < len(file_name) - len(suffix):
+                return file_name
+            break
     # If no match is found, return None
     return None
 
 
-def _update_image_download(conn: duckdb.DuckDBPyConnection, log_entry: CloudFrontLogEntry) -> None:
+def _match_image_download(log_entry: CloudFrontLogEntry) -> str | None:
+    """
+    Check whether the log entry sent bytes of an image, and parse the image name.
+
+    Whole (200) and partial (206) responses are accepted whatever their edge result, as an interrupted transfer
+    still sent its bytes; how much of the image a client fetched is decided by the DownloadTracker.
+    Status, size and uri are evaluated in one short-circuit expression; the name is only parsed for accepted
+    entries.
+    """
     # if log_entry.sc_content_type is None or not log_entry.sc_content_type.startswith("application/"):
     #     # application/x-iso9660-image (iso)
     #     # application/zstd (zst)
@@ -99,43 +130,180 @@ def _update_image_download(conn: duckdb.DuckDBPyConnection, log_entry: CloudFron
     #     # application/gzip (tar.gz)
     #     # binary/octet-stream (qcow2)
     #     return
-    if log_entry.sc_status is None or log_entry.sc_status >= 400:
-        return
-    if log_entry.sc_bytes is None or log_entry.sc_bytes < 500000:
-        # set the minimum image size 500KB
-        return
-    if log_entry.x_edge_result_type is None or log_entry.x_edge_result_type in (
-        "LimitExceeded",
-        "CapacityExceeded",
-        "Error",
-    ):
+    uri = log_entry.cs_uri_stem
+    if log_entry.sc_status in (200, 206) and log_entry.sc_bytes and uri:
+        return _parse_image_name(uri)
+    return None
+
+
+def image_line_filter() -> LineFilter:
+    """the raw line checks of _match_image_download: a 200 or 206 status and an image prefix in the uri."""
+    return LineFilter(statuses=(200, 206), uri_contains=(_IMAGE_PREFIX,))
+
+
+def _sent_range(log_entry: CloudFrontLogEntry) -> tuple[int, int, int | None] | None:
+    """
+    the [start, end) bytes of the image sent by an accepted entry, and the image size if it was a whole response.
+
+    sc_bytes, which also counts the response headers, caps the range of an interrupted transfer.
+    """
+    sent = log_entry.sc_bytes or 0
+    if log_entry.sc_status == 206:
+        if log_entry.sc_range_start is None or log_entry.sc_range_end is None:
+            return None
+        start = log_entry.sc_range_start
+        return start, min(log_entry.sc_range_end + 1, start + sent), None
+    size = log_entry.sc_content_len
+    return 0, min(size, sent) if size else sent, size
+
+
+def _count_downloads(downloads: Counter[str], completed: list[Download], dedup: DedupWindow | None) -> None:
+    """count completed downloads, unless dedup saw the same client download the image within its window."""
+    for name, client, timestamp in completed:
+        if dedup is not None and dedup.seen((client, name), timestamp):
+            continue
+        downloads[name] += 1
+
+
+def _update_image_download(
+    downloads: Counter[str],
+    log_entry: CloudFrontLogEntry,
+    tracker: DownloadTracker,
+    dedup: DedupWindow | None = None,
+) -> None:
+    """add the bytes sent by log_entry to tracker, and count the downloads it completed."""
+    name = _match_image_download(log_entry)
+    if not name:
         return
-    if log_entry.cs_uri_stem is None:
+    sent = _sent_range(log_entry)
+    if sent is None:
         return
-    name = _parse_image_name(log_entry.cs_uri_stem)
-    if not name:
+    start, end, size = sent
+    client = (log_entry.c_ip, log_entry.cs_user_agent)
+    _count_downloads(downloads, tracker.add(name, client, start, end, log_entry.timestamp, size), dedup)
+
+
+def merge_image_download(conn: duckdb.DuckDBPyConnection, downloads: Counter[str]) -> None:
+    """merge collected download count into images table"""
+    if not downloads:
         return
-    conn.execute(
-        f"""
-        INSERT INTO images (Name, Download) values ('{name}', 1)
-        ON CONFLICT (Name) DO UPDATE SET Download = images.Download + 1; """
+    conn.executemany(
+        """
+        INSERT INTO images (Name, Download) values (?, ?)
+        ON CONFLICT (Name) DO UPDATE SET Download = images.Download + EXCLUDED.Download;""",
+        list(downloads.items()),
     )
 
 
+class ImageAggregator(Aggregator):
+    """
+    Count completed image downloads in memory.
+
+    The byte ranges of downloads in progress stay in the aggregator until they complete or go stale; call flush
+    at the end of the logs to judge them on the bytes fetched so far. merge only adds the counted downloads.
+    The snapshot table is image_stats, with the columns of the csv file of the same name.
+    """
+
+    def __init__(self, completion: float = DEFAULT_COMPLETION, dedup_window: float = DEDUP_WINDOW) -> None:
+        self.tracker = DownloadTracker(completion)
+        self.dedup = DedupWindow(dedup_window)
+        self.downloads: Counter[str] = Counter()
+
+    def feed(self, entry: CloudFrontLogEntry) -> None:
+        _update_image_download(self.downloads, entry, self.tracker, self.dedup)
+
+    def flush(self) -> ImageAggregator:
+        """count the downloads in progress that fetched enough, drop the others, and return the aggregator."""
+        _count_downloads(self.downloads, self.tracker.flush(), self.dedup)
+        return self
+
+    def copy(self) -> ImageAggregator:
+        """a copy of the aggregator that does not change with it, to restore after a failed ingest."""
+        other = ImageAggregator(self.tracker.completion, self.dedup.window)
+        other.tracker = self.tracker.copy()
+        other.dedup = self.dedup.copy()
+        other.downloads = self.downloads.copy()
+        return other
+
+    def restore(self, saved: ImageAggregator) -> None:
+        """go back to the downloads in progress and the counts of saved, a copy taken earlier."""
+        self.tracker, self.dedup, self.downloads = saved.tracker, saved.dedup, saved.downloads
+
+    def merge(self, other: ImageAggregator) -> ImageAggregator:
+        self.downloads.update(other.downloads)
+        return self
+
+    def snapshot(self) -> dict[str, Rows]:
+        ranked = sorted(self.downloads.items(), key=lambda i: (-i[1], i[0]))
+        return {"image_stats": [{"Name": name, "Download": n} for name, n in ranked]}
+
+
+def ingest_image(
+    conn: duckdb.DuckDBPyConnection,
+    entries: Iterable[CloudFrontLogEntry],
+    aggregator: ImageAggregator,
+    flush: bool = False,
+) -> None:
+    """
+    count image downloads of log entries with aggregator, and move its counts into images in one transaction.
+
+    Successive calls with the same aggregator follow downloads across them, so a download still in progress is
+    counted by a later call. With flush, the downloads in progress at the end are judged on the bytes fetched so
+    far. If the call fails, aggregator is restored to what it was before, so a retry does not count twice.
+    """
+    saved = aggregator.copy()
+    try:
+        aggregator.feed_batch(entries)
+        if flush:
+            aggregator.flush()
+        conn.execute("BEGIN TRANSACTION;")
+        merge_image_download(conn, aggregator.downloads)
+        conn.execute("COMMIT;")
+    except Exception:
+        aggregator.restore(saved)
+        raise
+    finally:
+        aggregator.downloads.clear()  # counted into images, or dropped with the failed transaction
+
+
 @timing
-def parse_downloads_elxr_dev_logs(log_folder: Path, csv_file: Path = DOWNLOADS_ELXR_DEV_CSV) -> None:
+def parse_downloads_elxr_dev_logs(
+    log_folder: Path | str,
+    csv_file: Path = DOWNLOADS_ELXR_DEV_CSV,
+    compress: bool = False,
+    dedup_window: float = DEDUP_WINDOW,
+    completion: float = DEFAULT_COMPLETION,
+    sample_rate: float = 1.0,
+) -> None:
     """parse logs from downloads.elxr.dev site and extract image download count
 
-    :param log_folder: the parent folder path of log files (compressed by gzip)
-    :type log_folder: Path
+    :param log_folder: the parent folder path of log files (compressed by gzip), or an s3://bucket/prefix URL
+    :type log_folder: Path | str
     :param csv_file: the path of CSV file, default to DOWNLOADS_ELXR_DEV_CSV
     :type csv_file: Path
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param dedup_window: seconds within which requests of the same client, image and user agent count once,
+                         default to DEDUP_WINDOW, 0 to count every request
+    :type dedup_window: float
+    :param completion: fraction of an image a client must fetch to count a download, default to DEFAULT_COMPLETION
+    :type completion: float
+    :param sample_rate: the share of clients counted and scaled up to estimates, written with their confidence
+                        intervals into the estimated folder next to csv_file, default to 1.0 to count all exactly
+    :type sample_rate: float
     :return: None
     :raises Exception: if log_folder does not exist, not a directory.
                        if csv_file is not a file"""
-    with _popular_image(csv_file) as conn:
-        conn.execute("BEGIN TRANSACTION;")
-        for child in log_folder.glob("*.gz"):
-            for entry in parse_cloudfront_log(child):
-                _update_image_download(conn, entry)
-        conn.execute("COMMIT;")
+    line_filter = image_line_filter()
+    if sample_rate < 1:
+        csv_file = estimated_csv(csv_file)
+        line_filter = line_filter.sampled(sample_rate, SAMPLE_FIELDS["image_download"])
+    # with sampling, scale_counts stages estimate.csv into this publish, to be published with the csv files
+    with publish(), popular_image(csv_file, compress) as conn:
+        if sample_rate < 1:
+            clear_counts(conn, _IMAGE_COUNTS)
+        entries = read_logs(log_folder, line_filter=line_filter)
+        ingest_image(conn, entries, ImageAggregator(completion, dedup_window), flush=True)
+        if sample_rate < 1:
+            scale_counts(conn, _IMAGE_COUNTS, sample_rate, csv_file)
+    line_filter.report()
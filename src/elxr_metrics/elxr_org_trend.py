@@ -8,105 +8,504 @@
 
 from __future__ import annotations
 
+import datetime
+import ipaddress
+import json
 import logging
+import zlib
+from collections import Counter
 from contextlib import contextmanager
-from functools import cache
+from functools import cache, lru_cache
 from pathlib import Path
-from typing import Any, Generator
+from typing import Any, Generator, Iterable
 
 import duckdb
 import maxminddb
 from duckdb import DuckDBPyConnection
 
-from elxr_metrics.cloudfront_log import CloudFrontLogEntry, parse_cloudfront_log, webpage_timebucket
+from elxr_metrics.aggregate import Aggregator, Rows
+from elxr_metrics.bot import DEFAULT_CLASSIFIER, BotClassifier
+from elxr_metrics.cloudfront_log import (
+    BUCKET_WIDTHS,
+    DEFAULT_BUCKET_WIDTH,
+    CloudFrontLogEntry,
+    LineFilter,
+    time_bucket,
+)
 from elxr_metrics.elapsed import timing
+from elxr_metrics.export import publish
+from elxr_metrics.log_source import read_logs
+from elxr_metrics.sample import ESTIMATE_DIR, SAMPLE_FIELDS, Counts, clear_counts, estimated_csv, scale_counts
 
 ELXR_ORG_VIEW_CSV = Path("public/elxr_org_view.csv")
+_TREND_COUNTS: Counts = {
+    "trend": (("TimeBucket",), ("ViewCount", "UniqueUser")),
+    "bot_trend": (("TimeBucket",), ("ViewCount", "UniqueUser")),
+    "country": (("Code",), ("Count",)),
+    "country_trend": (("TimeBucket", "Code"), ("Count",)),
+    "city": (("Code", "Region", "City"), ("Count",)),
+}
 
 logger = logging.getLogger(__name__)
 
+LATENESS = 3600  # seconds after its end a time bucket still takes views, before it is flushed
+_IP_CACHE_SIZE = 1 << 16
 
-@contextmanager
-def _trend(csv_file: Path) -> Generator[DuckDBPyConnection, Any, None]:
-    country_file = csv_file.parent / "country.csv"
-    conn = duckdb.connect(":memory:")
-    try:
-        conn.execute("""DROP TABLE IF EXISTS trend;""")
-        conn.execute("""DROP TABLE IF EXISTS temp_data;""")
+
+def load_trend(conn: DuckDBPyConnection, csv_file: Path, bucket_width: int = DEFAULT_BUCKET_WIDTH) -> None:
+    """
+    create trend and geo tables, and load the cumulative ones from csv_file, elxr_org_bot_view.csv and
+    country_trend.csv.
+
+    :raises ValueError: if the loaded time buckets are of another width than bucket_width
+    """
+    bot_file = csv_file.parent / "elxr_org_bot_view.csv"
+    country_trend_file = csv_file.parent / "country_trend.csv"
+    coordinates_file = csv_file.parent / "countries.csv"
+    if not coordinates_file.exists() and csv_file.parent.name == ESTIMATE_DIR:  # those of the exact counts
+        coordinates_file = csv_file.parent.parent / "countries.csv"
+    conn.execute("""DROP TABLE IF EXISTS trend;""")
+    conn.execute("""DROP TABLE IF EXISTS bot_trend;""")
+    for table in ("trend", "bot_trend"):
         conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS trend (
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
             TimeBucket TIMESTAMP PRIMARY KEY,
             ViewCount INTEGER,
             UniqueUser INTEGER
         );"""
         )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS country (
-            Code VARCHAR PRIMARY KEY,
-            Name VARCHAR,
-            Count INTEGER
-        );"""
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS temp_data (
-            TimeBucket TIMESTAMP,
-            ClientIP VARCHAR
-        );"""
-        )
-        if not csv_file.exists():
-            conn.execute(
-                f"""
-                COPY (SELECT * FROM trend LIMIT 0)
-                TO '{csv_file}'
-                WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-            )
-        if csv_file.stat().st_size > 31:  # expect header "TimeBucket,ViewCount,UniqueUser"
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS country (
+        Code VARCHAR PRIMARY KEY,
+        Name VARCHAR,
+        Count INTEGER
+    );"""
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS country_trend (
+        TimeBucket TIMESTAMP,
+        Code VARCHAR,
+        Name VARCHAR,
+        Count INTEGER,
+        PRIMARY KEY (TimeBucket, Code)
+    );"""
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS city (
+        Code VARCHAR,
+        Region VARCHAR,
+        City VARCHAR,
+        Latitude DOUBLE,
+        Longitude DOUBLE,
+        Count INTEGER,
+        PRIMARY KEY (Code, Region, City)
+    );"""
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS coordinates (
+        Code VARCHAR PRIMARY KEY,
+        Latitude DOUBLE,
+        Longitude DOUBLE
+    );"""
+    )
+    for table, file in (("trend", csv_file), ("bot_trend", bot_file)):
+        if file.exists() and file.stat().st_size > 31:  # expect header "TimeBucket,ViewCount,UniqueUser"
             conn.execute(
                 f"""
-                COPY trend
-                FROM '{csv_file}'
+                COPY {table}
+                FROM '{file}'
                 WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
             )
-        yield conn
-    finally:
+    if country_trend_file.exists() and country_trend_file.stat().st_size > 30:  # "TimeBucket,Code,Name,Count"
         conn.execute(
             f"""
-            COPY (SELECT * FROM trend WHERE TimeBucket + INTERVAL 732 DAY > CURRENT_TIMESTAMP ORDER BY TimeBucket ASC)
-            TO '{csv_file}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
+            COPY country_trend
+            FROM '{country_trend_file}'
+            WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
         )
+    if coordinates_file.exists():  # country,latitude,longitude,name
         conn.execute(
             f"""
-            COPY (SELECT * FROM country ORDER BY Count DESC, Code ASC)
-            TO '{country_file}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
+            INSERT INTO coordinates
+            SELECT country, latitude, longitude FROM read_csv('{coordinates_file}', header = true);"""
         )
-        conn.close()
+    _check_bucket_width(conn, csv_file, bucket_width)
+
+
+def _resolution(width: int) -> str:
+    """the name of a bucket width of BUCKET_WIDTHS, e.g. "6h"."""
+    return next(name for name, w in BUCKET_WIDTHS.items() if w == width)
+
+
+def _meta_file(csv_file: Path) -> Path:
+    """the file next to csv_file recording the width of its time buckets, e.g. elxr_org_view.meta.json."""
+    return csv_file.with_suffix(".meta.json")
 
 
-def _merge_elxr_org(conn: DuckDBPyConnection) -> None:
-    """merge collected temp data into trend table"""
+def _loaded_width(conn: DuckDBPyConnection, csv_file: Path) -> int | None:
+    """
+    the width of the loaded time buckets: the one recorded next to csv_file, or for files written without it, the
+    widest of BUCKET_WIDTHS all loaded buckets are aligned to. None if no bucket is loaded.
+    """
+    meta_file = _meta_file(csv_file)
+    if meta_file.exists():
+        return json.loads(meta_file.read_text(encoding="utf-8"))["bucket_width"]
+    epochs = [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT DISTINCT CAST(epoch(TimeBucket) AS BIGINT) FROM (
+                SELECT TimeBucket FROM trend
+                UNION ALL SELECT TimeBucket FROM bot_trend
+                UNION ALL SELECT TimeBucket FROM country_trend
+            );"""
+        ).fetchall()
+    ]
+    if not epochs:
+        return None
+    return max((w for w in BUCKET_WIDTHS.values() if all(e % w == 0 for e in epochs)), default=0)
+
+
+def _check_bucket_width(conn: DuckDBPyConnection, csv_file: Path, bucket_width: int) -> None:
+    """reject loaded time buckets of another width, so buckets of two widths never mix in one file."""
+    width = _loaded_width(conn, csv_file)
+    if width is not None and width != bucket_width:
+        raise ValueError(
+            f"{csv_file} holds time buckets of another width than {_resolution(bucket_width)}, "
+            "use a new csv file or rebuild it from the logs"
+        )
+
+
+def save_trend(
+    conn: DuckDBPyConnection,
+    csv_file: Path,
+    compress: bool = False,
+    city_db: Path | None = None,
+    trend: TrendAggregator | None = None,
+    bucket_width: int = DEFAULT_BUCKET_WIDTH,
+) -> None:
+    """
+    publish the trend into csv_file and dashboard shards of the resolution of bucket_width, or of the width of
+    trend if given, the bot trend into elxr_org_bot_view.csv, and the geo tables into their csv files.
+
+    The open time buckets of trend, still counting users for later ingests, are published as well, but merged in
+    a transaction rolled back after publishing, so they are merged into the tables once, when they close.
+    """
+    if trend is not None and trend.views:
+        conn.execute("BEGIN TRANSACTION;")
+        try:
+            merge_elxr_org(conn, trend)
+            save_trend(conn, csv_file, compress, city_db, bucket_width=trend.bucket_width)
+        finally:
+            conn.execute("ROLLBACK;")
+        return
+    bot_file = csv_file.parent / "elxr_org_bot_view.csv"
+    country_file = csv_file.parent / "country.csv"
+    country_trend_file = csv_file.parent / "country_trend.csv"
+    city_file = csv_file.parent / "city.csv"
+    shard_dir = csv_file.with_suffix("")  # e.g. public/elxr_org_view/ for the dashboard JSON shards
     conn.execute(
         """
-        INSERT INTO trend (TimeBucket, ViewCount, UniqueUser)
-        SELECT
-            TimeBucket,
-            COUNT(*) AS ViewCount,
-            COUNT(DISTINCT ClientIP) AS UniqueUser
-        FROM temp_data
-        GROUP BY TimeBucket
-        ON CONFLICT (TimeBucket)
-        DO UPDATE SET
-            ViewCount = ViewCount + EXCLUDED.ViewCount,
-            UniqueUser = UniqueUser + EXCLUDED.UniqueUser;
+        CREATE OR REPLACE TEMP VIEW published_trend AS
+        SELECT * FROM trend WHERE TimeBucket + INTERVAL 732 DAY > CURRENT_TIMESTAMP;"""
+    )
+    with publish(compress) as pub:
+        pub.copy(conn, "SELECT * FROM published_trend ORDER BY TimeBucket ASC", csv_file)
+        pub.copy(
+            conn,
+            """
+            SELECT * FROM bot_trend WHERE TimeBucket + INTERVAL 732 DAY > CURRENT_TIMESTAMP
+            ORDER BY TimeBucket ASC""",
+            bot_file,
+        )
+        # Name goes last: the dashboard splits lines on commas and some country names contain one
+        pub.copy(
+            conn,
+            """
+            SELECT country.Code, country.Count, coordinates.Latitude, coordinates.Longitude, country.Name
+            FROM country LEFT JOIN coordinates ON country.Code = coordinates.Code
+            ORDER BY Count DESC, country.Code ASC""",
+            country_file,
+        )
+        pub.copy(
+            conn,
+            """
+            SELECT * FROM country_trend WHERE TimeBucket + INTERVAL 732 DAY > CURRENT_TIMESTAMP
+            ORDER BY TimeBucket ASC, Count DESC, Code ASC""",
+            country_trend_file,
+        )
+        if city_db:
+            pub.copy(conn, "SELECT * FROM city ORDER BY Count DESC, Code ASC, Region ASC, City ASC", city_file)
+        shards = _trend_shards(conn, trend.bucket_width if trend is not None else bucket_width)
+        for name, shard in shards.items():
+            pub.write_text(shard_dir / f"{name}.json", json.dumps(shard, separators=(",", ":")))
+        index = {
+            name: {k: shard[k] for k in ("start", "end", "resolution", "rows", "min", "max")}
+            for name, shard in shards.items()
+        }
+        pub.write_text(shard_dir / "index.json", json.dumps(index, separators=(",", ":")))
+        for shard_file in shard_dir.glob("*.json"):  # e.g. a year shard out of the published window
+            if shard_file.stem not in shards and shard_file.name != "index.json":
+                pub.remove(shard_file)
+        pub.write_text(_meta_file(csv_file), json.dumps({"bucket_width": bucket_width}))
+
+
+@contextmanager
+def view_trend(
+    csv_file: Path, compress: bool = False, city_db: Path | None = None, bucket_width: int = DEFAULT_BUCKET_WIDTH
+) -> Generator[DuckDBPyConnection, Any, None]:
+    """
+    load and save the web page view trend of csv_file.
+    The files are published together only if the processing succeeds.
+    """
+    conn = duckdb.connect(":memory:")
+    try:
+        load_trend(conn, csv_file, bucket_width)
+        yield conn
+        save_trend(conn, csv_file, compress, city_db, bucket_width=bucket_width)
+    finally:
+        conn.close()
+
+
+_TREND_RANGES = {"7d": 7, "30d": 30, "90d": 90}
+
+
+def _trend_shard(conn: DuckDBPyConnection, query: str, resolution: str, params: list | None = None) -> dict[str, Any]:
+    """
+    build a column oriented dashboard shard from query rows of (TimeBucket, ViewCount, UniqueUser).
+
+    The shard carries its start/end bucket, row count and min/max of each series, so the dashboard can pick
+    a shard and scale its axes without parsing the data.
+    """
+    rows = conn.execute(query, params).fetchall()
+    buckets = [row[0].strftime(r"%Y-%m-%d %H:%M:%S") for row in rows]
+    views = [int(row[1]) for row in rows]
+    users = [int(row[2]) for row in rows]
+    return {
+        "start": buckets[0] if buckets else None,
+        "end": buckets[-1] if buckets else None,
+        "resolution": resolution,
+        "rows": len(rows),
+        "min": {"ViewCount": min(views, default=0), "UniqueUser": min(users, default=0)},
+        "max": {"ViewCount": max(views, default=0), "UniqueUser": max(users, default=0)},
+        "TimeBucket": buckets,
+        "ViewCount": views,
+        "UniqueUser": users,
+    }
+
+
+def _trend_shards(conn: DuckDBPyConnection, bucket_width: int = DEFAULT_BUCKET_WIDTH) -> dict[str, dict[str, Any]]:
+    """
+    pre-aggregate the published trend of bucket_width wide time buckets into dashboard shards.
+
+    7d, 30d and 90d hold the last days before the latest bucket, one shard per calendar year holds that year,
+    all of them at full resolution. "all" is the whole history downsampled to daily sums; note the daily
+    UniqueUser is the sum of the bucket values, as distinct users cannot be recounted from the CSV.
+    """
+    columns = "TimeBucket, ViewCount, UniqueUser"
+    resolution = _resolution(bucket_width)
+    latest = conn.execute("SELECT MAX(TimeBucket) FROM published_trend").fetchone()[0]  # type: ignore[index]
+    shards: dict[str, dict[str, Any]] = {}
+    for name, days in _TREND_RANGES.items():
+        start = (latest or datetime.datetime.min) - datetime.timedelta(days=days)
+        shards[name] = _trend_shard(
+            conn,
+            f"SELECT {columns} FROM published_trend WHERE TimeBucket > ? ORDER BY TimeBucket",
+            resolution,
+            [start],
+        )
+    years = conn.execute("SELECT DISTINCT year(TimeBucket) AS y FROM published_trend ORDER BY y").fetchall()
+    for (year,) in years:
+        shards[str(year)] = _trend_shard(
+            conn,
+            f"SELECT {columns} FROM published_trend WHERE year(TimeBucket) = ? ORDER BY TimeBucket",
+            resolution,
+            [year],
+        )
+    shards["all"] = _trend_shard(
+        conn,
         """
+        SELECT date_trunc('day', TimeBucket) AS Day, SUM(ViewCount), SUM(UniqueUser)
+        FROM published_trend GROUP BY Day ORDER BY Day""",
+        "1d",
     )
+    return shards
+
+
+def view_bucket(log_entry: CloudFrontLogEntry, width: int = DEFAULT_BUCKET_WIDTH) -> datetime.datetime | None:
+    """the time bucket of a web page view, or None if the entry is not a web page view."""
+    if log_entry.sc_content_type != "text/html":  # only count web page reviews
+        return None
+    return time_bucket(log_entry.epoch, width)
+
+
+def trend_line_filter() -> LineFilter:
+    """the raw line check of view_bucket: a web page content type."""
+    return LineFilter(any_of=("text/html",))
+
+
+@lru_cache(maxsize=_IP_CACHE_SIZE)
+def _pack_ip(ip: str | None) -> int:
+    """
+    an IP address as an integer, to keep sets of users compact.
+
+    IPv6 addresses are offset above all IPv4 addresses; anything else, e.g. a missing IP, maps to a negative number
+    from its CRC-32, which is the same in every process, so partials of different runs agree on it.
+    """
+    try:
+        address = ipaddress.ip_address(ip)  # type: ignore[arg-type]
+    except ValueError:
+        return -1 - zlib.crc32(str(ip).encode())
+    return int(address) if address.version == 4 else int(address) | 1 << 128
+
+
+class TrendAggregator(Aggregator):
+    """
+    Count web page views and unique users per time bucket in memory, in total and by bots.
 
+    Unique users are the distinct client IPs of the views fed to the aggregator, kept as sets of packed integers;
+    merging two aggregators unites their IPs, so a user seen by both counts once. The snapshot tables are
+    elxr_org_view and elxr_org_bot_view, with the columns of the csv files of the same name. Views are bucketed by
+    bucket_width seconds, 6 hours by default.
 
-_COUNTRY_READER = maxminddb.open_database(r"GeoLite2-Country/GeoLite2-Country.mmdb")
+    A bucket is closed once a view lateness seconds past its end is seen; pop_closed hands the closed buckets over,
+    so memory is bounded by the open buckets and their users, not by the number of views. A view of a bucket that
+    was already handed over is dropped and counted in late, as its users could no longer be told apart from those
+    already counted.
+    """
+
+    def __init__(
+        self,
+        classifier: BotClassifier = DEFAULT_CLASSIFIER,
+        bucket_width: int = DEFAULT_BUCKET_WIDTH,
+        lateness: int = LATENESS,
+    ) -> None:
+        self.classifier = classifier
+        self.bucket_width = bucket_width
+        self.lateness = lateness
+        self.watermark: int | None = None  # the epoch of the latest view seen
+        self.flushed: datetime.datetime | None = None  # the latest time bucket handed over by pop_closed
+        self.late = 0  # views dropped as their time bucket was handed over
+        self.views: Counter[datetime.datetime] = Counter()
+        self.users: dict[datetime.datetime, set[int]] = {}
+        self.bot_views: Counter[datetime.datetime] = Counter()
+        self.bot_users: dict[datetime.datetime, set[int]] = {}
+
+    def add(self, bucket: datetime.datetime, log_entry: CloudFrontLogEntry) -> bool:
+        """count one page view in the time bucket, and return whether it was counted, not late."""
+        if self.flushed is not None and bucket <= self.flushed:
+            self.late += 1
+            return False
+        ip = _pack_ip(log_entry.c_ip)
+        epoch = log_entry.epoch
+        if self.watermark is None or epoch > self.watermark:
+            self.watermark = epoch
+        self.views[bucket] += 1
+        self.users.setdefault(bucket, set()).add(ip)
+        if self.classifier.is_bot(log_entry.cs_user_agent, log_entry.c_ip):
+            self.bot_views[bucket] += 1
+            self.bot_users.setdefault(bucket, set()).add(ip)
+        return True
+
+    def feed(self, entry: CloudFrontLogEntry) -> None:
+        t = view_bucket(entry, self.bucket_width)
+        if t is not None:
+            self.add(t, entry)
+
+    def pop_closed(self, all_buckets: bool = False) -> TrendAggregator:
+        """
+        remove the closed time buckets.
+
+        :param all_buckets: remove the open buckets too, e.g. at the end of the logs, default to False
+        :type all_buckets: bool
+        :return: a new aggregator of the closed buckets
+        :rtype: TrendAggregator
+        """
+        closed = TrendAggregator(self.classifier, self.bucket_width, self.lateness)
+        if self.watermark is None:
+            return closed
+        horizon = time_bucket(self.watermark - self.lateness - self.bucket_width, self.bucket_width)
+        for t in [t for t in self.views if all_buckets or t <= horizon]:
+            closed.views[t] = self.views.pop(t)
+            closed.users[t] = self.users.pop(t)
+            if t in self.bot_views:
+                closed.bot_views[t] = self.bot_views.pop(t)
+                closed.bot_users[t] = self.bot_users.pop(t)
+            if self.flushed is None or t > self.flushed:
+                self.flushed = t
+        return closed
+
+    def copy(self) -> TrendAggregator:
+        """a copy of the aggregator that does not change with it, to restore after a failed ingest."""
+        other = TrendAggregator(self.classifier, self.bucket_width, self.lateness)
+        other.watermark, other.flushed, other.late = self.watermark, self.flushed, self.late
+        other.views = self.views.copy()
+        other.users = {t: set(ips) for t, ips in self.users.items()}
+        other.bot_views = self.bot_views.copy()
+        other.bot_users = {t: set(ips) for t, ips in self.bot_users.items()}
+        return other
+
+    def restore(self, saved: TrendAggregator) -> None:
+        """go back to the counts of saved, a copy taken earlier."""
+        self.watermark, self.flushed, self.late = saved.watermark, saved.flushed, saved.late
+        self.views, self.users = saved.views, saved.users
+        self.bot_views, self.bot_users = saved.bot_views, saved.bot_users
+
+    def merge(self, other: TrendAggregator) -> TrendAggregator:
+        if other.watermark is not None and (self.watermark is None or other.watermark > self.watermark):
+            self.watermark = other.watermark
+        if other.flushed is not None and (self.flushed is None or other.flushed > self.flushed):
+            self.flushed = other.flushed
+        self.late += other.late
+        self.views.update(other.views)
+        self.bot_views.update(other.bot_views)
+        for mine, theirs in ((self.users, other.users), (self.bot_users, other.bot_users)):
+            for t, ips in theirs.items():
+                mine.setdefault(t, set()).update(ips)
+        return self
+
+    def rows(self, bots: bool = False) -> list[tuple[datetime.datetime, int, int]]:
+        """(TimeBucket, ViewCount, UniqueUser) of all views, or of the views by bots, sorted by time bucket."""
+        views, users = (self.bot_views, self.bot_users) if bots else (self.views, self.users)
+        return [(t, views[t], len(users[t])) for t in sorted(views)]
+
+    def snapshot(self) -> dict[str, Rows]:
+        columns = ("TimeBucket", "ViewCount", "UniqueUser")
+        return {
+            "elxr_org_view": [dict(zip(columns, row)) for row in self.rows()],
+            "elxr_org_bot_view": [dict(zip(columns, row)) for row in self.rows(bots=True)],
+        }
+
+
+def merge_elxr_org(conn: DuckDBPyConnection, trend: TrendAggregator) -> None:
+    """merge collected view counts into trend table (all views) and bot_trend table (views by bots)"""
+    for table, bots in (("trend", False), ("bot_trend", True)):
+        rows = trend.rows(bots)
+        if not rows:
+            continue
+        conn.executemany(
+            f"""
+            INSERT INTO {table} (TimeBucket, ViewCount, UniqueUser) values (?, ?, ?)
+            ON CONFLICT (TimeBucket)
+            DO UPDATE SET
+                ViewCount = ViewCount + EXCLUDED.ViewCount,
+                UniqueUser = UniqueUser + EXCLUDED.UniqueUser;""",
+            rows,
+        )
+
+
+GEOLITE2_COUNTRY_MMDB = Path("GeoLite2-Country/GeoLite2-Country.mmdb")
+
+
+@cache
+def _open_mmdb(path: Path) -> maxminddb.Reader:
+    """open a MaxMind database once, on first lookup."""
+    return maxminddb.open_database(path)
 
 
 @cache
@@ -122,7 +521,7 @@ def _country_lookup(ip: str) -> tuple[str, str]:
     country = "N/A"
     code = "N/A"
     try:
-        r = _COUNTRY_READER.get(ip)
+        r = _open_mmdb(GEOLITE2_COUNTRY_MMDB).get(ip)
         c = r.get("country") or r.get("registered_country")
         code = c["iso_code"]
         country = c["names"]["en"]
@@ -133,40 +532,199 @@ def _country_lookup(ip: str) -> tuple[str, str]:
     return code, country
 
 
-def _process_log_entry(conn: DuckDBPyConnection, log_entry: CloudFrontLogEntry) -> None:
-    """process the log entry and insert into temp table"""
-    if log_entry.sc_content_type != "text/html":  # only count web page reviews
+@cache
+def _city_lookup(city_db: Path, ip: str) -> tuple[str, str, str, float | None, float | None]:
+    """
+    map IP address to country iso-code, region, city and coordinates with a City database.
+
+    :return: country iso-code, region and city name ("N/A" if not found), latitude and longitude (None if not found)
+    :rtype: tuple[str, str, str, float | None, float | None]
+    """
+    try:
+        r = _open_mmdb(city_db).get(ip) or {}
+    except Exception:  # pylint: disable=broad-except
+        r = {}
+    c = r.get("country") or r.get("registered_country") or {}
+    subdivisions = r.get("subdivisions") or [{}]
+    location = r.get("location") or {}
+    return (
+        c.get("iso_code", "N/A"),
+        subdivisions[0].get("names", {}).get("en", "N/A"),
+        r.get("city", {}).get("names", {}).get("en", "N/A"),
+        location.get("latitude"),
+        location.get("longitude"),
+    )
+
+
+class CountryAggregator(Aggregator):
+    """
+    Count web page views by country, by country per time bucket and, with a City database, by city in memory.
+
+    IP addresses are resolved through the cached lookups and counted in dictionaries, so geo dimensions cost no
+    per-view database upsert; merge_geo writes the counts once. The snapshot tables are country, country_trend
+    and, with a City database, city, with the count columns of the csv files of the same name.
+    """
+
+    def __init__(self, city_db: Path | None = None, bucket_width: int = DEFAULT_BUCKET_WIDTH) -> None:
+        self.city_db = city_db
+        self.bucket_width = bucket_width
+        self.country: Counter[tuple[str, str]] = Counter()
+        self.country_trend: Counter[tuple[datetime.datetime, str, str]] = Counter()
+        self.city: Counter[tuple[str, str, str, float | None, float | None]] = Counter()
+
+    def add(self, bucket: datetime.datetime, ip: str) -> None:
+        """count one page view from ip in the time bucket."""
+        code, name = _country_lookup(ip)
+        if code == "N/A":  # no country info, skip
+            return
+        self.country[code, name] += 1
+        self.country_trend[bucket, code, name] += 1
+        if self.city_db:
+            self.city[_city_lookup(self.city_db, ip)] += 1
+
+    def feed(self, entry: CloudFrontLogEntry) -> None:
+        t = view_bucket(entry, self.bucket_width)
+        if t is not None:
+            self.add(t, entry.c_ip)
+
+    def merge(self, other: CountryAggregator) -> CountryAggregator:
+        self.country.update(other.country)
+        self.country_trend.update(other.country_trend)
+        self.city.update(other.city)
+        return self
+
+    def snapshot(self) -> dict[str, Rows]:
+        tables = {
+            "country": [
+                {"Code": code, "Name": name, "Count": n}
+                for (code, name), n in sorted(self.country.items(), key=lambda i: (-i[1], i[0]))
+            ],
+            "country_trend": [
+                {"TimeBucket": t, "Code": code, "Name": name, "Count": n}
+                for (t, code, name), n in sorted(self.country_trend.items(), key=lambda i: (i[0][0], -i[1], i[0][1]))
+            ],
+        }
+        if self.city_db:
+            columns = ("Code", "Region", "City", "Latitude", "Longitude", "Count")
+            tables["city"] = [
+                dict(zip(columns, (*key, n))) for key, n in sorted(self.city.items(), key=lambda i: (-i[1], i[0][:3]))
+            ]
+        return tables
+
+
+def merge_geo(conn: DuckDBPyConnection, geo: CountryAggregator) -> None:
+    """merge collected geo counts into country, country_trend and city tables"""
+    if not geo.country:
         return
-    t = webpage_timebucket(log_entry.timestamp)
-    ts = t.strftime(r"%Y-%m-%d %H:%M:%S")
-    conn.execute(f"INSERT INTO temp_data (TimeBucket, ClientIP) values ('{ts}', '{log_entry.c_ip}');")
-    code, name = _country_lookup(log_entry.c_ip)
-    if code == "N/A":  # no country info, skip
+    conn.executemany(
+        """
+        INSERT INTO country (Code, Name, Count) values (?, ?, ?)
+        ON CONFLICT (Code) DO UPDATE SET Count = country.Count + EXCLUDED.Count;""",
+        [(code, name, count) for (code, name), count in geo.country.items()],
+    )
+    conn.executemany(
+        """
+        INSERT INTO country_trend (TimeBucket, Code, Name, Count) values (?, ?, ?, ?)
+        ON CONFLICT (TimeBucket, Code) DO UPDATE SET Count = country_trend.Count + EXCLUDED.Count;""",
+        [(t, code, name, count) for (t, code, name), count in geo.country_trend.items()],
+    )
+    if not geo.city:
         return
-    conn.execute(
-        f"""
-        INSERT INTO country (Code, Name, Count) values ('{code}', '{name}', 1)
-        ON CONFLICT (Code) DO UPDATE SET Count = country.Count + 1; """
+    conn.executemany(
+        """
+        INSERT INTO city (Code, Region, City, Latitude, Longitude, Count) values (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (Code, Region, City) DO UPDATE SET Count = city.Count + EXCLUDED.Count;""",
+        [(*key, count) for key, count in geo.city.items()],
     )
 
 
+def ingest_trend(
+    conn: DuckDBPyConnection,
+    entries: Iterable[CloudFrontLogEntry],
+    trend: TrendAggregator,
+    city_db: Path | None = None,
+    flush: bool = False,
+) -> None:
+    """
+    count page views of log entries with trend, and merge its closed time buckets and the geo counts into the
+    trend and geo tables in one transaction.
+
+    Whenever a view opens a new time bucket, the buckets it closed are merged into the tables and dropped, so
+    memory holds the open buckets only. Successive calls with the same aggregator keep the users of the open
+    buckets across them, so a user seen by two calls counts once. With flush, the open buckets are merged too,
+    at the end of the logs. Views of a bucket already merged would count its users twice, so they are dropped,
+    in the geo tables too, and their number is logged. If the call fails, trend is restored to what it was before.
+    """
+    geo = CountryAggregator(city_db, trend.bucket_width)
+    saved = trend.copy()
+    try:
+        conn.execute("BEGIN TRANSACTION;")
+        for entry in entries:
+            t = view_bucket(entry, trend.bucket_width)
+            if t is None:
+                continue
+            opened = t not in trend.views
+            if not trend.add(t, entry):
+                continue
+            geo.add(t, entry.c_ip)
+            if opened:
+                merge_elxr_org(conn, trend.pop_closed())
+        merge_elxr_org(conn, trend.pop_closed(all_buckets=flush))
+        merge_geo(conn, geo)
+        conn.execute("COMMIT;")
+    except Exception:
+        trend.restore(saved)
+        raise
+    if trend.late > saved.late:
+        logger.warning(
+            "dropped %d views of time buckets already merged, more than %d seconds late",
+            trend.late - saved.late,
+            trend.lateness,
+        )
+
+
 @timing
-def parse_elxr_org_logs(log_folder: Path, csv_file: Path = ELXR_ORG_VIEW_CSV):
+def parse_elxr_org_logs(
+    log_folder: Path | str,
+    csv_file: Path = ELXR_ORG_VIEW_CSV,
+    compress: bool = False,
+    city_db: Path | None = None,
+    classifier: BotClassifier = DEFAULT_CLASSIFIER,
+    bucket_width: int = DEFAULT_BUCKET_WIDTH,
+    sample_rate: float = 1.0,
+):
     """
     parse cloudfront log files and populate page view count into database.
 
-    :param log_folder: the parent folder path of log files (compressed by gzip)
-    :type log_folder: Path
+    :param log_folder: the parent folder path of log files (compressed by gzip), or an s3://bucket/prefix URL
+    :type log_folder: Path | str
     :param csv_file: the path of CSV file, default to ELXR_ORG_VIEW_CSV
     :type csv_file: Path
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param city_db: a MaxMind City database to also count views per region and city into city.csv, default to None
+    :type city_db: Path | None
+    :param classifier: the classifier of bot views, counted into elxr_org_bot_view.csv, default to user agent only
+    :type classifier: BotClassifier
+    :param bucket_width: seconds per time bucket, one of BUCKET_WIDTHS, default to 6 hours
+    :type bucket_width: int
+    :param sample_rate: the share of clients counted and scaled up to estimates, written with their confidence
+                        intervals into the estimated folder next to csv_file, default to 1.0 to count all exactly
+    :type sample_rate: float
     :return: None
     :raises Exception: if log_folder does not exist, not a directory.
                        if csv_file is not a file
     """
-    with _trend(csv_file) as conn:
-        conn.execute("BEGIN TRANSACTION;")
-        for child in log_folder.glob("*.gz"):
-            for entry in parse_cloudfront_log(child):
-                _process_log_entry(conn, entry)
-        _merge_elxr_org(conn)
-        conn.execute("COMMIT;")
+    line_filter = trend_line_filter()
+    if sample_rate < 1:
+        csv_file = estimated_csv(csv_file)
+        line_filter = line_filter.sampled(sample_rate, SAMPLE_FIELDS["elxr_org_view"])
+    # with sampling, scale_counts stages estimate.csv into this publish, to be published with the csv files
+    with publish(), view_trend(csv_file, compress, city_db, bucket_width) as conn:
+        if sample_rate < 1:
+            clear_counts(conn, _TREND_COUNTS)
+        entries = read_logs(log_folder, line_filter=line_filter)
+        ingest_trend(conn, entries, TrendAggregator(classifier, bucket_width), city_db, flush=True)
+        if sample_rate < 1:
+            scale_counts(conn, _TREND_COUNTS, sample_rate, csv_file)
+    line_filter.report()
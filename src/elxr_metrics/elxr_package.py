@@ -10,158 +10,402 @@ from __future__ import annotations
 
 import logging
 import re
+from collections import Counter
 from contextlib import contextmanager
 from functools import cache
 from pathlib import Path
+from typing import Iterable, NamedTuple
 
 import duckdb
 
-from elxr_metrics.cloudfront_log import CloudFrontLogEntry, parse_cloudfront_log
+from elxr_metrics.aggregate import Rows
+from elxr_metrics.bot import DEFAULT_CLASSIFIER, BotClassifier
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry, LineFilter
+from elxr_metrics.debian_index import load_source_map
 from elxr_metrics.elapsed import timing
+from elxr_metrics.export import publish, table_checksum
+from elxr_metrics.log_source import read_logs
+from elxr_metrics.metric import MetricEngine, MetricSpec
+from elxr_metrics.sample import SAMPLE_FIELDS, Counts, clear_counts, estimated_csv, scale_counts
 
 MIRROR_ELXR_DEV_CSV = Path("public/package_stats.csv")
+_PACKAGE_COUNTS: Counts = {
+    "stats": (("Name",), ("Download",)),
+    "stats_detail": (("Name", "Version", "Arch"), ("Download",)),
+    "stats_bot": (("Name",), ("Download",)),
+}
 
 logger = logging.getLogger(__name__)
 
 
-@contextmanager
-def _popular_package(csv_file: Path):
+def load_package(
+    conn: duckdb.DuckDBPyConnection, csv_file: Path, index_files: list[Path] | None = None
+) -> tuple[tuple[int, int], ...]:
     """
-    load and save new package download into csv_file.
-    package_top_10.csv is also updated at the save folder.
+    create stats and stats_detail tables and load them from csv_file and package_stats_detail.csv.
+
+    :return: checksums of the loaded tables, to tell save_package whether they changed
     """
-    top_10 = csv_file.parent / "package_top_10.csv"
-    conn = duckdb.connect(":memory:")
-    try:
-        conn.execute("""DROP TABLE IF EXISTS stats;""")
+    detail_file = csv_file.parent / "package_stats_detail.csv"
+    bot_file = csv_file.parent / "package_bot_stats.csv"
+    conn.execute("""DROP TABLE IF EXISTS stats;""")
+    conn.execute("""DROP TABLE IF EXISTS stats_detail;""")
+    conn.execute("""DROP TABLE IF EXISTS stats_bot;""")
+    for table in ("stats", "stats_bot"):
         conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS stats (
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
             Name VARCHAR PRIMARY KEY,
             Download INTEGER
         );"""
         )
-        if not csv_file.exists():  # create if not exist
-            conn.execute(
-                f"""
-                COPY (SELECT * FROM stats LIMIT 0)
-                TO '{csv_file}'
-                WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-            )
-        if csv_file.stat().st_size > 13:  # expect header "Name,Download"
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stats_detail (
+        Name VARCHAR,
+        Version VARCHAR,
+        Arch VARCHAR,
+        Download INTEGER,
+        PRIMARY KEY (Name, Version, Arch)
+    );"""
+    )
+    for table, file, header in (
+        ("stats", csv_file, 13),
+        ("stats_detail", detail_file, 26),
+        ("stats_bot", bot_file, 13),
+    ):
+        # expect header "Name,Download" or "Name,Version,Arch,Download"
+        if file.exists() and file.stat().st_size > header:
             conn.execute(
                 f"""
-                COPY stats
-                FROM '{csv_file}'
+                COPY {table}
+                FROM '{file}'
                 WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
             )
+    if index_files:
+        load_source_map(conn, index_files)
+    return table_checksum(conn, "stats"), table_checksum(conn, "stats_detail"), table_checksum(conn, "stats_bot")
+
+
+def save_package(
+    conn: duckdb.DuckDBPyConnection,
+    csv_file: Path,
+    loaded: tuple[tuple[int, int], ...],
+    index_files: list[Path] | None = None,
+    compress: bool = False,
+) -> tuple[tuple[int, int], ...]:
+    """
+    publish stats and stats_detail tables into csv_file and its sibling files.
+
+    :return: checksums of the saved tables, to pass as loaded on the next save
+    """
+    top_10 = csv_file.parent / "package_top_10.csv"
+    detail_file = csv_file.parent / "package_stats_detail.csv"
+    arch_file = csv_file.parent / "package_arch_stats.csv"
+    source_file = csv_file.parent / "source_package_stats.csv"
+    bot_file = csv_file.parent / "package_bot_stats.csv"
+    saved = (table_checksum(conn, "stats"), table_checksum(conn, "stats_detail"), table_checksum(conn, "stats_bot"))
+    with publish(compress) as pub:
+        # skip sorting and writing unless a row changed or a file is missing
+        if saved[0] != loaded[0] or not (csv_file.exists() and top_10.exists()):
+            pub.copy_ranked(conn, "stats", "Download DESC, Name ASC", csv_file, top_10)
+        if saved[1] != loaded[1] or not (detail_file.exists() and arch_file.exists()):
+            pub.copy(
+                conn,
+                "SELECT * FROM stats_detail ORDER BY Download DESC, Name ASC, Version ASC, Arch ASC",
+                detail_file,
+            )
+            pub.copy(
+                conn,
+                """
+                SELECT Arch, SUM(Download) AS Download FROM stats_detail
+                GROUP BY Arch ORDER BY Download DESC, Arch ASC""",
+                arch_file,
+            )
+        if saved[2] != loaded[2] or not bot_file.exists():
+            pub.copy(conn, "SELECT * FROM stats_bot ORDER BY Download DESC, Name ASC", bot_file)
+        if index_files:
+            pub.copy(
+                conn,
+                """
+                SELECT COALESCE(source_map.Source, stats.Name) AS Name, SUM(stats.Download) AS Download
+                FROM stats LEFT JOIN source_map ON stats.Name = source_map.Package
+                GROUP BY 1 ORDER BY Download DESC, Name ASC""",
+                source_file,
+            )
+    return saved
+
+
+@contextmanager
+def popular_package(csv_file: Path, index_files: list[Path] | None = None, compress: bool = False):
+    """
+    load and save new package download into csv_file.
+    package_top_10.csv, package_stats_detail.csv (per name, version and arch),
+    package_arch_stats.csv (per arch rollup) and package_bot_stats.csv (downloads by bots, included in the
+    other files) are also updated at the save folder.
+    If Debian index files are given, source_package_stats.csv (per source package rollup) is updated too.
+    The files are published together only if the processing succeeds.
+    With compress, they get pre-compressed .gz/.br siblings.
+    """
+    conn = duckdb.connect(":memory:")
+    try:
+        loaded = load_package(conn, csv_file, index_files)
         yield conn
+        save_package(conn, csv_file, loaded, index_files, compress)
     finally:
-        conn.execute(
-            f"""
-            COPY (SELECT * FROM stats ORDER BY Download DESC, Name ASC)
-            TO '{csv_file}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-        )
-        conn.execute(
-            f"""
-            COPY (SELECT * FROM stats ORDER BY Download DESC, Name ASC LIMIT 10)
-            TO '{top_10}'
-            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\n');"""
-        )
         conn.close()
 
 
-# _DEB_NAME_RE = re.compile(r"^([a-zA-Z0-9\-\+\.]+)_(.+?)_(.+?).deb$", re.ASCII)
-_DEB_NAME_RE = re.compile(r"^([a-zA-Z0-9\-\+\.]+)_", re.ASCII)
+_DEB_NAME_RE = re.compile(r"[a-zA-Z0-9\-\+\.]+", re.ASCII)
+_DEB_CONTENT_TYPES = frozenset(
+    (
+        "application/vnd.debian.binary-package",
+        "binary/octet-stream",
+    )
+)
+_DEB_POOL_PREFIX = "/elxr/pool/"
+_DEB_SUFFIX = ".deb"
+
+
+class DebFile(NamedTuple):
+    """binary package name, version and architecture parsed from a deb file name"""
+
+    name: str
+    version: str | None = None
+    arch: str | None = None
 
 
 @cache
-def _parse_deb_name(path: str) -> str | None:
+def _parse_deb_file(path: str) -> DebFile | None:
     """
-    Extract package name from a given URI path.
+    Extract package name, version and architecture from a given URI path.
 
     Parameters:
-    path (str): The URI path from which to extract the package name.
+    path (str): The URI path of a deb file, e.g. /elxr/pool/main/<letter>/<src>/<pkg>_<ver>_<arch>.deb
 
     Returns:
-    str | None: The extracted package name if successful, otherwise None.
-
-    Purpose:
-    This function takes a URI path as input, extracts the file name from it, and attempts to parse the package name
-    from the file name using a regular expression. If successful, it returns the package name; otherwise, it logs a
-    warning and returns None.
+    DebFile | None: The parsed deb file if successful, otherwise None.
 
     Notes:
-    The function uses a regular expression to match the package name in the file name. The regular expression is
-    defined as _DEB_NAME_RE and matches one or more alphanumeric characters, hyphens, plus signs, or dots at the
-    beginning of the file name. If the match is successful, the function returns the matched package name; otherwise,
-    it logs a warning and returns None.
-    """
-    # get src package name in stead of binary
-    # apt-get showsrc file.deb
-    # apt-get search name
+    Pool paths are highly structured, so the file name is split with plain string partitioning instead of
+    constructing a Path and running a regular expression over it. Only the package name is validated against
+    _DEB_NAME_RE; version and architecture are None when missing from the file name.
+    """
+    # binary names are mapped to source package names by debian_index.load_source_map, with
     # https://mirror.elxr.dev/elxr/dists/aria/main/binary-amd64/Packages
-    # https://debian.osuosl.org/debian/indices/package-file.map.bz2
     assert path
-    file_name = Path(path).name
-    match = _DEB_NAME_RE.match(file_name)
-    if match:
-        return match.group(1)
+    file_name = path.rpartition("/")[2]
+    if file_name.endswith(_DEB_SUFFIX):
+        file_name = file_name[: -len(_DEB_SUFFIX)]
+    name, sep, rest = file_name.partition("_")
+    if sep and _DEB_NAME_RE.fullmatch(name):
+        version, sep, arch = rest.rpartition("_")
+        if not sep:  # <pkg>_<ver>.deb
+            version, arch = rest, ""
+        return DebFile(name, version or None, arch or None)
     logger.warning("failed to parse deb package name from: {%s}", path)
     return None
 
 
-def _update_package_download(conn: duckdb.DuckDBPyConnection, log_entry: CloudFrontLogEntry) -> None:
+def _parse_deb_name(path: str) -> str | None:
     """
-    Updates the package download count in the database based on the provided CloudFront log entry.
+    Extract package name from a given URI path.
 
     Parameters:
-    conn (duckdb.DuckDBPyConnection): The connection to the DuckDB database.
-    log_entry (CloudFrontLogEntry): The CloudFront log entry containing information about the package download.
+    path (str): The URI path from which to extract the package name.
 
     Returns:
-    None
+    str | None: The extracted package name if successful, otherwise None.
+    """
+    deb = _parse_deb_file(path)
+    return deb.name if deb else None
 
-    Notes:
-    This function assumes that the database connection is already established and the stats table exists.
-    The function uses the _parse_deb_name function to extract the package name from the log entry's URI stem.
+
+def _match_deb_download(log_entry: CloudFrontLogEntry) -> DebFile | None:
     """
-    if log_entry.sc_content_type not in (
-        "application/vnd.debian.binary-package",
-        "binary/octet-stream",
-    ):  # only count deb file
-        return
-    if log_entry.sc_status is None or log_entry.sc_status >= 400:
-        return
-    if log_entry.cs_uri_stem is None or not log_entry.cs_uri_stem.startswith("/elxr/pool/"):
-        return
-    if not log_entry.cs_uri_stem.endswith(".deb"):
-        return
-    name = _parse_deb_name(log_entry.cs_uri_stem)
-    if not name:
+    Check whether the log entry is a successful deb download from the pool, and parse its file name.
+
+    Content type, status, pool prefix and deb suffix are evaluated in one short-circuit expression, so a
+    rejected entry costs a handful of attribute loads. The file name is only parsed for accepted entries.
+    """
+    uri = log_entry.cs_uri_stem
+    if (
+        log_entry.sc_content_type in _DEB_CONTENT_TYPES  # only count deb file
+        and log_entry.sc_status is not None
+        and log_entry.sc_status < 400
+        and uri is not None
+        and uri.startswith(_DEB_POOL_PREFIX)
+        and uri.endswith(_DEB_SUFFIX)
+    ):
+        return _parse_deb_file(uri)
+    return None
+
+
+def package_line_filter() -> LineFilter:
+    """the raw line checks of _match_deb_download: a deb content type, a status below 400 and a pool deb uri."""
+    return LineFilter(any_of=_DEB_CONTENT_TYPES, statuses=range(100, 400), uri_contains=(_DEB_POOL_PREFIX, _DEB_SUFFIX))
+
+
+def _deb_name(log_entry: CloudFrontLogEntry) -> tuple[str] | None:
+    """the package name of a deb download, as the key of a metric, or None if it is not a deb download."""
+    deb = _match_deb_download(log_entry)
+    return (deb.name,) if deb else None
+
+
+def _package_specs(classifier: BotClassifier = DEFAULT_CLASSIFIER) -> tuple[MetricSpec, ...]:
+    """
+    the metrics of package downloads: per name, version and arch, parsed from the uri by _match_deb_download,
+    and per name for downloads by bots.
+    """
+    return (
+        MetricSpec("stats_detail", key=("Name", "Version", "Arch"), extractor=_match_deb_download),
+        MetricSpec(
+            "stats_bot",
+            key=("Name",),
+            extractor=_deb_name,
+            predicate=lambda entry: classifier.is_bot(entry.cs_user_agent, entry.c_ip),
+        ),
+    )
+
+
+def merge_package_download(
+    conn: duckdb.DuckDBPyConnection,
+    downloads: Counter[tuple[str, str | None, str | None]],
+    bots: Counter[tuple[str]] | None = None,
+) -> None:
+    """
+    merge collected download count, keyed on name, version and arch, into stats and stats_detail tables, and bot
+    download count, keyed on name, into stats_bot.
+
+    Missing version or arch are stored as "N/A" in stats_detail.
+    """
+    if bots:
+        conn.executemany(
+            """
+            INSERT INTO stats_bot (Name, Download) values (?, ?)
+            ON CONFLICT (Name) DO UPDATE SET Download = stats_bot.Download + EXCLUDED.Download;""",
+            [(name, count) for (name,), count in bots.items()],
+        )
+    if not downloads:
         return
+    conn.execute("""DROP TABLE IF EXISTS temp_download;""")
+    conn.execute(
+        """
+        CREATE TEMP TABLE temp_download (
+        Name VARCHAR,
+        Version VARCHAR,
+        Arch VARCHAR,
+        Download INTEGER
+    );"""
+    )
+    conn.executemany(
+        "INSERT INTO temp_download VALUES (?, ?, ?, ?);",
+        [(name, version or "N/A", arch or "N/A", count) for (name, version, arch), count in downloads.items()],
+    )
+    conn.execute(
+        """
+        INSERT INTO stats (Name, Download)
+        SELECT Name, SUM(Download) FROM temp_download GROUP BY Name
+        ON CONFLICT (Name) DO UPDATE SET Download = stats.Download + EXCLUDED.Download;"""
+    )
     conn.execute(
-        f"""
-        INSERT INTO stats (Name, Download) values ('{name}', 1)
-        ON CONFLICT (Name) DO UPDATE SET Download = stats.Download + 1; """
+        """
+        INSERT INTO stats_detail (Name, Version, Arch, Download)
+        SELECT Name, Version, Arch, SUM(Download) FROM temp_download GROUP BY Name, Version, Arch
+        ON CONFLICT (Name, Version, Arch) DO UPDATE SET Download = stats_detail.Download + EXCLUDED.Download;"""
     )
+    conn.execute("""DROP TABLE temp_download;""")
+
+
+class PackageAggregator(MetricEngine):
+    """
+    Count package downloads in memory, in total, per version and architecture, and by bots.
+
+    The downloads are counted by the metric engine with the specs of _package_specs, keyed on name, version and
+    arch ("N/A" if missing), and the bot downloads keyed on name. The snapshot tables are package_stats,
+    package_stats_detail and package_bot_stats, with the columns of the csv files of the same name.
+    """
+
+    def __init__(self, classifier: BotClassifier = DEFAULT_CLASSIFIER) -> None:
+        super().__init__(_package_specs(classifier))
+        self.classifier = classifier
+
+    @property
+    def downloads(self) -> Counter[tuple]:
+        """the download count, keyed on name, version and arch."""
+        return self.counts["stats_detail"]
+
+    @property
+    def bots(self) -> Counter[tuple]:
+        """the download count by bots, keyed on name."""
+        return self.counts["stats_bot"]
+
+    def snapshot(self) -> dict[str, Rows]:
+        totals: Counter[str] = Counter()
+        for (name, _, _), count in self.downloads.items():
+            totals[name] += count
+        return {
+            "package_stats": [
+                {"Name": name, "Download": n} for name, n in sorted(totals.items(), key=lambda i: (-i[1], i[0]))
+            ],
+            "package_stats_detail": [
+                {"Name": name, "Version": version, "Arch": arch, "Download": n}
+                for (name, version, arch), n in sorted(self.downloads.items(), key=lambda i: (-i[1], i[0]))
+            ],
+            "package_bot_stats": [
+                {"Name": name, "Download": n} for (name,), n in sorted(self.bots.items(), key=lambda i: (-i[1], i[0]))
+            ],
+        }
+
+
+def ingest_package(
+    conn: duckdb.DuckDBPyConnection,
+    entries: Iterable[CloudFrontLogEntry],
+    classifier: BotClassifier = DEFAULT_CLASSIFIER,
+) -> None:
+    """count package downloads of log entries in memory and merge them in one transaction."""
+    aggregator = PackageAggregator(classifier).feed_batch(entries)
+    conn.execute("BEGIN TRANSACTION;")
+    merge_package_download(conn, aggregator.downloads, aggregator.bots)
+    conn.execute("COMMIT;")
 
 
 @timing
-def parse_mirror_elxr_dev_logs(log_folder: Path, csv_file: Path = MIRROR_ELXR_DEV_CSV) -> None:
+def parse_mirror_elxr_dev_logs(
+    log_folder: Path | str,
+    csv_file: Path = MIRROR_ELXR_DEV_CSV,
+    index_files: list[Path] | None = None,
+    compress: bool = False,
+    classifier: BotClassifier = DEFAULT_CLASSIFIER,
+    sample_rate: float = 1.0,
+) -> None:
     """parse logs from mirror site and extract package download count
 
-    :param log_folder: the parent folder path of log files (compressed by gzip)
-    :type log_folder: Path
+    :param log_folder: the parent folder path of log files (compressed by gzip), or an s3://bucket/prefix URL
+    :type log_folder: Path | str
     :param csv_file: the path of CSV file, default to MIRROR_ELXR_DEV_CSV
     :type csv_file: Path
+    :param index_files: Debian Packages/Sources index files to roll up downloads by source package, default to None
+    :type index_files: list[Path] | None
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param classifier: the classifier of bot downloads, counted into package_bot_stats.csv, default to user agent only
+    :type classifier: BotClassifier
+    :param sample_rate: the share of requests counted and scaled up to estimates, written with their confidence
+                        intervals into the estimated folder next to csv_file, default to 1.0 to count all exactly
+    :type sample_rate: float
     :return: None
     :raises Exception: if log_folder does not exist, not a directory.
                        if csv_file is not a file"""
-    with _popular_package(csv_file) as conn:
-        conn.execute("BEGIN TRANSACTION;")
-        for child in log_folder.glob("*.gz"):
-            for entry in parse_cloudfront_log(child):
-                _update_package_download(conn, entry)
-        conn.execute("COMMIT;")
+    line_filter = package_line_filter()
+    if sample_rate < 1:
+        csv_file = estimated_csv(csv_file)
+        line_filter = line_filter.sampled(sample_rate, SAMPLE_FIELDS["package_download"])
+    # with sampling, scale_counts stages estimate.csv into this publish, to be published with the csv files
+    with publish(), popular_package(csv_file, index_files, compress) as conn:
+        if sample_rate < 1:
+            clear_counts(conn, _PACKAGE_COUNTS)
+        ingest_package(conn, read_logs(log_folder, line_filter=line_filter), classifier)
+        if sample_rate < 1:
+            scale_counts(conn, _PACKAGE_COUNTS, sample_rate, csv_file)
+    line_filter.report()
@@ -0,0 +1,299 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to publish exported metrics files atomically"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Generator
+
+import duckdb
+
+try:
+    import brotli
+except ImportError:  # optional, pip install elxr-metrics[brotli]
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# pre-compressed siblings: file suffix to encoder
+_ENCODERS: dict[str, Callable[[bytes], bytes]] = {".gz": lambda b: gzip.compress(b, compresslevel=9, mtime=0)}
+if brotli is not None:
+    _ENCODERS[".br"] = lambda b: brotli.compress(b, quality=11)
+_COMPRESSED = (".csv", ".json")  # suffixes of the files that get pre-compressed siblings
+_SIBLINGS = (".gz", ".br")  # suffixes of all pre-compressed siblings, whether brotli is installed or not
+
+
+def _digest(path: Path) -> bytes | None:
+    """sha256 digest of the file content, or None if the file does not exist."""
+    if not path.exists():
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def _fsync(path: Path) -> None:
+    """flush file (or directory) content to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:  # directories cannot be fsync'ed on every platform
+        pass
+    finally:
+        os.close(fd)
+
+
+class CsvPublisher:
+    """
+    Stage exported files next to their targets and publish them together.
+
+    Each file is written to a temporary sibling and fsync'ed; missing directories of a target are created for it,
+    and removed again if the staged files are discarded. On commit, a staged file whose content hash equals
+    the current target is dropped, so unchanged data is not rewritten; changed files replace their targets with
+    an atomic rename. If a rename fails, already replaced targets are restored to their previous content.
+
+    With compress, every changed text file also gets pre-compressed .gz and .br (if brotli is installed) siblings,
+    published in the same way, so a static web server can send the smaller encoding. compress applies to the files
+    staged while it is set, so a nested publish can compress its own files only. Siblings that were not written
+    again for a changed file are removed once it is published, so a server never sends stale content. Files
+    staged for removal, e.g. shards no longer listed in an index, are removed with their siblings at that point too.
+    A target staged twice is published with the content staged last.
+    """
+
+    def __init__(self, compress: bool = False) -> None:
+        self._staged: list[tuple[Path, Path, bool]] = []  # temporary file, target and whether to compress it
+        self._removed: list[Path] = []  # targets to remove once the staged files are published
+        self._created: list[Path] = []  # directories created for staged files, removed again if they are discarded
+        self._compress = False
+        self.compress = compress
+
+    @property
+    def compress(self) -> bool:
+        """whether files staged from now on get pre-compressed siblings."""
+        return self._compress
+
+    @compress.setter
+    def compress(self, compress: bool) -> None:
+        if compress and brotli is None:
+            logger.warning("brotli is not installed, only .gz files are compressed")
+        self._compress = compress
+
+    def _temp_path(self, target: Path) -> Path:
+        missing = []
+        directory = target.parent
+        while not directory.is_dir():
+            missing.append(directory)
+            directory = directory.parent
+        for directory in reversed(missing):
+            directory.mkdir(exist_ok=True)
+            self._created.append(directory)
+        return target.with_name(f".{target.name}.{os.getpid()}.tmp")
+
+    def _stage(self, temp: Path, target: Path) -> None:
+        _fsync(temp)
+        # a target staged again, e.g. by an outer and a nested save, shares its temporary file: the last one wins
+        self._staged = [entry for entry in self._staged if entry[1] != target]
+        self._staged.append((temp, target, self.compress))
+
+    def copy(self, conn: duckdb.DuckDBPyConnection, query: str, target: Path) -> None:
+        """stage the result of query as a CSV file for target."""
+        temp = self._temp_path(target)
+        conn.execute(
+            f"""
+            COPY ({query})
+            TO '{temp}'
+            WITH (FORMAT CSV, DELIMITER ',', HEADER, NEW_LINE e'\\n');"""
+        )
+        self._stage(temp, target)
+
+    def copy_ranked(
+        self,
+        conn: duckdb.DuckDBPyConnection,
+        table: str,
+        order_by: str,
+        target: Path,
+        top_target: Path,
+        top_n: int = 10,
+    ) -> None:
+        """
+        stage table sorted by order_by for target, and its first top_n rows for top_target.
+
+        The table is sorted and written once; the top file is the header and first top_n lines of the staged file,
+        so it costs no second query. Values must not contain line breaks, which holds for package and image names.
+        """
+        self.copy(conn, f"SELECT * FROM {table} ORDER BY {order_by}", target)
+        temp = self._staged[-1][0]
+        with open(temp, encoding="utf-8") as f:
+            head = "".join(line for _, line in zip(range(top_n + 1), f))
+        self.write_text(top_target, head)
+
+    def _compressed(self, temp: Path, target: Path) -> list[tuple[Path, Path]]:
+        """write compressed siblings of a staged text file."""
+        data = temp.read_bytes()
+        siblings = []
+        for suffix, encode in _ENCODERS.items():
+            sibling = target.with_name(target.name + suffix)
+            sibling_temp = self._temp_path(sibling)
+            sibling_temp.write_bytes(encode(data))
+            _fsync(sibling_temp)
+            siblings.append((sibling_temp, sibling))
+        return siblings
+
+    def write_text(self, target: Path, text: str) -> None:
+        """stage text content for target."""
+        temp = self._temp_path(target)
+        temp.write_text(text, encoding="utf-8")
+        self._stage(temp, target)
+
+    def write_bytes(self, target: Path, data: bytes) -> None:
+        """stage binary content for target."""
+        temp = self._temp_path(target)
+        temp.write_bytes(data)
+        self._stage(temp, target)
+
+    def remove(self, target: Path) -> None:
+        """stage the removal of target and its pre-compressed siblings, done once the staged files are published."""
+        self._removed.append(target)
+
+    def discard(self) -> None:
+        """remove all staged files, leaving targets untouched."""
+        for temp, _, _ in self._staged:
+            temp.unlink(missing_ok=True)
+        self._staged.clear()
+        self._removed.clear()
+        self._remove_created()
+
+    def _remove_created(self) -> None:
+        """remove the directories created for staged files, unless something else was put in them."""
+        for directory in reversed(self._created):
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+        self._created.clear()
+
+    def commit(self) -> list[Path]:
+        """
+        Publish staged files whose content changed.
+
+        :return: the targets that were replaced
+        :rtype: list[Path]
+        :raises OSError: if a target cannot be replaced; previous targets are restored first
+        """
+        changed: list[tuple[Path, Path]] = []
+        stale: list[Path] = []
+        for temp, target, compress in self._staged:
+            compress = compress and target.suffix in _COMPRESSED
+            if _digest(temp) == _digest(target):
+                logger.info("unchanged, skip writing %s", target)
+                if compress and not all(target.with_name(target.name + s).exists() for s in _ENCODERS):
+                    changed.extend(self._compressed(target, target))
+                temp.unlink()
+            else:
+                if compress:
+                    changed.extend(self._compressed(temp, target))
+                if target.suffix in _COMPRESSED:
+                    written = _ENCODERS if compress else ()
+                    stale.extend(target.with_name(target.name + s) for s in _SIBLINGS if s not in written)
+                changed.append((temp, target))
+        for target in self._removed:
+            stale.extend((target, *(target.with_name(target.name + s) for s in _SIBLINGS)))
+        self._staged.clear()
+        self._removed.clear()
+
+        backups: list[tuple[Path | None, Path]] = []
+        try:
+            for temp, target in changed:
+                backup = None
+                if target.exists():
+                    backup = target.with_name(f".{target.name}.{os.getpid()}.bak")
+                    backup.unlink(missing_ok=True)
+                    try:
+                        os.link(target, backup)
+                    except OSError:  # no hard link support
+                        shutil.copy2(target, backup)
+                backups.append((backup, target))
+                os.replace(temp, target)
+        except BaseException:
+            logger.error("failed to publish, restore %d files", len(backups))
+            for backup, target in reversed(backups):
+                if backup is None:
+                    target.unlink(missing_ok=True)
+                else:
+                    os.replace(backup, target)
+            for temp, _ in changed:
+                temp.unlink(missing_ok=True)
+            self._remove_created()
+            raise
+        self._created.clear()
+        for backup, _ in backups:
+            if backup is not None:
+                backup.unlink()
+        for path in stale:
+            if path.exists():
+                path.unlink()
+                logger.info("removed stale %s", path)
+        for directory in {target.parent for _, target in changed}:
+            _fsync(directory)
+        for _, target in changed:
+            logger.info("published %s", target)
+        return [target for _, target in changed]
+
+
+def table_checksum(conn: duckdb.DuckDBPyConnection, table: str) -> tuple[int, int]:
+    """
+    row count and order independent checksum of table content.
+
+    It is a single scan without sorting, so comparing the checksum taken after loading a table with the one taken
+    before exporting tells whether any row changed, at a fraction of the export cost.
+    """
+    row = conn.execute(f"""SELECT COUNT(*), COALESCE(bit_xor(hash(t)), 0) FROM {table} AS t;""").fetchone()
+    assert row is not None
+    return row[0], row[1]
+
+
+_active = threading.local()  # the outermost publisher of the current thread
+
+
+@contextmanager
+def publish(compress: bool = False) -> Generator[CsvPublisher, Any, None]:
+    """
+    context manager to stage files and publish them on exit.
+
+    If the block raises, staged files are discarded and the published files are left as they were.
+    A publish nested in another one, e.g. a pipeline save inside a backfill chunk, joins the outer publisher,
+    so all files are published together when the outer block exits; the files staged in the nested block are
+    compressed as the nested publish asks.
+    """
+    outer = getattr(_active, "publisher", None)
+    if outer is not None:
+        previous, outer.compress = outer.compress, compress
+        try:
+            yield outer
+        finally:
+            outer.compress = previous
+        return
+    publisher = CsvPublisher(compress)
+    _active.publisher = publisher
+    try:
+        yield publisher
+    except BaseException:
+        publisher.discard()
+        raise
+    finally:
+        _active.publisher = None
+    publisher.commit()
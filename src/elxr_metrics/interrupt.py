@@ -0,0 +1,36 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to stop long running commands on SIGTERM as on SIGINT"""
+
+from __future__ import annotations
+
+import signal
+import threading
+from contextlib import contextmanager
+from typing import Any, Generator
+
+
+def _interrupt(signum, frame):  # pylint: disable=unused-argument
+    raise KeyboardInterrupt
+
+
+@contextmanager
+def interrupt_on_sigterm() -> Generator[None, Any, None]:
+    """
+    context manager to raise KeyboardInterrupt on SIGTERM, so a service manager stops the block like Ctrl-C.
+
+    Signal handlers can only be set in the main thread; elsewhere SIGTERM is left as it is. The previous handler
+    is restored on exit.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
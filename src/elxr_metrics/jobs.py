@@ -0,0 +1,106 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to run several metric pipelines concurrently in worker processes"""
+
+from __future__ import annotations
+
+import logging
+import shlex
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Mapping, NamedTuple
+
+from elxr_metrics.elapsed import elapsed_timer
+
+logger = logging.getLogger(__name__)
+
+
+class JobResult(NamedTuple):
+    """the outcome of a job: its name, seconds it took and its error, None if it succeeded"""
+
+    name: str
+    seconds: float
+    error: str | None = None
+
+
+def load_jobs(path: Path) -> list[tuple[int, list[str]]]:
+    """
+    Read a jobs file, one one-shot run per line: log_path, csv_path, log_type and options, quoted as in a shell.
+
+    Lines starting with # are comments, e.g.:
+
+    .. code-block:: text
+
+        # log_path csv_path log_type [options]
+        logs/elxr_org public/elxr_org_view.csv elxr_org_view --city-db GeoLite2-City.mmdb
+        logs/mirror_elxr_dev public/package_stats.csv package_download --compress
+
+    :param path: the jobs file
+    :type path: Path
+    :return: the line number and the arguments of each job
+    :rtype: list[tuple[int, list[str]]]
+    :raises ValueError: if a line cannot be split, or there is no job
+    """
+    jobs = []
+    for lineno, line in enumerate(path.read_text(encoding="utf-8").splitlines(), start=1):
+        try:
+            args = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise ValueError(f"{path}:{lineno}: {e}") from e
+        if args:
+            jobs.append((lineno, args))
+    if not jobs:
+        raise ValueError(f"no job in {path}")
+    return jobs
+
+
+def _timed(name: str, job: Callable[[], Any]) -> JobResult:
+    with elapsed_timer() as et:
+        try:
+            job()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception("job %s failed after %2.4f sec", name, et())
+            return JobResult(name, et(), f"{type(e).__name__}: {e}")
+        logger.info("job %s took %2.4f sec", name, et())
+        return JobResult(name, et())
+
+
+def run_jobs(jobs: Mapping[str, Callable[[], Any]], workers: int | None = None) -> list[JobResult]:
+    """
+    Run jobs concurrently in a process pool, and report how long each took.
+
+    Most of the time of a job goes to parsing log lines in Python, which holds the GIL, so the jobs run in worker
+    processes rather than threads. A job must be picklable, e.g. a functools.partial of a module level function.
+    Each job publishes its own csv files and shares no state with the others, so jobs must not write to the same
+    outputs. A job that fails, or whose worker dies, is logged and does not stop the others.
+
+    :param jobs: the jobs to run by name
+    :type jobs: Mapping[str, Callable[[], Any]]
+    :param workers: the most jobs run at once, default to None to run all at once
+    :type workers: int | None
+    :return: the result of each job, in the order of jobs
+    :rtype: list[JobResult]
+    """
+    with elapsed_timer() as et:
+        with ProcessPoolExecutor(max_workers=workers or max(len(jobs), 1)) as executor:
+            futures = {name: executor.submit(_timed, name, job) for name, job in jobs.items()}
+            results = []
+            for name, future in futures.items():
+                try:
+                    results.append(future.result())
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("job %s did not run: %s", name, e)
+                    results.append(JobResult(name, 0.0, f"{type(e).__name__}: {e}"))
+        failed = sum(1 for result in results if result.error)
+        logger.info(
+            "ran %d jobs in %2.4f sec, %2.4f sec one after another, %d failed",
+            len(results),
+            et(),
+            sum(result.seconds for result in results),
+            failed,
+        )
+    return results
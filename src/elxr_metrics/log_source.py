@@ -0,0 +1,218 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to list and read CloudFront log files from a local folder or an S3 compatible bucket"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain
+from pathlib import Path
+from typing import IO, Any, Generator, Iterable
+from urllib.parse import urlparse
+
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry, LineFilter, is_log_file, log_file_time, parse_cloudfront_log
+
+try:
+    import boto3
+except ImportError:  # optional, pip install elxr-metrics[s3]
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+S3_SCHEME = "s3://"
+_BATCH = 1000  # entries handed from a reader thread to the consumer at once
+_DONE = object()  # a reader thread finished its object
+_EPOCH = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+def log_order(key: str) -> tuple[datetime.datetime, str]:
+    """sort key of a log file: the hour in its CloudFront file name, then the name."""
+    return log_file_time(Path(key)) or _EPOCH, key
+
+
+class S3LogSource:
+    """
+    CloudFront log files under an s3://bucket/prefix URL.
+
+    Objects are listed page by page and streamed through gzip decompression straight from the response body,
+    so nothing is staged on disk. The endpoint and credentials come from the usual AWS environment variables
+    and configuration files, e.g. AWS_ENDPOINT_URL for MinIO.
+    """
+
+    def __init__(self, url: str, client: Any = None, max_workers: int = 4, page_size: int | None = None) -> None:
+        parsed = urlparse(url)
+        if parsed.scheme != "s3" or not parsed.netloc:
+            raise ValueError(f"not an s3://bucket/prefix URL: {url}")
+        if client is None:
+            if boto3 is None:
+                raise ImportError("reading logs from S3 requires boto3, pip install elxr-metrics[s3]")
+            client = boto3.client("s3")
+        self.url = url
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.lstrip("/")
+        self.client = client
+        self.max_workers = max_workers
+        self.page_size = page_size
+
+    def __str__(self) -> str:
+        return self.url
+
+    def keys(self) -> Generator[str, None, None]:
+        """list the keys of log objects (.gz, .zst or .log) under the prefix, following pagination."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        config = {"PageSize": self.page_size} if self.page_size else {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, PaginationConfig=config):
+            for obj in page.get("Contents", []):
+                if is_log_file(obj["Key"]):
+                    yield obj["Key"]
+
+    def open(self, key: str) -> IO[bytes]:
+        """open the streaming body of an object."""
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def _read(self, key: str, out: queue.Queue, stop: threading.Event, line_filter: LineFilter | None) -> None:
+        """parse one object and put its entries into out in batches, then _DONE, until stop is set."""
+        try:
+            with self.open(key) as body:
+                batch: list[CloudFrontLogEntry] = []
+                for entry in parse_cloudfront_log(body, line_filter, key):
+                    batch.append(entry)
+                    if len(batch) >= _BATCH:
+                        if stop.is_set():
+                            break
+                        out.put(batch)
+                        batch = []
+                else:
+                    out.put(batch)
+            out.put(_DONE)
+        except Exception as e:  # pylint: disable=broad-except
+            out.put(e)
+
+    def entries(
+        self, keys: Iterable[str] | None = None, line_filter: LineFilter | None = None
+    ) -> Generator[CloudFrontLogEntry, None, None]:
+        """
+        Read the log entries of objects in the order of keys, streaming up to max_workers objects at once.
+
+        Up to max_workers objects are read ahead, each into its own small queue, and the entries of an object are
+        yielded once the objects before it are done, so they come in the same order as from one object after
+        another, and time bucketed pipelines see the hours of CloudFront file names in order.
+
+        :param keys: the object keys, default to all listed keys
+        :type keys: Iterable[str] | None
+        :param line_filter: the checks of raw lines, default to None to parse every line
+        :type line_filter: LineFilter | None
+        :return: generator of log entries
+        :rtype: CloudFrontLogEntry
+        :raises Exception: the first error of a reader thread
+        """
+        keys = list(self.keys() if keys is None else keys)
+        remaining = iter(keys)
+        stop = threading.Event()
+        reading: deque[tuple[Future, queue.Queue]] = deque()  # the objects read ahead, in order
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3-log") as executor:
+
+            def read_next() -> None:
+                key = next(remaining, None)
+                if key is not None:
+                    # a small bound keeps memory flat when readers are faster than the consumer
+                    out: queue.Queue = queue.Queue(maxsize=4)
+                    reading.append((executor.submit(self._read, key, out, stop, line_filter), out))
+
+            try:
+                for _ in range(self.max_workers):
+                    read_next()
+                while reading:
+                    _, out = reading[0]
+                    while (item := out.get()) is not _DONE:
+                        if isinstance(item, BaseException):
+                            raise item
+                        yield from item
+                    reading.popleft()
+                    read_next()
+            finally:
+                stop.set()
+                while any(not future.done() for future, _ in reading):  # unblock readers waiting on a full queue
+                    for _, out in reading:
+                        try:
+                            out.get(timeout=0.01)
+                        except queue.Empty:
+                            pass
+        logger.info("read %d objects from %s", len(keys), self.url)
+
+
+class LocalLogSource:
+    """CloudFront log files in a local folder, keyed by file name."""
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+
+    def __str__(self) -> str:
+        return str(self.folder)
+
+    def keys(self) -> Generator[str, None, None]:
+        """list the names of log files (.gz, .zst or .log) in the folder."""
+        for child in self.folder.iterdir():
+            if is_log_file(child.name) and child.is_file():
+                yield child.name
+
+    def entries(
+        self, keys: Iterable[str] | None = None, line_filter: LineFilter | None = None
+    ) -> Iterable[CloudFrontLogEntry]:
+        """
+        Read the log entries of files one after another.
+
+        :param keys: the file names, default to all listed files
+        :type keys: Iterable[str] | None
+        :param line_filter: the checks of raw lines, default to None to parse every line
+        :type line_filter: LineFilter | None
+        :return: the log entries
+        :rtype: Iterable[CloudFrontLogEntry]
+        """
+        files = (self.folder / key for key in (self.keys() if keys is None else keys))
+        return chain.from_iterable(parse_cloudfront_log(f, line_filter) for f in files)
+
+
+def open_log_source(location: Path | str, max_workers: int = 4) -> LocalLogSource | S3LogSource:
+    """
+    Open the log source of a location.
+
+    :param location: a local folder, or an s3://bucket/prefix URL
+    :type location: Path | str
+    :param max_workers: number of S3 objects streamed at once, default to 4
+    :type max_workers: int
+    :return: the log source
+    :rtype: LocalLogSource | S3LogSource
+    """
+    if str(location).startswith(S3_SCHEME):
+        return S3LogSource(str(location), max_workers=max_workers)
+    return LocalLogSource(Path(location))
+
+
+def read_logs(
+    location: Path | str, max_workers: int = 4, line_filter: LineFilter | None = None
+) -> Iterable[CloudFrontLogEntry]:
+    """
+    Read the log entries of all log files (.gz, .zst or .log) at a location, in the order of the hour in their
+    CloudFront file names, so the entries come roughly in time order.
+
+    :param location: a local folder, or an s3://bucket/prefix URL
+    :type location: Path | str
+    :param max_workers: number of S3 objects streamed at once, default to 4
+    :type max_workers: int
+    :param line_filter: the checks of raw lines, default to None to parse every line
+    :type line_filter: LineFilter | None
+    :return: the log entries
+    :rtype: Iterable[CloudFrontLogEntry]
+    """
+    source = open_log_source(location, max_workers)
+    return source.entries(sorted(source.keys(), key=log_order), line_filter)
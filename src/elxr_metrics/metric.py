@@ -0,0 +1,348 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to count declarative metrics of log entries in a single pass"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from operator import attrgetter
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterable
+
+import duckdb
+from duckdb import DuckDBPyConnection
+
+from elxr_metrics.aggregate import Aggregator, Rows
+from elxr_metrics.cloudfront_log import BUCKET_WIDTHS, CloudFrontLogEntry, time_bucket
+from elxr_metrics.elapsed import timing
+from elxr_metrics.export import publish
+from elxr_metrics.log_source import read_logs
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11, pip install tomli
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+METRICS_CSV = Path("public/metrics.csv")
+
+logger = logging.getLogger(__name__)
+
+_ENTRY_FIELDS = frozenset(f.name for f in fields(CloudFrontLogEntry))
+_FLOAT_FIELDS = frozenset(f.name for f in fields(CloudFrontLogEntry) if f.type.partition("|")[0].strip() == "float")
+
+
+@dataclass(frozen=True)
+class MetricSpec:
+    """
+    A metric counted from log entries.
+
+    An entry is counted if every field in where has one of the listed values and predicate, if given, accepts it.
+    It is counted under the values of the key fields, missing values as "N/A", and with time_bucket ("1h", "6h" or
+    "1d") also under its time bucket. With an extractor, key names the values it returns instead of log fields,
+    e.g. parsed from the uri, and an entry it returns None for is not counted. The count is 1 per entry, or the
+    value of the sum field, kept as a float if the field is one. The metric is written to <name>.csv with the
+    columns TimeBucket (with time_bucket), the key columns and Count (or Sum).
+    """
+
+    name: str
+    key: tuple[str, ...]
+    where: dict[str, tuple[Any, ...]] = field(default_factory=dict)
+    time_bucket: str | None = None
+    sum: str | None = None
+    columns: tuple[str, ...] | None = None  # names of the key columns, default to the key fields
+    predicate: Callable[[CloudFrontLogEntry], bool] | None = None
+    extractor: Callable[[CloudFrontLogEntry], tuple[Any, ...] | None] | None = None
+
+    def __post_init__(self) -> None:
+        if not self.name.isidentifier():
+            raise ValueError(f"metric name must be an identifier: {self.name}")
+        if not self.key:
+            raise ValueError(f"metric {self.name} needs at least one key")
+        used = set(self.where) | ({self.sum} if self.sum else set())
+        if self.extractor is None:  # with an extractor, key names its values, not log fields
+            used |= set(self.key)
+        unknown = used - _ENTRY_FIELDS
+        if unknown:
+            raise ValueError(f"unknown log fields in metric {self.name}: {', '.join(sorted(unknown))}")
+        if self.time_bucket is not None and self.time_bucket not in BUCKET_WIDTHS:
+            raise ValueError(f"time bucket of metric {self.name} must be one of {', '.join(BUCKET_WIDTHS)}")
+        if self.columns is not None and len(self.columns) != len(self.key):
+            raise ValueError(f"metric {self.name} needs one column name per key field")
+        if any(not c or '"' in c for c in self.key_columns):
+            raise ValueError(f"column names of metric {self.name} must be non-empty and without double quotes")
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> MetricSpec:
+        """create a spec from a table of a metrics file."""
+        return cls(
+            name=d["name"],
+            key=tuple(d["key"]),
+            where={k: tuple(v) if isinstance(v, list) else (v,) for k, v in d.get("where", {}).items()},
+            time_bucket=d.get("time_bucket"),
+            sum=d.get("sum"),
+            columns=tuple(d["columns"]) if "columns" in d else None,
+        )
+
+    @property
+    def key_columns(self) -> tuple[str, ...]:
+        """the names of the key columns."""
+        return self.columns or self.key
+
+    @property
+    def value_column(self) -> str:
+        """the name of the count column."""
+        return "Sum" if self.sum else "Count"
+
+    @property
+    def value_type(self) -> str:
+        """the SQL type of the count column."""
+        return "DOUBLE" if self.sum in _FLOAT_FIELDS else "BIGINT"
+
+
+# the default metrics of the metrics log type
+DEFAULT_METRIC_SPECS = (
+    MetricSpec("status_trend", key=("sc_status",), time_bucket="1d", columns=("Status",)),
+    MetricSpec("tls_trend", key=("ssl_protocol",), time_bucket="1d", columns=("Protocol",)),
+)
+
+
+def load_metric_specs(path: Path) -> tuple[MetricSpec, ...]:
+    """
+    Read metric specs from a TOML file of [[metric]] tables, e.g.
+
+    .. code-block:: toml
+
+        [[metric]]
+        name = "html_status"
+        key = ["x_edge_location", "sc_status"]
+        time_bucket = "6h"
+        where = { sc_content_type = ["text/html"] }
+
+    :param path: the TOML file
+    :type path: Path
+    :return: the metric specs
+    :rtype: tuple[MetricSpec, ...]
+    :raises ImportError: on python < 3.11 without tomli
+    :raises ValueError: if a spec is invalid
+    """
+    if tomllib is None:
+        raise ImportError("reading metric specs requires python 3.11 or tomli, pip install tomli")
+    with open(path, "rb") as f:
+        specs = tuple(MetricSpec.from_dict(d) for d in tomllib.load(f).get("metric", []))
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate metric names in {path}")
+    return specs
+
+
+def _matcher(spec: MetricSpec) -> Callable[[CloudFrontLogEntry], bool] | None:
+    """one function checking all conditions of spec, or None if it accepts every entry."""
+    checks = [(attrgetter(name), frozenset(values)) for name, values in spec.where.items()]
+    predicate = spec.predicate
+    if not checks and predicate is None:
+        return None
+
+    def match(entry: CloudFrontLogEntry) -> bool:
+        return all(get(entry) in values for get, values in checks) and (predicate is None or predicate(entry))
+
+    return match
+
+
+def _key_getter(spec: MetricSpec) -> Callable[[CloudFrontLogEntry], tuple[str, ...] | None]:
+    if spec.extractor is not None:
+        extract = spec.extractor
+
+        def key(entry: CloudFrontLogEntry) -> tuple[str, ...] | None:
+            values = extract(entry)
+            return None if values is None else tuple("N/A" if v is None else str(v) for v in values)
+
+        return key
+    get = attrgetter(*spec.key)
+    if len(spec.key) == 1:
+        return lambda entry: ("N/A" if (v := get(entry)) is None else str(v),)
+    return lambda entry: tuple("N/A" if v is None else str(v) for v in get(entry))
+
+
+class MetricEngine(Aggregator):
+    """
+    Count many metric specs in one pass over the log entries.
+
+    The specs are compiled once: each where clause becomes one matcher shared by the specs with the same
+    conditions, key fields become attribute getters unless a spec has its own extractor, and the time bucket of
+    each width is computed at most once per entry. feed then runs a single loop over the compiled specs, so
+    another metric costs a few dictionary updates per entry, not another pass over the logs. The snapshot tables
+    are named after the specs.
+    """
+
+    def __init__(self, specs: Iterable[MetricSpec] = DEFAULT_METRIC_SPECS) -> None:
+        self.specs = tuple(specs)
+        self.counts: dict[str, Counter[tuple]] = {spec.name: Counter() for spec in self.specs}
+        matchers: dict[Any, Callable[[CloudFrontLogEntry], bool] | None] = {}
+        self._widths = sorted({BUCKET_WIDTHS[s.time_bucket] for s in self.specs if s.time_bucket})
+        self._compiled = []
+        for spec in self.specs:
+            where = (tuple(sorted(spec.where.items())), spec.predicate)
+            if where not in matchers:
+                matchers[where] = _matcher(spec)
+            width = self._widths.index(BUCKET_WIDTHS[spec.time_bucket]) if spec.time_bucket else None
+            value = attrgetter(spec.sum) if spec.sum else None
+            self._compiled.append((matchers[where], _key_getter(spec), width, value, self.counts[spec.name]))
+
+    def feed(self, entry: CloudFrontLogEntry) -> None:
+        epoch = None
+        buckets: list[datetime.datetime | None] = [None] * len(self._widths)
+        matched: dict[Callable, bool] = {}
+        for match, key, width, value, counts in self._compiled:
+            if match is not None:
+                ok = matched.get(match)
+                if ok is None:
+                    ok = matched[match] = match(entry)
+                if not ok:
+                    continue
+            k = key(entry)
+            if k is None:
+                continue
+            if width is not None:
+                t = buckets[width]
+                if t is None:
+                    if epoch is None:
+                        epoch = entry.epoch
+                    t = buckets[width] = time_bucket(epoch, self._widths[width])
+                k = (t, *k)
+            counts[k] += 1 if value is None else value(entry) or 0
+
+    def merge(self, other: MetricEngine) -> MetricEngine:
+        if [s.name for s in other.specs] != [s.name for s in self.specs]:
+            raise ValueError("cannot merge engines of different metrics")
+        for name, counts in other.counts.items():
+            self.counts[name].update(counts)
+        return self
+
+    def snapshot(self) -> dict[str, Rows]:
+        tables = {}
+        for spec in self.specs:
+            columns = (("TimeBucket",) if spec.time_bucket else ()) + spec.key_columns + (spec.value_column,)
+            tables[spec.name] = [dict(zip(columns, (*k, n))) for k, n in sorted(self.counts[spec.name].items())]
+        return tables
+
+
+def _table(spec: MetricSpec) -> str:
+    return f"metric_{spec.name}"
+
+
+def load_metrics(conn: DuckDBPyConnection, csv_file: Path, specs: Iterable[MetricSpec]) -> None:
+    """create a table per metric and load it from its csv file next to csv_file."""
+    for spec in specs:
+        file = csv_file.parent / f"{spec.name}.csv"
+        keys = (["TimeBucket TIMESTAMP"] if spec.time_bucket else []) + [f'"{c}" VARCHAR' for c in spec.key_columns]
+        conn.execute(f"""DROP TABLE IF EXISTS {_table(spec)};""")
+        conn.execute(
+            f"""
+            CREATE TABLE {_table(spec)} (
+            {", ".join(keys)},
+            "{spec.value_column}" {spec.value_type},
+            PRIMARY KEY ({", ".join(k.split(" ")[0] for k in keys)})
+        );"""
+        )
+        header = ",".join((["TimeBucket"] if spec.time_bucket else []) + [*spec.key_columns, spec.value_column])
+        if file.exists() and file.stat().st_size > len(header) + 1:  # more than the header
+            conn.execute(
+                f"""
+                COPY {_table(spec)}
+                FROM '{file}'
+                WITH (FORMAT CSV, DELIMITER ',', HEADER);"""
+            )
+
+
+def _merge_metrics(conn: DuckDBPyConnection, engine: MetricEngine) -> None:
+    """merge the counts of engine into the metric tables"""
+    for spec in engine.specs:
+        counts = engine.counts[spec.name]
+        if not counts:
+            continue
+        keys = (["TimeBucket"] if spec.time_bucket else []) + [f'"{c}"' for c in spec.key_columns]
+        value = f'"{spec.value_column}"'
+        conn.executemany(
+            f"""
+            INSERT INTO {_table(spec)} ({", ".join(keys)}, {value}) values ({", ".join("?" * (len(keys) + 1))})
+            ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {value} = {_table(spec)}.{value} + EXCLUDED.{value};""",
+            [(*k, n) for k, n in counts.items()],
+        )
+
+
+def ingest_metrics(conn: DuckDBPyConnection, entries: Iterable[CloudFrontLogEntry], specs: Iterable[MetricSpec]):
+    """count the metrics of log entries in one pass and merge them in one transaction."""
+    engine = MetricEngine(specs).feed_batch(entries)
+    conn.execute("BEGIN TRANSACTION;")
+    _merge_metrics(conn, engine)
+    conn.execute("COMMIT;")
+
+
+def save_metrics(conn: DuckDBPyConnection, csv_file: Path, specs: Iterable[MetricSpec], compress: bool = False) -> None:
+    """publish each metric into its csv file, and the number of rows and the total of each metric into csv_file."""
+    specs = tuple(specs)
+    with publish(compress) as pub:
+        for spec in specs:
+            order = ", ".join((["TimeBucket"] if spec.time_bucket else []) + [f'"{c}"' for c in spec.key_columns])
+            pub.copy(conn, f"SELECT * FROM {_table(spec)} ORDER BY {order}", csv_file.parent / f"{spec.name}.csv")
+        summary = " UNION ALL ".join(
+            f"""SELECT '{spec.name}' AS Metric, COUNT(*) AS Rows, COALESCE(SUM("{spec.value_column}"), 0) AS Total
+            FROM {_table(spec)}"""
+            for spec in specs
+        )
+        pub.copy(conn, f"SELECT * FROM ({summary}) ORDER BY Metric", csv_file)
+
+
+@contextmanager
+def _metrics(
+    csv_file: Path, specs: Iterable[MetricSpec], compress: bool = False
+) -> Generator[DuckDBPyConnection, Any, None]:
+    """
+    load and save the metrics of specs next to csv_file.
+    The files are published together only if the processing succeeds.
+    """
+    conn = duckdb.connect(":memory:")
+    try:
+        load_metrics(conn, csv_file, specs)
+        yield conn
+        save_metrics(conn, csv_file, specs, compress)
+    finally:
+        conn.close()
+
+
+@timing
+def parse_metrics_logs(
+    log_folder: Path | str,
+    csv_file: Path = METRICS_CSV,
+    specs: Iterable[MetricSpec] = DEFAULT_METRIC_SPECS,
+    compress: bool = False,
+) -> None:
+    """
+    parse cloudfront log files and count declarative metrics in one pass.
+
+    :param log_folder: the parent folder path of log files (compressed by gzip), or an s3://bucket/prefix URL
+    :type log_folder: Path | str
+    :param csv_file: the summary csv file, each metric is written to <name>.csv beside it, default to METRICS_CSV
+    :type csv_file: Path
+    :param specs: the metrics, default to DEFAULT_METRIC_SPECS
+    :type specs: Iterable[MetricSpec]
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :return: None
+    :raises Exception: if log_folder does not exist, not a directory.
+                       if csv_file is not a file
+    """
+    specs = tuple(specs)
+    with _metrics(csv_file, specs, compress) as conn:
+        ingest_metrics(conn, read_logs(log_folder), specs)
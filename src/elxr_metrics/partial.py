@@ -0,0 +1,298 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to count log shards into partial aggregate files and reduce them into the csv files"""
+
+from __future__ import annotations
+
+import datetime
+import gzip
+import json
+import logging
+from pathlib import Path
+from typing import Any, Iterable, NamedTuple
+
+from elxr_metrics.aggregate import Aggregator
+from elxr_metrics.bot import DEFAULT_CLASSIFIER, BotClassifier
+from elxr_metrics.cloudfront_log import DEFAULT_BUCKET_WIDTH, CloudFrontLogEntry
+from elxr_metrics.completion import DEFAULT_COMPLETION
+from elxr_metrics.dedup import DEDUP_WINDOW
+from elxr_metrics.elapsed import timing
+from elxr_metrics.elxr_image import ImageAggregator, image_line_filter, merge_image_download, popular_image
+from elxr_metrics.elxr_org_trend import (
+    CountryAggregator,
+    TrendAggregator,
+    merge_elxr_org,
+    merge_geo,
+    trend_line_filter,
+    view_bucket,
+    view_trend,
+)
+from elxr_metrics.elxr_package import (
+    PackageAggregator,
+    merge_package_download,
+    package_line_filter,
+    popular_package,
+)
+from elxr_metrics.export import publish
+from elxr_metrics.log_source import read_logs
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_FORMAT = "elxr-metrics-partial"
+PARTIAL_VERSION = 2
+PARTIAL_LOG_TYPES = ("elxr_org_view", "package_download", "image_download")
+
+
+class Partial(NamedTuple):
+    """
+    the counts of a shard of logs, before they are added to the csv files.
+
+    The aggregators keep what the csv files lose, e.g. the users of each time bucket instead of their number, so
+    partials of any split of the logs merge into the same counts. options are the counting options, which must be
+    the same for partials to merge.
+    """
+
+    log_type: str
+    options: dict[str, Any]
+    aggregators: tuple[Aggregator, ...]
+
+    def merge(self, other: Partial) -> Partial:
+        """
+        add the counts of other, and return the partial.
+
+        :raises ValueError: if other is of another log type or was counted with other options
+        """
+        if (other.log_type, other.options) != (self.log_type, self.options):
+            raise ValueError(
+                f"cannot merge partials of {other.log_type} {other.options} into {self.log_type} {self.options}"
+            )
+        for mine, theirs in zip(self.aggregators, other.aggregators):
+            mine.merge(theirs)
+        return self
+
+
+def _trend_state(trend: TrendAggregator, geo: CountryAggregator) -> dict[str, Any]:
+    return {
+        "views": sorted([t.isoformat(), n] for t, n in trend.views.items()),
+        "users": sorted([t.isoformat(), sorted(ips)] for t, ips in trend.users.items()),
+        "bot_views": sorted([t.isoformat(), n] for t, n in trend.bot_views.items()),
+        "bot_users": sorted([t.isoformat(), sorted(ips)] for t, ips in trend.bot_users.items()),
+        "country": sorted([*key, n] for key, n in geo.country.items()),
+        "country_trend": sorted([t.isoformat(), code, name, n] for (t, code, name), n in geo.country_trend.items()),
+        "city": sorted(([*key, n] for key, n in geo.city.items()), key=lambda row: [str(v) for v in row]),
+    }
+
+
+def _trend_aggregators(state: dict[str, Any], options: dict[str, Any]) -> tuple[Aggregator, ...]:
+    trend = TrendAggregator(bucket_width=options["bucket_width"])
+    geo = CountryAggregator(bucket_width=options["bucket_width"])
+    t = datetime.datetime.fromisoformat
+    trend.views.update({t(s): n for s, n in state["views"]})
+    trend.users.update({t(s): set(ips) for s, ips in state["users"]})
+    trend.bot_views.update({t(s): n for s, n in state["bot_views"]})
+    trend.bot_users.update({t(s): set(ips) for s, ips in state["bot_users"]})
+    geo.country.update({(code, name): n for code, name, n in state["country"]})
+    geo.country_trend.update({(t(s), code, name): n for s, code, name, n in state["country_trend"]})
+    geo.city.update({tuple(row[:-1]): row[-1] for row in state["city"]})
+    return trend, geo
+
+
+def _package_state(package: PackageAggregator) -> dict[str, Any]:
+    return {
+        "downloads": sorted(([*deb, n] for deb, n in package.downloads.items()), key=lambda row: [str(v) for v in row]),
+        "bots": sorted([name, n] for (name,), n in package.bots.items()),
+    }
+
+
+def _package_aggregators(state: dict[str, Any], _: dict[str, Any]) -> tuple[Aggregator, ...]:
+    package = PackageAggregator()
+    package.downloads.update({(name, version, arch): n for name, version, arch, n in state["downloads"]})
+    package.bots.update({(name,): n for name, n in state["bots"]})
+    return (package,)
+
+
+def _image_state(image: ImageAggregator) -> dict[str, Any]:
+    return {"downloads": sorted([name, n] for name, n in image.downloads.items())}
+
+
+def _image_aggregators(state: dict[str, Any], options: dict[str, Any]) -> tuple[Aggregator, ...]:
+    image = ImageAggregator(options["completion"], options["dedup_window"])
+    image.downloads.update(dict(state["downloads"]))
+    return (image,)
+
+
+def _state(partial: Partial) -> dict[str, Any]:
+    if partial.log_type == "elxr_org_view":
+        return _trend_state(*partial.aggregators)  # type: ignore[arg-type]
+    if partial.log_type == "package_download":
+        return _package_state(*partial.aggregators)  # type: ignore[arg-type]
+    return _image_state(*partial.aggregators)  # type: ignore[arg-type]
+
+
+_AGGREGATORS = {
+    "elxr_org_view": _trend_aggregators,
+    "package_download": _package_aggregators,
+    "image_download": _image_aggregators,
+}
+
+
+def write_partial(partial: Partial, partial_file: Path) -> None:
+    """
+    write a partial into a gzip compressed JSON file, tagged with the format and its version.
+
+    Values are sorted and the gzip header has no time stamp, so the same counts always give the same bytes.
+    """
+    document = {
+        "format": PARTIAL_FORMAT,
+        "version": PARTIAL_VERSION,
+        "log_type": partial.log_type,
+        "options": partial.options,
+        "state": _state(partial),
+    }
+    data = json.dumps(document, separators=(",", ":")).encode()
+    with publish() as pub:
+        pub.write_bytes(partial_file, gzip.compress(data, mtime=0))
+
+
+def read_partial(partial_file: Path) -> Partial:
+    """
+    read a partial written by write_partial.
+
+    :raises ValueError: if the file is not a partial, or of another version
+    """
+    data = partial_file.read_bytes()
+    try:
+        document = json.loads(gzip.decompress(data))
+    except (OSError, EOFError, ValueError) as e:  # not gzip, truncated or not JSON
+        raise ValueError(f"not a partial aggregate file: {partial_file}") from e
+    if not isinstance(document, dict) or document.get("format") != PARTIAL_FORMAT:
+        raise ValueError(f"not a partial aggregate file: {partial_file}")
+    if document.get("version") != PARTIAL_VERSION:
+        raise ValueError(f"unsupported partial version {document.get('version')}: {partial_file}")
+    log_type, options = document["log_type"], document["options"]
+    if log_type not in _AGGREGATORS:
+        raise ValueError(f"unsupported log type {log_type}: {partial_file}")
+    return Partial(log_type, options, _AGGREGATORS[log_type](document["state"], options))
+
+
+def _count_trend(entries: Iterable[CloudFrontLogEntry], trend: TrendAggregator, geo: CountryAggregator) -> None:
+    for entry in entries:
+        t = view_bucket(entry, trend.bucket_width)
+        if t is not None and trend.add(t, entry):
+            geo.add(t, entry.c_ip)
+
+
+@timing
+def map_logs(  # pylint: disable=too-many-arguments
+    log_folder: Path | str,
+    partial_file: Path,
+    log_type: str,
+    city_db: Path | None = None,
+    classifier: BotClassifier = DEFAULT_CLASSIFIER,
+    dedup_window: float = DEDUP_WINDOW,
+    completion: float = DEFAULT_COMPLETION,
+    bucket_width: int = DEFAULT_BUCKET_WIDTH,
+) -> None:
+    """
+    count a shard of log files into a partial aggregate file, to be reduced with the partials of the other shards.
+
+    Image downloads still in progress at the end of the shard are judged on the bytes fetched so far, and the dedup
+    window does not span shards, so shards are best split at quiet hours.
+
+    :param log_folder: the folder of the log files of the shard, or an s3://bucket/prefix URL
+    :type log_folder: Path | str
+    :param partial_file: the partial aggregate file to write
+    :type partial_file: Path
+    :param log_type: one of PARTIAL_LOG_TYPES
+    :type log_type: str
+    :param city_db: a MaxMind City database to also count views by city for elxr_org_view, default to None
+    :type city_db: Path | None
+    :param classifier: the classifier of bot traffic, default to user agent only
+    :type classifier: BotClassifier
+    :param dedup_window: seconds within which repeated image requests count once, default to DEDUP_WINDOW
+    :type dedup_window: float
+    :param completion: fraction of an image a client must fetch to count a download, default to DEFAULT_COMPLETION
+    :type completion: float
+    :param bucket_width: seconds per time bucket of elxr_org_view, default to 6 hours
+    :type bucket_width: int
+    :return: None
+    :raises ValueError: if log_type is not one of PARTIAL_LOG_TYPES
+    """
+    if log_type == "elxr_org_view":
+        line_filter = trend_line_filter()
+        trend = TrendAggregator(classifier, bucket_width)
+        geo = CountryAggregator(city_db, bucket_width)
+        _count_trend(read_logs(log_folder, line_filter=line_filter), trend, geo)
+        options = {"bucket_width": bucket_width, "city": city_db is not None, "bot_networks": classifier.identity}
+        partial = Partial(log_type, options, (trend, geo))
+    elif log_type == "package_download":
+        line_filter = package_line_filter()
+        package = PackageAggregator(classifier).feed_batch(read_logs(log_folder, line_filter=line_filter))
+        partial = Partial(log_type, {"bot_networks": classifier.identity}, (package,))
+    elif log_type == "image_download":
+        line_filter = image_line_filter()
+        image = ImageAggregator(completion, dedup_window).feed_batch(read_logs(log_folder, line_filter=line_filter))
+        partial = Partial(log_type, {"completion": completion, "dedup_window": dedup_window}, (image.flush(),))
+    else:
+        raise ValueError(f"{log_type} has no partial aggregates")
+    line_filter.report()
+    write_partial(partial, partial_file)
+
+
+@timing
+def reduce_partials(
+    partial_files: Iterable[Path],
+    csv_file: Path,
+    compress: bool = False,
+    index_files: list[Path] | None = None,
+    city_db: Path | None = None,
+) -> None:
+    """
+    merge partial aggregate files and add their counts into csv_file and its sibling files.
+
+    The merge adds counts and unites the users of each time bucket, so it is associative and commutative: the csv
+    files are the same however the logs were split into shards, and the same as counting all logs in one run.
+
+    :param partial_files: the partial aggregate files, all of the same log type and options
+    :type partial_files: Iterable[Path]
+    :param csv_file: the path of the csv file of the log type
+    :type csv_file: Path
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param index_files: Debian index files to roll up package downloads by source package, default to None
+    :type index_files: list[Path] | None
+    :param city_db: for elxr_org_view partials counted with a City database, any path to also write city.csv,
+                    default to None
+    :type city_db: Path | None
+    :return: None
+    :raises ValueError: if there is no partial, or they cannot be merged
+    """
+    merged: Partial | None = None
+    for partial_file in partial_files:
+        partial = read_partial(partial_file)
+        merged = partial if merged is None else merged.merge(partial)
+    if merged is None:
+        raise ValueError("no partial aggregate file to reduce")
+    if merged.log_type == "elxr_org_view":
+        trend, geo = merged.aggregators
+        with view_trend(csv_file, compress, city_db, merged.options["bucket_width"]) as conn:
+            conn.execute("BEGIN TRANSACTION;")
+            merge_elxr_org(conn, trend)  # type: ignore[arg-type]
+            merge_geo(conn, geo)  # type: ignore[arg-type]
+            conn.execute("COMMIT;")
+    elif merged.log_type == "package_download":
+        (package,) = merged.aggregators
+        with popular_package(csv_file, index_files, compress) as conn:
+            conn.execute("BEGIN TRANSACTION;")
+            merge_package_download(conn, package.downloads, package.bots)  # type: ignore[attr-defined]
+            conn.execute("COMMIT;")
+    else:
+        (image,) = merged.aggregators
+        with popular_image(csv_file, compress) as conn:
+            conn.execute("BEGIN TRANSACTION;")
+            merge_image_download(conn, image.downloads)  # type: ignore[attr-defined]
+            conn.execute("COMMIT;")
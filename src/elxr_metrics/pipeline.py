@@ -0,0 +1,127 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to look up the load, ingest and save steps of each log type"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple
+
+from duckdb import DuckDBPyConnection
+
+from elxr_metrics.bot import DEFAULT_CLASSIFIER, BotClassifier
+from elxr_metrics.cloudfront_log import DEFAULT_BUCKET_WIDTH, CloudFrontLogEntry, LineFilter
+from elxr_metrics.completion import DEFAULT_COMPLETION
+from elxr_metrics.dedup import DEDUP_WINDOW
+from elxr_metrics.edge_performance import ingest_edge, load_edge, save_edge
+from elxr_metrics.elxr_image import ImageAggregator, image_line_filter, ingest_image, load_image, save_image
+from elxr_metrics.elxr_org_trend import TrendAggregator, ingest_trend, load_trend, save_trend, trend_line_filter
+from elxr_metrics.elxr_package import ingest_package, load_package, package_line_filter, save_package
+from elxr_metrics.metric import DEFAULT_METRIC_SPECS, MetricSpec, ingest_metrics, load_metrics, save_metrics
+
+LOG_TYPES = ("elxr_org_view", "package_download", "image_download", "edge_performance", "metrics")
+
+
+class Pipeline(NamedTuple):
+    """
+    steps to keep the metrics of one log type in a DuckDB connection.
+
+    load creates and fills the tables from the csv files and returns a state, ingest counts log entries into
+    the tables, and save publishes the tables with the last state and returns the state for the next save.
+    line_filter, if any, drops raw log lines ingest would not count before they are parsed. flush, if any,
+    counts what ingest still holds back for later entries, e.g. image downloads in progress, at the end of the logs.
+    """
+
+    load: Callable[[DuckDBPyConnection], Any]
+    ingest: Callable[[DuckDBPyConnection, Iterable[CloudFrontLogEntry]], None]
+    save: Callable[[DuckDBPyConnection, Any], Any]
+    line_filter: LineFilter | None = None
+    flush: Callable[[DuckDBPyConnection], None] | None = None
+
+
+def get_pipeline(
+    log_type: str,
+    csv_file: Path,
+    compress: bool = False,
+    index_files: list[Path] | None = None,
+    city_db: Path | None = None,
+    classifier: BotClassifier = DEFAULT_CLASSIFIER,
+    dedup_window: float = DEDUP_WINDOW,
+    completion: float = DEFAULT_COMPLETION,
+    metric_specs: Iterable[MetricSpec] = DEFAULT_METRIC_SPECS,
+    bucket_width: int = DEFAULT_BUCKET_WIDTH,
+) -> Pipeline:
+    """
+    Get the pipeline of a log type, bound to its csv file and options.
+
+    :param log_type: one of LOG_TYPES
+    :type log_type: str
+    :param csv_file: the csv file to load and store
+    :type csv_file: Path
+    :param compress: also write pre-compressed .gz/.br files, default to False
+    :type compress: bool
+    :param index_files: Debian index files for package_download, default to None
+    :type index_files: list[Path] | None
+    :param city_db: a MaxMind City database for elxr_org_view, default to None
+    :type city_db: Path | None
+    :param classifier: the classifier of bot traffic, default to user agent only
+    :type classifier: BotClassifier
+    :param dedup_window: seconds within which repeated image requests count once, default to DEDUP_WINDOW
+    :type dedup_window: float
+    :param completion: fraction of an image a client must fetch to count a download, default to DEFAULT_COMPLETION
+    :type completion: float
+    :param metric_specs: the metrics counted for metrics, default to DEFAULT_METRIC_SPECS
+    :type metric_specs: Iterable[MetricSpec]
+    :param bucket_width: seconds per time bucket of elxr_org_view and edge_performance, default to 6 hours
+    :type bucket_width: int
+    :return: the pipeline
+    :rtype: Pipeline
+    :raises ValueError: if log_type is unknown
+    """
+    if log_type == "elxr_org_view":
+        trend = TrendAggregator(classifier, bucket_width)  # kept across ingests, a user may view in two batches
+
+        def load(conn: DuckDBPyConnection) -> None:
+            trend.restore(TrendAggregator(classifier, bucket_width))  # the csv files hold the published open buckets
+            load_trend(conn, csv_file, bucket_width)
+
+        return Pipeline(
+            load,
+            lambda conn, entries: ingest_trend(conn, entries, trend, city_db),
+            lambda conn, _: save_trend(conn, csv_file, compress, city_db, trend),
+            trend_line_filter(),
+        )
+    if log_type == "package_download":
+        return Pipeline(
+            lambda conn: load_package(conn, csv_file, index_files),
+            lambda conn, entries: ingest_package(conn, entries, classifier),
+            lambda conn, loaded: save_package(conn, csv_file, loaded, index_files, compress),
+            package_line_filter(),
+        )
+    if log_type == "image_download":
+        aggregator = ImageAggregator(completion, dedup_window)  # kept across ingests, a download may span two files
+        return Pipeline(
+            lambda conn: load_image(conn, csv_file),
+            lambda conn, entries: ingest_image(conn, entries, aggregator),
+            lambda conn, loaded: save_image(conn, csv_file, loaded, compress),
+            image_line_filter(),
+            lambda conn: ingest_image(conn, (), aggregator, flush=True),
+        )
+    if log_type == "edge_performance":
+        return Pipeline(
+            lambda conn: load_edge(conn, csv_file),
+            lambda conn, entries: ingest_edge(conn, entries, bucket_width),
+            lambda conn, _: save_edge(conn, csv_file, compress),
+        )
+    if log_type == "metrics":
+        specs = tuple(metric_specs)
+        return Pipeline(
+            lambda conn: load_metrics(conn, csv_file, specs),
+            lambda conn, entries: ingest_metrics(conn, entries, specs),
+            lambda conn, _: save_metrics(conn, csv_file, specs, compress),
+        )
+    raise ValueError(f"unknown log type: {log_type}")
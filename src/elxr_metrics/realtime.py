@@ -0,0 +1,320 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to ingest CloudFront real-time log records from a stream and update metrics in micro-batches"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import queue
+import socket
+import stat
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import Field, fields
+from functools import lru_cache
+from pathlib import Path
+from typing import IO, Callable, Generator, Iterable
+
+import duckdb
+
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry, to_object
+from elxr_metrics.interrupt import interrupt_on_sigterm
+from elxr_metrics.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+# all fields of a real-time log configuration, in the order CloudFront lists them
+DEFAULT_FIELD_ORDER = (
+    "timestamp",
+    "c-ip",
+    "time-to-first-byte",
+    "sc-status",
+    "sc-bytes",
+    "cs-method",
+    "cs-protocol",
+    "cs-host",
+    "cs-uri-stem",
+    "cs-bytes",
+    "x-edge-location",
+    "x-edge-request-id",
+    "x-host-header",
+    "time-taken",
+    "cs-protocol-version",
+    "c-ip-version",
+    "cs-user-agent",
+    "cs-referer",
+    "cs-cookie",
+    "cs-uri-query",
+    "x-edge-response-result-type",
+    "x-forwarded-for",
+    "ssl-protocol",
+    "ssl-cipher",
+    "x-edge-result-type",
+    "fle-encrypted-fields",
+    "fle-status",
+    "sc-content-type",
+    "sc-content-len",
+    "sc-range-start",
+    "sc-range-end",
+    "c-port",
+    "x-edge-detailed-result-type",
+    "c-country",
+    "cs-accept-encoding",
+    "cs-accept",
+    "cache-behavior-path-pattern",
+    "cs-headers",
+    "cs-header-names",
+    "cs-headers-count",
+)
+_RENAMED = {"cs-referer": "cs_referrer"}  # real-time names that differ from the standard log fields
+_EOF = object()
+
+
+def load_field_order(path: Path) -> tuple[str, ...]:
+    """
+    Read the field order of a real-time log configuration, the field names separated by commas or white space.
+
+    Lines starting with # are comments, e.g. the field list copied from the CloudFront console:
+
+    .. code-block:: text
+
+        # realtime config of mirror.elxr.dev
+        timestamp, c-ip, sc-status, sc-bytes, cs-uri-stem, sc-content-type
+
+    :param path: the configuration file
+    :type path: Path
+    :return: the field names
+    :rtype: tuple[str, ...]
+    :raises ValueError: if there is no timestamp field or a field is listed twice
+    """
+    names = []
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if not line.lstrip().startswith("#"):
+            names.extend(name.strip().lower() for name in line.replace(",", " ").split())
+    if "timestamp" not in names:
+        raise ValueError(f"no timestamp field in {path}")
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate fields in {path}")
+    return tuple(names)
+
+
+@lru_cache(maxsize=4096)
+def _date_time(second: int) -> tuple[datetime.date, datetime.time]:
+    t = datetime.datetime.fromtimestamp(second, datetime.timezone.utc)
+    return t.date(), t.time().replace(tzinfo=datetime.timezone.utc)
+
+
+class RealtimeParser:  # pylint: disable=too-few-public-methods
+    """
+    Map real-time log records onto CloudFrontLogEntry by a field order.
+
+    The columns are matched to the entry fields once; the timestamp, in seconds since the epoch, becomes the date
+    and time of the entry, and fields without an entry field, e.g. c-country, are skipped.
+    """
+
+    def __init__(self, field_order: Iterable[str] = DEFAULT_FIELD_ORDER) -> None:
+        self.field_order = tuple(field_order)
+        model_fields = {f.name: f for f in fields(CloudFrontLogEntry)}
+        self._columns: list[tuple[int, Field]] = []
+        self._timestamp = self.field_order.index("timestamp")
+        for i, name in enumerate(self.field_order):
+            f = model_fields.get(_RENAMED.get(name, name.replace("-", "_")))
+            if f is not None and f.name not in ("date", "time"):
+                self._columns.append((i, f))
+        skipped = len(self.field_order) - len(self._columns) - 1
+        if skipped:
+            logger.debug("%d real-time fields have no entry field and are skipped", skipped)
+
+    def __call__(self, line: str) -> CloudFrontLogEntry:
+        col = line.rstrip("\r\n").split("\t")
+        if len(col) != len(self.field_order):
+            raise ValueError(f"expected {len(self.field_order)} fields, got {len(col)}")
+        date, time_ = _date_time(int(float(col[self._timestamp])))
+        values = {f.name: to_object(col[i], f) for i, f in self._columns}
+        return CloudFrontLogEntry(date=date, time=time_, **values)
+
+
+@contextmanager
+def open_stream(location: str) -> Generator[IO[bytes], None, None]:
+    """
+    Open a stream of real-time log records.
+
+    :param location: "-" for stdin, a Unix socket to connect to, or a named pipe or file to read
+    :type location: str
+    :return: the binary stream
+    :rtype: IO[bytes]
+    """
+    if location == "-":
+        yield sys.stdin.buffer
+        return
+    if stat.S_ISSOCK(os.stat(location).st_mode):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(location)
+            with sock.makefile("rb") as stream:
+                yield stream
+        return
+    with open(location, "rb") as stream:
+        yield stream
+
+
+class StreamIngester:
+    """
+    Ingest real-time log records into a long lived DuckDB connection in micro-batches.
+
+    Records are read by a thread into a bounded queue. A batch is ingested once it has batch_size records or
+    batch_interval seconds after its first record, and ingested counts are published every publish_interval
+    seconds, so a record shows in the csv files at most batch_interval + publish_interval seconds after it was
+    read. A record that cannot be parsed is logged and skipped.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        pipeline: Pipeline,
+        parser: RealtimeParser | None = None,
+        batch_size: int = 10_000,
+        batch_interval: float = 5.0,
+        publish_interval: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.pipeline = pipeline
+        self.parser = parser or RealtimeParser()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.publish_interval = publish_interval
+        self.clock = clock
+        self.conn = duckdb.connect(":memory:")
+        self.state = pipeline.load(self.conn)
+        self.records = 0
+        self.skipped = 0
+        self._pending = False
+        self._last_publish = clock()
+
+    def _parse(self, lines: list[bytes]) -> Generator[CloudFrontLogEntry, None, None]:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                entry = self.parser(line.decode("utf-8"))
+            except ValueError as e:
+                self.skipped += 1
+                logger.warning("skip real-time record: %s", e)
+                continue
+            self.records += 1
+            yield entry
+
+    def ingest(self, lines: list[bytes]) -> None:
+        """ingest a batch of records in one transaction."""
+        try:
+            self.pipeline.ingest(self.conn, self._parse(lines))
+        except Exception:  # pylint: disable=broad-except
+            try:
+                self.conn.rollback()
+            except duckdb.TransactionException:  # failed before the transaction began
+                pass
+            logger.exception("failed to ingest a batch of %d records, skip it", len(lines))
+            return
+        self._pending = True
+
+    def publish(self) -> None:
+        """publish ingested counts."""
+        if self._pending:
+            self.state = self.pipeline.save(self.conn, self.state)
+            self._pending = False
+            logger.info("published %d real-time records, skipped %d", self.records, self.skipped)
+        self._last_publish = self.clock()
+
+    def run(self, stream: IO[bytes]) -> None:
+        """ingest the records of stream until it ends, then publish pending counts."""
+        lines: queue.Queue = queue.Queue(maxsize=4 * self.batch_size)
+        reader = threading.Thread(target=_read_lines, args=(stream, lines), name="realtime-reader", daemon=True)
+        reader.start()
+        batch: list[bytes] = []
+        started = 0.0
+        done = False
+        while not done:
+            now = self.clock()
+            due = [self._last_publish + self.publish_interval]
+            if batch:
+                due.append(started + self.batch_interval)
+            try:
+                item = lines.get(timeout=max(0.0, min(due) - now))
+            except queue.Empty:
+                item = None
+            if item is _EOF:
+                done = True
+            elif isinstance(item, BaseException):
+                raise item
+            elif item is not None:
+                if not batch:
+                    started = self.clock()
+                batch.append(item)
+            now = self.clock()
+            if batch and (done or len(batch) >= self.batch_size or now - started >= self.batch_interval):
+                self.ingest(batch)
+                batch = []
+            if done or now - self._last_publish >= self.publish_interval:
+                self.publish()
+
+    def close(self) -> None:
+        """publish pending counts and close the connection."""
+        try:
+            self.publish()
+        finally:
+            self.conn.close()
+
+
+def _read_lines(stream: IO[bytes], out: queue.Queue) -> None:
+    """put the lines of stream into out, then _EOF, or the error of reading."""
+    try:
+        for line in stream:
+            out.put(line)
+        out.put(_EOF)
+    except Exception as e:  # pylint: disable=broad-except
+        out.put(e)
+
+
+def ingest_stream(  # pylint: disable=too-many-arguments
+    location: str,
+    pipeline: Pipeline,
+    field_order: Iterable[str] = DEFAULT_FIELD_ORDER,
+    batch_size: int = 10_000,
+    batch_interval: float = 5.0,
+    publish_interval: float = 60.0,
+) -> None:
+    """
+    Ingest CloudFront real-time log records from a stream and keep the metrics of pipeline up to date.
+
+    It runs until the stream ends or it is interrupted; SIGINT and SIGTERM stop it after publishing pending counts.
+
+    :param location: "-" for stdin, a Unix socket to connect to, or a named pipe or file to read
+    :type location: str
+    :param pipeline: the pipeline of the log type
+    :type pipeline: Pipeline
+    :param field_order: the fields of a record, in the order of the real-time log configuration
+    :type field_order: Iterable[str]
+    :param batch_size: the most records ingested at once, default to 10000
+    :type batch_size: int
+    :param batch_interval: the most seconds a record waits to be ingested, default to 5
+    :type batch_interval: float
+    :param publish_interval: seconds between publishing the csv files, default to 60
+    :type publish_interval: float
+    :return: None
+    """
+    with interrupt_on_sigterm():
+        ingester = StreamIngester(pipeline, RealtimeParser(field_order), batch_size, batch_interval, publish_interval)
+        logger.info("reading real-time log records from %s", location)
+        try:
+            with open_stream(location) as stream:
+                ingester.run(stream)
+        except KeyboardInterrupt:
+            logger.info("stop reading %s", location)
+        finally:
+            ingester.close()
@@ -0,0 +1,105 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to estimate metrics from a deterministic sample of log lines"""
+
+from __future__ import annotations
+
+import logging
+from pathlib import Path
+
+from duckdb import DuckDBPyConnection
+
+from elxr_metrics.export import publish
+
+logger = logging.getLogger(__name__)
+
+# the field hashed to sample the lines of each log type: unique users and image downloads, which follow one
+# client across requests, need all requests of a client, the other counts one request at a time
+SAMPLE_FIELDS = {
+    "elxr_org_view": "c_ip",
+    "package_download": "x_edge_request_id",
+    "image_download": "c_ip",
+}
+ESTIMATE_DIR = "estimated"
+ESTIMATE_CSV = "estimate.csv"
+Z_95 = 1.96
+
+# counted tables of a pipeline: table name to its key columns and count columns
+Counts = dict[str, tuple[tuple[str, ...], tuple[str, ...]]]
+
+
+def estimated_csv(csv_file: Path) -> Path:
+    """
+    the csv file to write the estimates of csv_file to, of the same name in an estimated folder next to it.
+
+    The sibling files of the pipeline go to the same folder, so estimates never replace or mix with exact counts.
+    The folder is created by the publish of the estimates, so a failed run does not leave it behind empty.
+    """
+    return csv_file.parent / ESTIMATE_DIR / csv_file.name
+
+
+def clear_counts(conn: DuckDBPyConnection, counts: Counts) -> None:
+    """delete the rows loaded into the counted tables, so an estimate covers the sampled log lines only."""
+    for table in counts:
+        conn.execute(f"DELETE FROM {table};")
+
+
+def _interval(n: str, rate: float) -> str:
+    """SQL of the estimate and the low and high ends of its 95% confidence interval, of a sampled count n."""
+    margin = f"{Z_95} * sqrt({n} * {1 - rate!r})"
+    return (
+        f"CAST(ROUND({n} / {rate!r}) AS BIGINT) AS Estimate, "
+        f"CAST(GREATEST({n}, ROUND(({n} - {margin}) / {rate!r})) AS BIGINT) AS Low, "
+        f"CAST(ROUND(({n} + {margin}) / {rate!r}) AS BIGINT) AS High"
+    )
+
+
+def scale_counts(conn: DuckDBPyConnection, counts: Counts, rate: float, csv_file: Path) -> None:
+    """
+    scale sampled counts up to estimates, and publish their 95% confidence intervals into estimate.csv.
+
+    Called within the publish of the estimated csv files, estimate.csv joins it and is published with them.
+
+    A count n of sampled units, each kept with probability rate, is estimated as n / rate with a standard error of
+    sqrt(n * (1 - rate)) / rate; the interval never goes below n. The units are lines, or clients when sampled by
+    c_ip, so the intervals of counts of many lines per client, e.g. views, are narrower than their true spread.
+
+    :param conn: the connection with the counted tables
+    :type conn: DuckDBPyConnection
+    :param counts: the counted tables, with their key and count columns
+    :type counts: Counts
+    :param rate: the sample rate, in (0, 1]
+    :type rate: float
+    :param csv_file: the estimated csv file, estimate.csv is written next to it
+    :type csv_file: Path
+    :return: None
+    """
+    selects = []
+    for table, (keys, columns) in counts.items():
+        key = "concat_ws('/', " + ", ".join(f"CAST({k} AS VARCHAR)" for k in keys) + ")"
+        selects.extend(f"SELECT '{table}.{c}' AS Metric, {key} AS Key, {c} AS n FROM {table}" for c in columns)
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE estimate AS
+        SELECT Metric, Key, n AS Sampled, {_interval("n", rate)}
+        FROM ({" UNION ALL ".join(selects)});"""
+    )
+    totals = conn.execute(
+        f"""
+        SELECT Metric, Sampled, {_interval("Sampled", rate)}
+        FROM (SELECT Metric, SUM(Sampled) AS Sampled FROM estimate GROUP BY Metric) ORDER BY Metric"""
+    ).fetchall()
+    for metric, n, estimate, low, high in totals:
+        logger.info("estimated %s: %d (95%% CI %d - %d) from %d sampled", metric, estimate, low, high, n)
+    for table, (_, columns) in counts.items():
+        conn.execute(f"UPDATE {table} SET " + ", ".join(f"{c} = ROUND({c} / {rate!r})" for c in columns) + ";")
+    with publish() as pub:
+        pub.copy(
+            conn,
+            "SELECT * FROM estimate ORDER BY Metric ASC, Estimate DESC, Key ASC",
+            csv_file.parent / ESTIMATE_CSV,
+        )
@@ -0,0 +1,72 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to estimate quantiles of a stream of values without keeping the values"""
+
+from __future__ import annotations
+
+import math
+from collections import Counter
+
+RELATIVE_ACCURACY = 0.01
+
+
+class DDSketch:
+    """
+    A DDSketch quantile sketch: counts of values in logarithmic bins.
+
+    Bin i holds the values in (gamma^(i-1), gamma^i], gamma = (1 + a) / (1 - a), so every quantile is estimated
+    within relative accuracy a of a value of the stream. Two sketches of the same accuracy merge by adding their
+    bin counts, which is how sketches are kept in tables and combined across runs. Values below min_value,
+    e.g. a time to first byte of 0, fall into the bin of min_value.
+    """
+
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY, min_value: float = 1e-6) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.bins: Counter[int] = Counter()
+        self.count = 0
+
+    def key(self, value: float) -> int:
+        """the bin of a value."""
+        return math.ceil(math.log(max(value, self.min_value)) / self._log_gamma)
+
+    def value(self, key: int) -> float:
+        """the estimate of the values in a bin, within relative accuracy of each of them."""
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> None:
+        """add count occurrences of value."""
+        self.bins[self.key(value)] += count
+        self.count += count
+
+    def merge(self, other: DDSketch) -> None:
+        """add the values of another sketch of the same accuracy."""
+        if other.gamma != self.gamma:
+            raise ValueError("cannot merge sketches of different accuracy")
+        self.bins.update(other.bins)
+        self.count += other.count
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimate a quantile.
+
+        :param q: the quantile, from 0 to 1
+        :type q: float
+        :return: the estimate, or None if the sketch is empty
+        :rtype: float | None
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.bins))  # pragma: no cover
@@ -0,0 +1,181 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+"""module to watch a log folder and update metrics continuously"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import time
+from itertools import chain
+from pathlib import Path
+from typing import Callable
+
+import duckdb
+
+from elxr_metrics.cloudfront_log import is_log_file, log_file_time, parse_cloudfront_log
+from elxr_metrics.interrupt import interrupt_on_sigterm
+from elxr_metrics.pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    """
+    Ingest new log files of a folder into a long lived DuckDB connection.
+
+    The connection, the loaded tables and the lookup caches stay warm between files. A file is ingested once its
+    size is the same on two polls, so files still being copied are left for the next poll; new files are ingested
+    in the order of the hour in their CloudFront file name. Ingested counts are published after no new file
+    arrived for debounce seconds, or at the latest max_delay seconds after the first unpublished file.
+    """
+
+    def __init__(
+        self,
+        log_folder: Path,
+        pipeline: Pipeline,
+        debounce: float = 60.0,
+        max_delay: float | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.log_folder = log_folder
+        self.pipeline = pipeline
+        self.debounce = debounce
+        self.max_delay = max_delay if max_delay is not None else 10 * debounce
+        self.clock = clock
+        self.conn = duckdb.connect(":memory:")
+        self.state = pipeline.load(self.conn)
+        self._sizes: dict[Path, int] = {}  # size of pending files on the last poll
+        self._done: set[Path] = set()
+        self._first_pending: float | None = None  # when the first unpublished file was ingested
+        self._last_ingest = 0.0
+        self.latest: datetime.datetime | None = None  # the latest hour of ingested log files
+
+    def poll(self) -> list[Path]:
+        """
+        find settled new log files.
+
+        :return: new files whose size did not change since the last poll, ordered by their log hour
+        :rtype: list[Path]
+        """
+        settled = []
+        sizes = {}
+        children = {child for child in self.log_folder.iterdir() if is_log_file(child.name)}
+        self._done &= children  # forget removed files
+        for child in children:
+            if child in self._done:
+                continue
+            try:
+                size = child.stat().st_size
+            except FileNotFoundError:  # removed after listing
+                continue
+            if self._sizes.get(child) == size:
+                settled.append(child)
+            else:
+                sizes[child] = size
+        self._sizes = sizes
+        epoch = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        return sorted(settled, key=lambda f: (log_file_time(f) or epoch, f.name))
+
+    def ingest(self, files: list[Path]) -> None:
+        """ingest files in one transaction; if it fails, ingest them one by one to skip the broken file."""
+        try:
+            line_filter = self.pipeline.line_filter
+            entries = chain.from_iterable(parse_cloudfront_log(f, line_filter) for f in files)
+            self.pipeline.ingest(self.conn, entries)
+        except Exception:  # pylint: disable=broad-except
+            try:
+                self.conn.rollback()
+            except duckdb.TransactionException:  # failed before the transaction began
+                pass
+            if len(files) > 1:
+                for f in files:
+                    self.ingest([f])
+                return
+            logger.exception("failed to ingest %s, skip it", files[0])
+        else:
+            for f in files:
+                hour = log_file_time(f)
+                if hour and (self.latest is None or hour > self.latest):
+                    self.latest = hour
+            logger.info("ingested %d files, latest log hour %s", len(files), self.latest)
+        self._done.update(files)
+
+    def flush(self) -> None:
+        """publish ingested counts."""
+        self.state = self.pipeline.save(self.conn, self.state)
+        self._first_pending = None
+
+    def step(self) -> bool:
+        """
+        poll and ingest new files once, then flush if it is due.
+
+        :return: whether the counts were published
+        :rtype: bool
+        """
+        files = self.poll()
+        now = self.clock()
+        if files:
+            self.ingest(files)
+            self._last_ingest = now
+            if self._first_pending is None:
+                self._first_pending = now
+        if self._first_pending is not None and (
+            now - self._last_ingest >= self.debounce or now - self._first_pending >= self.max_delay
+        ):
+            self.flush()
+            return True
+        return False
+
+    def close(self) -> None:
+        """publish pending counts and close the connection."""
+        try:
+            if self._first_pending is not None:
+                self.flush()
+        finally:
+            self.conn.close()
+
+
+def watch(
+    log_folder: Path,
+    pipeline: Pipeline,
+    poll_interval: float = 10.0,
+    debounce: float = 60.0,
+    cycles: int | None = None,
+) -> None:
+    """
+    Watch log_folder and keep the metrics of pipeline up to date until interrupted.
+
+    Files already in the folder are ingested on the first polls, the same as a one-shot run.
+    SIGINT and SIGTERM stop the loop after publishing pending counts.
+
+    :param log_folder: the folder receiving log files (compressed by gzip)
+    :type log_folder: Path
+    :param pipeline: the pipeline of the log type
+    :type pipeline: Pipeline
+    :param poll_interval: seconds between polls, default to 10
+    :type poll_interval: float
+    :param debounce: seconds without new files before publishing, default to 60
+    :type debounce: float
+    :param cycles: stop after this number of polls, default to None (run until interrupted)
+    :type cycles: int | None
+    :return: None
+    """
+    with interrupt_on_sigterm():
+        watcher = Watcher(log_folder, pipeline, debounce)
+        logger.info("watching %s every %.0f seconds", log_folder, poll_interval)
+        try:
+            n = 0
+            while cycles is None or n < cycles:
+                watcher.step()
+                n += 1
+                if cycles is None or n < cycles:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logger.info("stop watching %s", log_folder)
+        finally:
+            watcher.close()
@@ -0,0 +1,103 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics import aggregate, elxr_org_trend
+from elxr_metrics.cloudfront_log import parse_cloudfront_log
+from elxr_metrics.elxr_image import ImageAggregator, parse_downloads_elxr_dev_logs
+from elxr_metrics.elxr_org_trend import CountryAggregator, TrendAggregator
+from elxr_metrics.elxr_package import PackageAggregator, parse_mirror_elxr_dev_logs
+
+LOGS = Path(__file__).parent / "logs"
+
+
+def _files(folder: str) -> list[Path]:
+    return sorted((LOGS / folder).glob("*.gz"))
+
+
+def test_package_aggregator_matches_csv(tmp_path):
+    """test the snapshot of a package aggregator holds the numbers of the csv files"""
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(LOGS / "mirror_elxr_dev", csv_file)
+    aggregator = PackageAggregator()
+    for f in _files("mirror_elxr_dev"):
+        aggregator.feed_batch(parse_cloudfront_log(f))
+    snapshot = aggregator.snapshot()
+    assert [tuple(row.values()) for row in snapshot["package_stats"]] == duckdb.read_csv(csv_file).fetchall()
+    detail = duckdb.read_csv(tmp_path / "package_stats_detail.csv").fetchall()
+    assert [tuple(row.values()) for row in snapshot["package_stats_detail"]] == detail
+
+
+def test_package_aggregator_merge():
+    """test aggregators of different files merge into the aggregator of all files"""
+    whole = PackageAggregator()
+    parts = []
+    for f in _files("mirror_elxr_dev"):
+        whole.feed_batch(parse_cloudfront_log(f))
+        parts.append(PackageAggregator().feed_batch(parse_cloudfront_log(f)))
+    merged = parts[0]
+    for part in parts[1:]:
+        merged.merge(part)
+    assert merged.snapshot() == whole.snapshot()
+
+
+def test_image_aggregator(tmp_path):
+    """test the image aggregator counts the same downloads as the csv file"""
+    csv_file = tmp_path / "image_stats.csv"
+    parse_downloads_elxr_dev_logs(LOGS / "downloads_elxr_dev", csv_file)
+    aggregator = ImageAggregator()
+    for f in _files("downloads_elxr_dev"):
+        aggregator.feed_batch(parse_cloudfront_log(f))
+    rows = [tuple(row.values()) for row in aggregator.flush().snapshot()["image_stats"]]
+    assert rows == duckdb.read_csv(csv_file).fetchall()
+    assert aggregator.merge(ImageAggregator().merge(aggregator)).snapshot()["image_stats"][0]["Download"] == 6
+
+
+def test_trend_aggregator_merge_unique_users():
+    """test merged trend aggregators count a user seen by both once"""
+    entries = [e for f in _files("elxr_org") for e in parse_cloudfront_log(f)]
+    whole = TrendAggregator().feed_batch(entries)
+    merged = TrendAggregator().feed_batch(entries[::2]).merge(TrendAggregator().feed_batch(entries[1::2]))
+    assert merged.snapshot() == whole.snapshot()
+    assert {
+        "TimeBucket": datetime.datetime(2074, 9, 22, 18, 0),
+        "ViewCount": 3,
+        "UniqueUser": 2,
+    } in whole.snapshot()["elxr_org_view"]
+
+
+def test_country_aggregator(mocker):
+    """test country aggregator counts views by country and city"""
+    mocker.patch.object(elxr_org_trend, "_country_lookup", return_value=("CA", "Canada"))
+    mocker.patch.object(elxr_org_trend, "_city_lookup", return_value=("CA", "Ontario", "Ottawa", 45.4, -75.7))
+    entries = [e for f in _files("elxr_org") for e in parse_cloudfront_log(f)]
+    snapshot = CountryAggregator(Path("GeoLite2-City.mmdb")).feed_batch(entries).snapshot()
+    assert snapshot["country"] == [{"Code": "CA", "Name": "Canada", "Count": 8}]
+    assert [row["Count"] for row in snapshot["country_trend"]] == [1, 1, 3, 3]
+    assert snapshot["city"][0]["City"] == "Ottawa"
+    assert "city" not in CountryAggregator().snapshot()
+
+
+def test_to_arrow(monkeypatch):
+    """test Arrow results, and the error without pyarrow"""
+    pyarrow = pytest.importorskip("pyarrow")
+    aggregator = PackageAggregator()
+    for f in _files("mirror_elxr_dev"):
+        aggregator.feed_batch(parse_cloudfront_log(f))
+    tables = aggregator.to_arrow()
+    assert isinstance(tables["package_stats"], pyarrow.Table)
+    assert tables["package_stats"].column_names == ["Name", "Download"]
+    assert tables["package_stats"].num_rows == len(aggregator.snapshot()["package_stats"])
+    monkeypatch.setattr(aggregate, "pyarrow", None)
+    with pytest.raises(ImportError):
+        aggregator.to_arrow()
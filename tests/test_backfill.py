@@ -0,0 +1,110 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import shutil
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.backfill import backfill, load_checkpoint
+from elxr_metrics.elxr_image import parse_downloads_elxr_dev_logs
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.log_source import LocalLogSource
+from elxr_metrics.pipeline import get_pipeline
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+
+
+@pytest.fixture
+def expected(tmp_path) -> list[tuple]:
+    csv_file = tmp_path / "expected" / "package_stats.csv"
+    csv_file.parent.mkdir()
+    parse_mirror_elxr_dev_logs(LOGS, csv_file)
+    return duckdb.read_csv(csv_file).fetchall()
+
+
+def test_local_log_source():
+    """test local files are listed by name"""
+    source = LocalLogSource(LOGS)
+    keys = sorted(source.keys())
+    assert keys == sorted(f.name for f in LOGS.glob("*.gz"))
+    assert len(list(source.entries(keys[:1]))) < len(list(source.entries()))
+
+
+def test_backfill(tmp_path, expected):
+    """test chunked backfill gives the same counts as a one-shot run, and a rerun skips counted files"""
+    csv_file = tmp_path / "package_stats.csv"
+    checkpoint = tmp_path / "backfill.json"
+    pipeline = get_pipeline("package_download", csv_file)
+    backfill(LocalLogSource(LOGS), pipeline, checkpoint, chunk_size=1)
+    assert duckdb.read_csv(csv_file).fetchall() == expected
+    assert load_checkpoint(checkpoint) == {f.name for f in LOGS.glob("*.gz")}
+
+    os.utime(csv_file, (0, 0))
+    backfill(LocalLogSource(LOGS), pipeline, checkpoint, chunk_size=1)
+    assert csv_file.stat().st_mtime == 0
+
+
+def test_backfill_image(tmp_path):
+    """test backfill judges the image downloads still in progress after the last chunk, as a one-shot run does"""
+    logs = tmp_path / "logs"
+    shutil.copytree(LOGS.parent / "downloads_elxr_dev", logs)
+    with gzip.open(logs / "ZZZ1XBIQMJAA6.2024-10-31-03.61e13cf5.gz", "rt") as f:
+        lines = f.readlines()
+    header, first = lines[:2], lines[2].split("\t")
+    # a range request of the last hour, judged only at the end of the logs
+    first[1], first[3], first[4], first[7], first[8] = "09:00:00", "1000", "10.0.0.1", "/elxr-cloud.qcow2", "206"
+    first[-3:] = ["-", "0", "999\n"]
+    with gzip.open(logs / "ZZZ1XBIQMJAA6.2024-10-31-09.00000000.gz", "wt") as f:
+        f.writelines([*header, "\t".join(first)])
+    (tmp_path / "expected").mkdir()
+    parse_downloads_elxr_dev_logs(logs, tmp_path / "expected" / "image_stats.csv")
+    expected = duckdb.read_csv(tmp_path / "expected" / "image_stats.csv").fetchall()
+    assert ("elxr-cloud.qcow2", 1) in expected
+    csv_file = tmp_path / "image_stats.csv"
+    backfill(LocalLogSource(logs), get_pipeline("image_download", csv_file), tmp_path / "backfill.json", chunk_size=1)
+    assert duckdb.read_csv(csv_file).fetchall() == expected
+
+
+def test_backfill_compressed(tmp_path):
+    """test backfill writes the pre-compressed siblings of a compressing pipeline, but not of its checkpoint"""
+    csv_file = tmp_path / "package_stats.csv"
+    checkpoint = tmp_path / "backfill.json"
+    backfill(LocalLogSource(LOGS), get_pipeline("package_download", csv_file, compress=True), checkpoint)
+    assert (tmp_path / "package_stats.csv.gz").exists()
+    assert (tmp_path / "package_top_10.csv.gz").exists()
+    assert not (tmp_path / "backfill.json.gz").exists()
+
+
+def test_backfill_resume(tmp_path, expected):
+    """test an interrupted backfill keeps the finished chunks and resumes after them"""
+    logs = tmp_path / "logs"
+    shutil.copytree(LOGS, logs)
+    csv_file = tmp_path / "package_stats.csv"
+    checkpoint = tmp_path / "backfill.json"
+    pipeline = get_pipeline("package_download", csv_file)
+    calls = []
+
+    def ingest(conn, entries):
+        calls.append(1)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        pipeline.ingest(conn, entries)
+
+    with pytest.raises(KeyboardInterrupt):
+        backfill(LocalLogSource(logs), pipeline._replace(ingest=ingest), checkpoint, chunk_size=1)
+    first = json.loads(checkpoint.read_text())["done"]
+    assert len(first) == 1
+    assert duckdb.read_csv(csv_file).fetchall() != expected
+
+    backfill(LocalLogSource(logs), pipeline, checkpoint, chunk_size=1)
+    assert duckdb.read_csv(csv_file).fetchall() == expected
@@ -0,0 +1,85 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import pickle
+
+import pytest
+
+from elxr_metrics.bot import BotClassifier, is_bot_agent
+
+
+@pytest.mark.parametrize(
+    "user_agent, bot",
+    [
+        (None, True),
+        ("", True),
+        ("Mozilla/5.0 (compatible; CensysInspect/1.1; +https://about.censys.io/)", True),
+        ("Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko; compatible; bingbot/2.0)", True),
+        ("Googlebot-Image/1.0", True),
+        ("curl/8.5.0", True),
+        ("Wget/1.21.3", True),
+        ("python-requests/2.32.3", True),
+        ("Mozilla/5.0 (X11; Linux x86_64; rv:130.0) Gecko/20100101 Firefox/130.0", False),
+        ("Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0", False),
+        ("Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)", True),
+        ("Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)", True),
+        ("TelegramBot (like TwitterBot)", True),
+        ("WhatsApp/2.23.20.0 A", True),
+        ("Mozilla/5.0 (Windows NT 6.1; WOW64) SkypeUriPreview Preview/0.5 skype-url-preview@microsoft.com", True),
+        ("Mozilla/5.0+(compatible; UptimeRobot/2.0; http://www.uptimerobot.com/)", True),
+        ("masscan/1.3 (https://github.com/robertdavidgraham/masscan)", True),
+        ("Debian APT-HTTP/1.3 (2.6.1)", False),
+        (
+            "Mozilla/5.0 (Linux; Android 12; CUBOT KINGKONG 7 Build/SP1A.210812.016) AppleWebKit/537.36 "
+            "(KHTML, like Gecko) Chrome/120.0.6099.144 Mobile Safari/537.36",
+            False,
+        ),
+        (
+            "Mozilla/5.0 (Linux; Android 10; Cubot_Note_20 Build/QP1A.190711.020; wv) AppleWebKit/537.36 "
+            "(KHTML, like Gecko) Version/4.0 Chrome/119.0.6045.163 Mobile Safari/537.36",
+            False,
+        ),
+        (
+            "Mozilla/5.0 (Linux; Android 9; ROBOT Build/PPR1.180610.011) AppleWebKit/537.36 "
+            "(KHTML, like Gecko) Chrome/114.0.5735.196 Safari/537.36",
+            False,
+        ),
+        (
+            "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+            "Mobile/15E148 [FBAN/MessengerLiteForiOS;FBAV/438.0.0.31.107;FBBV/544658396;FBDV/iPhone14,5]",
+            False,
+        ),
+    ],
+)
+def test_is_bot_agent(user_agent, bot):
+    """test classifying user agents"""
+    assert is_bot_agent(user_agent) is bot
+
+
+def test_bot_networks(tmp_path):
+    """test classifying client networks"""
+    networks = tmp_path / "bots.txt"
+    networks.write_text("# CI runners\n10.0.0.0/8\n\n2001:db8::/32  # lab\n")
+    classifier = BotClassifier.from_file(networks)
+    apt = "Debian APT-HTTP/1.3 (2.6.1)"
+    assert classifier.is_bot(apt, "10.1.2.3")
+    assert classifier.is_bot(apt, "2001:db8::1")
+    assert not classifier.is_bot(apt, "11.1.2.3")
+    assert not classifier.is_bot(apt, None)
+    assert not classifier.is_bot(apt, "-")
+    assert classifier.is_bot("curl/8.5.0", "11.1.2.3")
+    assert not BotClassifier().is_bot(apt, "10.1.2.3")
+
+
+def test_bot_classifier_pickle():
+    """test a classifier sent to another process keeps its networks"""
+    classifier = BotClassifier(["10.0.0.0/8"])
+    assert classifier.is_bot("Mozilla/5.0", "10.1.2.3")
+    copy = pickle.loads(pickle.dumps(classifier))
+    assert copy.identity == classifier.identity
+    assert copy.is_bot("Mozilla/5.0", "10.1.2.3") and not copy.is_bot("Mozilla/5.0", "192.168.1.1")
@@ -0,0 +1,61 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+
+from elxr_metrics.completion import DownloadTracker, _Coverage
+
+T0 = datetime.datetime(2024, 10, 31, 3, tzinfo=datetime.timezone.utc)
+ISO = "elxr-12.6.1.0-amd64-CD-1.iso"
+
+
+def _at(seconds: float) -> datetime.datetime:
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+def test_coverage_merge():
+    """test byte intervals are merged when they overlap or touch"""
+    coverage = _Coverage()
+    for start, end in [(100, 200), (300, 400), (0, 50), (150, 250), (250, 300), (500, 600)]:
+        coverage.add(start, end)
+    assert list(zip(coverage.starts, coverage.ends)) == [(0, 50), (100, 400), (500, 600)]
+    assert coverage.covered == 450
+    coverage.add(0, 1000)
+    assert list(zip(coverage.starts, coverage.ends)) == [(0, 1000)]
+    assert coverage.covered == 1000
+
+
+def test_tracker_parallel_segments():
+    """test parallel segments of a client count one download once the confirmed size is covered"""
+    tracker = DownloadTracker(completion=0.9)
+    assert not tracker.add(ISO, "a", 0, 100, _at(0), size=1000)  # an aborted whole response confirms the size
+    assert not tracker.add(ISO, "a", 500, 1000, _at(1))
+    assert tracker.add(ISO, "b", 0, 1000, _at(2)) == [(ISO, "b", _at(2))]
+    assert tracker.add(ISO, "a", 100, 400, _at(3)) == [(ISO, "a", _at(3))]
+    assert len(tracker) == 0
+
+
+def test_tracker_stale():
+    """test a stale partial download is judged on the largest byte end seen, then dropped"""
+    tracker = DownloadTracker(completion=0.9, stale_after=60)
+    assert not tracker.add(ISO, "a", 0, 950, _at(0))
+    assert not tracker.add(ISO, "b", 0, 500, _at(10))
+    assert not tracker.add(ISO, "c", 900, 1000, _at(20))
+    assert tracker.add(ISO, "d", 0, 10, _at(65)) == [(ISO, "a", _at(0))]
+    assert tracker.add(ISO, "d", 10, 20, _at(100)) == []
+    assert len(tracker) == 1
+    assert tracker.flush() == []
+    assert len(tracker) == 0
+
+
+def test_tracker_max_keys():
+    """test memory is bounded by max_keys"""
+    tracker = DownloadTracker(max_keys=3)
+    for i in range(10):
+        tracker.add(ISO, i, 0, 10, _at(i))
+        assert len(tracker) <= 3
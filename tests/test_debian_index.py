@@ -0,0 +1,82 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import gzip
+import os
+from pathlib import Path
+
+import duckdb
+
+from elxr_metrics.debian_index import load_source_map, parse_index
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+
+PACKAGES = """Package: libglib2.0-0
+Source: glib2.0 (2.74.6-2+deb12u3)
+Version: 2.74.6-2+deb12u3
+Architecture: amd64
+
+Package: linux-image-imx-arm64
+Source: linux-imx-signed-arm64
+Version: 6.1.99-elxr2-2
+Architecture: arm64
+
+Package: curl
+Version: 7.88.1-10
+Architecture: arm64
+"""
+
+SOURCES = """Package: linux-imx-signed-arm64
+Binary: linux-image-6.1.0-23-imx-arm64,
+ linux-image-imx-arm64
+Version: 6.1.99-elxr2-2
+"""
+
+
+def test_parse_index():
+    """test parsing Packages and Sources stanzas"""
+    assert list(parse_index(PACKAGES.splitlines(keepends=True))) == [
+        ("libglib2.0-0", "glib2.0"),
+        ("linux-image-imx-arm64", "linux-imx-signed-arm64"),
+        ("curl", "curl"),
+    ]
+    assert list(parse_index(SOURCES.splitlines(keepends=True))) == [
+        ("linux-image-6.1.0-23-imx-arm64", "linux-imx-signed-arm64"),
+        ("linux-image-imx-arm64", "linux-imx-signed-arm64"),
+    ]
+
+
+def test_load_source_map_cache(tmp_path, conn):
+    """test the parsed index is cached in parquet and reused"""
+    index = tmp_path / "Packages.gz"
+    with gzip.open(index, "wt", encoding="utf-8") as f:
+        f.write(PACKAGES)
+    load_source_map(conn, [index])
+    cache = tmp_path / "Packages.gz.srcmap.parquet"
+    assert cache.exists()
+    assert conn.execute("SELECT Source FROM source_map WHERE Package = 'libglib2.0-0'").fetchone() == ("glib2.0",)
+
+    # a cache newer than the index is used without reparsing
+    os.utime(index, (0, 0))
+    index.write_bytes(b"not a gzip file")
+    os.utime(index, (0, 0))
+    conn.execute("DROP TABLE source_map;")
+    load_source_map(conn, [index])
+    assert conn.execute("SELECT COUNT(*) FROM source_map").fetchone() == (3,)
+
+
+def test_parse_package_source(tmp_path):
+    """test rolling up package downloads by source package"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    packages = tmp_path / "Packages"
+    packages.write_text(PACKAGES)
+    sources = tmp_path / "Sources"
+    sources.write_text(SOURCES)
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(path, csv_file, [packages, sources])
+    actual = duckdb.read_csv(tmp_path / "source_package_stats.csv").fetchall()
+    assert actual == [("glib2.0", 3), ("linux-imx-signed-arm64", 3)]
@@ -0,0 +1,51 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+
+from elxr_metrics.dedup import DedupWindow
+
+T0 = datetime.datetime(2024, 10, 31, 3, tzinfo=datetime.timezone.utc)
+
+
+def _at(seconds: float) -> datetime.datetime:
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+def test_dedup_window_slides():
+    """test repeated requests within the window count once, and each request slides the window"""
+    dedup = DedupWindow(window=60)
+    key = ("11.10.92.6", "elxr-12.6.1.0-amd64-CD-1.iso", "Mozilla/5.0")
+    assert not dedup.seen(key, _at(0))
+    assert dedup.seen(key, _at(50))
+    assert dedup.seen(key, _at(100))
+    assert not dedup.seen(key, _at(200))
+    assert not dedup.seen(("11.10.92.7",) + key[1:], _at(200))
+    assert dedup.seen(key, _at(150))  # out of order, within the window of the latest request
+
+
+def test_dedup_window_expires():
+    """test keys expire past the window and memory is bounded by max_keys"""
+    dedup = DedupWindow(window=60, max_keys=3)
+    for i in range(10):
+        assert not dedup.seen(i, _at(i))
+        assert len(dedup) <= 3
+    dedup = DedupWindow(window=60)
+    for i in range(10):
+        dedup.seen(i, _at(i * 30))
+    assert len(dedup) == 3
+
+
+def test_dedup_window_disabled():
+    """test a zero window or a request without time is never a duplicate"""
+    dedup = DedupWindow(window=0)
+    assert not dedup.seen("a", _at(0))
+    assert not dedup.seen("a", _at(0))
+    dedup = DedupWindow()
+    assert not dedup.seen("a", None)
+    assert not dedup.seen("a", None)
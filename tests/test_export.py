@@ -0,0 +1,222 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import gzip
+import os
+from pathlib import Path
+
+import duckdb
+import pytest
+from pytest_mock import MockerFixture
+
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.export import CsvPublisher, brotli, publish, table_checksum
+
+
+def test_publish_changed_and_unchanged(tmp_path, conn):
+    """test changed files are replaced and unchanged files are not rewritten"""
+    same = tmp_path / "same.csv"
+    same.write_text("a\n1\n")
+    os.utime(same, (0, 0))
+    new = tmp_path / "new.csv"
+    with publish() as pub:
+        pub.copy(conn, "SELECT 1 AS a", same)
+        pub.write_text(new, "b\n2\n")
+    assert same.stat().st_mtime == 0
+    assert new.read_text() == "b\n2\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["new.csv", "same.csv"]
+
+
+def test_publish_error_in_block(tmp_path):
+    """test nothing is published if the block raises"""
+    target = tmp_path / "stats.csv"
+    target.write_text("old")
+    with pytest.raises(RuntimeError), publish() as pub:
+        pub.write_text(target, "new")
+        raise RuntimeError("boom")
+    assert target.read_text() == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["stats.csv"]
+
+
+def test_publish_nested(tmp_path):
+    """test a nested publish joins the outer one"""
+    inner, outer = tmp_path / "inner.csv", tmp_path / "outer.json"
+    with publish() as pub:
+        with publish() as nested:
+            assert nested is pub
+            nested.write_text(inner, "inner")
+        assert not inner.exists()
+        pub.write_text(outer, "outer")
+    assert inner.read_text() == "inner" and outer.read_text() == "outer"
+    with pytest.raises(RuntimeError), publish() as pub:
+        with publish() as nested:
+            nested.write_text(inner, "new inner")
+        raise RuntimeError("boom")
+    assert inner.read_text() == "inner"
+
+
+def test_commit_rollback(tmp_path, mocker: MockerFixture):
+    """test replaced files are restored if a later replace fails"""
+    first = tmp_path / "first.csv"
+    first.write_text("old first")
+    second = tmp_path / "second.csv"
+    created = tmp_path / "created.csv"
+    pub = CsvPublisher()
+    pub.write_text(first, "new first")
+    pub.write_text(created, "new created")
+    pub.write_text(second, "new second")
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if Path(dst) == second:
+            raise OSError("disk full")
+        real_replace(src, dst)
+
+    mocker.patch("elxr_metrics.export.os.replace", side_effect=replace)
+    with pytest.raises(OSError):
+        pub.commit()
+    assert first.read_text() == "old first"
+    assert [p.name for p in tmp_path.iterdir()] == ["first.csv"]
+
+
+def test_parse_error_keeps_csv(tmp_path, mocker: MockerFixture):
+    """test a failed run does not touch the published csv files"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    csv_file.write_text("Name,Download\ncurl,1\n")
+    mocker.patch("elxr_metrics.elxr_package.merge_package_download", side_effect=RuntimeError("boom"))
+    with pytest.raises(RuntimeError):
+        parse_mirror_elxr_dev_logs(path, csv_file)
+    assert csv_file.read_text() == "Name,Download\ncurl,1\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["package_stats.csv"]
+
+
+def test_copy_ranked(tmp_path, conn):
+    """test full and top files come from one sorted table"""
+    conn.execute("CREATE TABLE stats AS SELECT 'p' || i::VARCHAR AS Name, i % 7 AS Download FROM range(50) t(i);")
+    full, top = tmp_path / "stats.csv", tmp_path / "top.csv"
+    with publish() as pub:
+        pub.copy_ranked(conn, "stats", "Download DESC, Name ASC", full, top, top_n=3)
+    expected = conn.execute("SELECT * FROM stats ORDER BY Download DESC, Name ASC").fetchall()
+    assert conn.execute(f"SELECT * FROM read_csv('{full}')").fetchall() == expected
+    assert conn.execute(f"SELECT * FROM read_csv('{top}')").fetchall() == expected[:3]
+
+
+def test_table_checksum(conn):
+    """test checksum tracks content, not row order"""
+    conn.execute("CREATE TABLE a (Name VARCHAR, Download INTEGER);")
+    conn.execute("INSERT INTO a VALUES ('x', 1), ('y', 2);")
+    conn.execute("CREATE TABLE b (Name VARCHAR, Download INTEGER);")
+    conn.execute("INSERT INTO b VALUES ('y', 2), ('x', 1);")
+    assert table_checksum(conn, "a") == table_checksum(conn, "b")
+    conn.execute("UPDATE b SET Download = 3 WHERE Name = 'x';")
+    assert table_checksum(conn, "a") != table_checksum(conn, "b")
+
+
+def test_parse_without_change(tmp_path):
+    """test a run without new downloads does not rewrite the csv files"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(path, csv_file)
+    for f in tmp_path.iterdir():
+        os.utime(f, (0, 0))
+    empty = tmp_path / "logs"
+    empty.mkdir()
+    parse_mirror_elxr_dev_logs(empty, csv_file)
+    assert all(f.stat().st_mtime == 0 for f in tmp_path.glob("*.csv"))
+
+
+def test_publish_compressed(tmp_path):
+    """test pre-compressed siblings are written with changed content only"""
+    target = tmp_path / "stats.csv"
+    with publish(compress=True) as pub:
+        pub.write_text(target, "Name,Download\ncurl,1\n")
+    assert gzip.decompress((tmp_path / "stats.csv.gz").read_bytes()) == b"Name,Download\ncurl,1\n"
+    assert brotli.decompress((tmp_path / "stats.csv.br").read_bytes()) == b"Name,Download\ncurl,1\n"
+    for f in tmp_path.iterdir():
+        os.utime(f, (0, 0))
+    with publish(compress=True) as pub:
+        pub.write_text(target, "Name,Download\ncurl,1\n")
+    assert all(f.stat().st_mtime == 0 for f in tmp_path.iterdir())
+
+
+def test_publish_stale_compressed(tmp_path):
+    """test pre-compressed siblings are removed when the file changes without compress, kept when unchanged"""
+    target = tmp_path / "stats.csv"
+    with publish(compress=True) as pub:
+        pub.write_text(target, "Name,Download\ncurl,1\n")
+    with publish() as pub:
+        pub.write_text(target, "Name,Download\ncurl,1\n")
+    assert (tmp_path / "stats.csv.gz").exists()
+    (tmp_path / "stats.csv.br").write_bytes(b"stale")
+    with publish() as pub:
+        pub.write_text(target, "Name,Download\ncurl,2\n")
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["stats.csv"]
+
+
+def test_publish_staged_twice(tmp_path):
+    """test a target staged twice, e.g. by an outer and a nested save, is published with the last content"""
+    target = tmp_path / "stats.csv"
+    target.write_text("old")
+    with publish() as pub:
+        pub.write_text(target, "first")
+        with publish() as nested:
+            nested.write_text(target, "second")
+    assert target.read_text() == "second"
+    assert [p.name for p in tmp_path.iterdir()] == ["stats.csv"]
+
+
+def test_publish_creates_directory(tmp_path):
+    """test missing directories of a target are created, and removed again if the publish fails"""
+    target = tmp_path / "estimated" / "shards" / "2024.json"
+    with pytest.raises(RuntimeError), publish() as pub:
+        pub.write_text(target, "new")
+        raise RuntimeError("boom")
+    assert not (tmp_path / "estimated").exists()
+    with publish() as pub:
+        pub.write_text(target, "new")
+    assert target.read_text() == "new"
+
+
+def test_publish_remove(tmp_path):
+    """test a file staged for removal is removed with its siblings on commit, and kept if the publish fails"""
+    old, new = tmp_path / "2001.json", tmp_path / "2024.json"
+    for f in (old, tmp_path / "2001.json.gz"):
+        f.write_text("old")
+    with pytest.raises(RuntimeError):
+        with publish() as pub:
+            pub.write_text(new, "new")
+            pub.remove(old)
+            raise RuntimeError("boom")
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["2001.json", "2001.json.gz"]
+    with publish() as pub:
+        pub.write_text(new, "new")
+        pub.remove(old)
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["2024.json"]
+
+
+def test_publish_nested_compressed(tmp_path):
+    """test a nested compressed publish compresses its own files, though the outer one does not"""
+    inner, outer = tmp_path / "inner.csv", tmp_path / "outer.json"
+    with publish() as pub:
+        with publish(compress=True):
+            pub.write_text(inner, "inner")
+        pub.write_text(outer, "outer")
+    assert gzip.decompress((tmp_path / "inner.csv.gz").read_bytes()) == b"inner"
+    assert not (tmp_path / "outer.json.gz").exists()
+
+
+def test_parse_package_compressed(tmp_path):
+    """test package stats are also published as compressed csv"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(path, csv_file, compress=True)
+    assert (tmp_path / "package_stats.csv.gz").exists()
+    assert (tmp_path / "package_top_10.csv.gz").exists()
+    assert gzip.decompress((tmp_path / "package_stats.csv.gz").read_bytes()) == csv_file.read_bytes()
+    assert not (tmp_path / "package_stats.parquet").exists()
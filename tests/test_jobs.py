@@ -0,0 +1,64 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import multiprocessing
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+from elxr_metrics.jobs import load_jobs, run_jobs
+
+
+def test_load_jobs(tmp_path):
+    """test jobs are read one per line, split as in a shell"""
+    jobs = tmp_path / "jobs.txt"
+    jobs.write_text(
+        "# log_path csv_path log_type [options]\n"
+        "logs/elxr_org public/elxr_org_view.csv elxr_org_view  # views\n"
+        "\n"
+        "'logs/mirror elxr dev' public/package_stats.csv package_download --compress\n"
+    )
+    assert load_jobs(jobs) == [
+        (2, ["logs/elxr_org", "public/elxr_org_view.csv", "elxr_org_view"]),
+        (4, ["logs/mirror elxr dev", "public/package_stats.csv", "package_download", "--compress"]),
+    ]
+    jobs.write_text("# nothing to run\n")
+    with pytest.raises(ValueError):
+        load_jobs(jobs)
+    jobs.write_text("'logs/elxr_org public/elxr_org_view.csv elxr_org_view\n")
+    with pytest.raises(ValueError, match="jobs.txt:1"):
+        load_jobs(jobs)
+
+
+def _append(path: Path, text: str) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_run_jobs(tmp_path):
+    """test jobs run at once in worker processes, and a failed job does not stop the others"""
+    with multiprocessing.Manager() as manager:
+        barrier = manager.Barrier(2, timeout=5)  # type: ignore[attr-defined]
+        missing = tmp_path / "missing" / "file"
+        results = run_jobs({"a": barrier.wait, "b": barrier.wait, "c": partial(missing.read_text)})
+    assert [r.name for r in results] == ["a", "b", "c"]
+    assert [r.error for r in results[:2]] == [None, None]
+    assert results[2].error.startswith("FileNotFoundError")
+    assert all(r.seconds >= 0 for r in results)
+
+    order = tmp_path / "order.txt"
+    results = run_jobs({"a": partial(_append, order, "a"), "b": partial(_append, order, "b")}, workers=1)
+    assert order.read_text() == "ab"
+    assert not any(r.error for r in results)
+
+
+def test_run_jobs_not_picklable():
+    """test a job that cannot be sent to a worker process fails alone"""
+    results = run_jobs({"a": lambda: None, "b": partial(int, "1")})
+    assert results[0].error is not None and results[1].error is None
@@ -0,0 +1,97 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.log_source import LocalLogSource, S3LogSource, read_logs
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """an in-memory S3 bucket holding the test logs under mirror_elxr_dev/"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="metrics")
+        for f in LOGS.glob("*.gz"):
+            client.upload_file(str(f), "metrics", f"mirror_elxr_dev/{f.name}")
+        client.put_object(Bucket="metrics", Key="mirror_elxr_dev/readme.txt", Body=b"not a log")
+        client.put_object(Bucket="metrics", Key="elxr_org/other.gz", Body=b"")
+        yield client
+
+
+def test_s3_keys(s3):
+    """test listing .gz objects under the prefix page by page"""
+    source = S3LogSource("s3://metrics/mirror_elxr_dev/", client=s3, page_size=1)
+    assert sorted(source.keys()) == sorted(f"mirror_elxr_dev/{f.name}" for f in LOGS.glob("*.gz"))
+
+
+def test_s3_entries(s3):
+    """test streamed entries are the same as the local files"""
+    source = S3LogSource("s3://metrics/mirror_elxr_dev", client=s3, max_workers=2)
+    assert sorted(map(repr, source.entries())) == sorted(map(repr, read_logs(LOGS)))
+
+
+def test_s3_entries_in_time_order(s3):
+    """test objects are read ahead at once but their entries come in the order of the hour of their names"""
+    logs = sorted((LOGS.parent / "elxr_org").glob("*.gz"))
+    for i, f in enumerate(logs):  # the later hour is listed first
+        s3.upload_file(str(f), "metrics", f"ordered/{len(logs) - i}/{f.name}")
+    expected = list(LocalLogSource(logs[0].parent).entries([f.name for f in logs]))
+    assert list(read_logs("s3://metrics/ordered/", max_workers=2)) == expected
+
+
+def test_s3_parse_logs(s3, tmp_path):
+    """test parsing logs from an s3 URL"""
+    expected = tmp_path / "expected.csv"
+    parse_mirror_elxr_dev_logs(LOGS, expected)
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs("s3://metrics/mirror_elxr_dev/", csv_file)
+    assert duckdb.read_csv(csv_file).fetchall() == duckdb.read_csv(expected).fetchall()
+
+
+def test_local_keys(tmp_path):
+    """test listing gzip, zstd and plain log files of a folder"""
+    for name in ("a.gz", "b.zst", "c.log", "readme.txt"):
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "d.log").mkdir()
+    assert sorted(LocalLogSource(tmp_path).keys()) == ["a.gz", "b.zst", "c.log"]
+
+
+def test_s3_broken_object(s3):
+    """test an error of a reader thread is raised to the consumer"""
+    s3.put_object(Bucket="metrics", Key="mirror_elxr_dev/broken.gz", Body=b"not gzip")
+    source = S3LogSource("s3://metrics/mirror_elxr_dev/", client=s3)
+    with pytest.raises(OSError):
+        list(source.entries())
+
+
+def test_s3_close_early(s3):
+    """test closing the generator early stops the readers"""
+    source = S3LogSource("s3://metrics/mirror_elxr_dev/", client=s3, max_workers=1)
+    entries = source.entries()
+    assert next(entries)
+    entries.close()
+
+
+@pytest.mark.parametrize("url", ["metrics/logs", "s3:///logs", "http://metrics/logs"])
+def test_s3_url(url):
+    """test invalid URLs"""
+    with pytest.raises(ValueError):
+        S3LogSource(url, client=object())
@@ -15,7 +15,11 @@ from unittest.mock import MagicMock
 import pytest
 
 import elxr_metrics.__main__
+from elxr_metrics import elxr_image, elxr_org_trend, elxr_package
 from elxr_metrics.__main__ import is_dir, is_file, main
+from elxr_metrics.bot import DEFAULT_CLASSIFIER
+from elxr_metrics.completion import DEFAULT_COMPLETION
+from elxr_metrics.dedup import DEDUP_WINDOW
 
 
 @pytest.mark.parametrize(
@@ -107,7 +111,28 @@ def test_main_elxr_org_view(tmp_path):
     log = Path("tests/logs/elxr_org")
     elxr_metrics.__main__.parse_elxr_org_logs = MagicMock()
     main([str(log), str(csv_file), "elxr_org_view"])
-    elxr_metrics.__main__.parse_elxr_org_logs.assert_called_once_with(log, csv_file)
+    elxr_metrics.__main__.parse_elxr_org_logs.assert_called_once_with(
+        log, csv_file, compress=False, city_db=None, classifier=DEFAULT_CLASSIFIER, bucket_width=21600, sample_rate=1.0
+    )
+
+
+def test_main_city_db(tmp_path):
+    """test main function with a City database"""
+    csv_file = tmp_path / "test.csv"
+    city_db = tmp_path / "GeoLite2-City.mmdb"
+    city_db.touch()
+    log = Path("tests/logs/elxr_org")
+    elxr_metrics.__main__.parse_elxr_org_logs = MagicMock()
+    main([str(log), str(csv_file), "elxr_org_view", "--city-db", str(city_db)])
+    elxr_metrics.__main__.parse_elxr_org_logs.assert_called_once_with(
+        log,
+        csv_file,
+        compress=False,
+        city_db=city_db,
+        classifier=DEFAULT_CLASSIFIER,
+        bucket_width=21600,
+        sample_rate=1.0,
+    )
 
 
 def test_main_mirror_elxr_dev(tmp_path):
@@ -116,7 +141,24 @@ def test_main_mirror_elxr_dev(tmp_path):
     log = Path("tests/logs/mirror_elxr_dev")
     elxr_metrics.__main__.parse_mirror_elxr_dev_logs = MagicMock()
     main([str(log), str(csv_file), "package_download"])
-    elxr_metrics.__main__.parse_mirror_elxr_dev_logs.assert_called_once_with(log, csv_file)
+    elxr_metrics.__main__.parse_mirror_elxr_dev_logs.assert_called_once_with(
+        log, csv_file, index_files=None, compress=False, classifier=DEFAULT_CLASSIFIER, sample_rate=1.0
+    )
+
+
+def test_main_packages_index(tmp_path):
+    """test main function with Debian index files"""
+    csv_file = tmp_path / "test.csv"
+    index = tmp_path / "Packages"
+    index.touch()
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_mirror_elxr_dev_logs = MagicMock()
+    main([str(log), str(csv_file), "package_download", "--packages-index", str(index)])
+    elxr_metrics.__main__.parse_mirror_elxr_dev_logs.assert_called_once_with(
+        log, csv_file, index_files=[index], compress=False, classifier=DEFAULT_CLASSIFIER, sample_rate=1.0
+    )
+    with pytest.raises(SystemExit):
+        main([str(log), str(csv_file), "package_download", "--packages-index", str(tmp_path / "missing")])
 
 
 def test_main_downloads_elxr_dev(tmp_path):
@@ -124,8 +166,207 @@ def test_main_downloads_elxr_dev(tmp_path):
     csv_file = tmp_path / "test.csv"
     log = Path("tests/logs/downloads_elxr_dev")
     elxr_metrics.__main__.parse_downloads_elxr_dev_logs = MagicMock()
-    main([str(log), str(csv_file), "image_download"])
-    elxr_metrics.__main__.parse_downloads_elxr_dev_logs.assert_called_once_with(log, csv_file)
+    main([str(log), str(csv_file), "image_download", "--compress", "--dedup-window", "600", "--completion", "0.5"])
+    elxr_metrics.__main__.parse_downloads_elxr_dev_logs.assert_called_once_with(
+        log, csv_file, compress=True, dedup_window=600.0, completion=0.5, sample_rate=1.0
+    )
+    for completion in ("0", "1.5", "half"):
+        with pytest.raises(SystemExit):
+            main([str(log), str(csv_file), "image_download", "--completion", completion])
+
+
+def test_main_edge_performance(tmp_path):
+    """test main function to parse edge performance"""
+    csv_file = tmp_path / "test.csv"
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_edge_performance_logs = MagicMock()
+    main([str(log), str(csv_file), "edge_performance"])
+    elxr_metrics.__main__.parse_edge_performance_logs.assert_called_once_with(
+        log, csv_file, compress=False, bucket_width=21600
+    )
+
+
+def test_main_metrics(tmp_path):
+    """test main function to count metrics of a config file"""
+    csv_file = tmp_path / "test.csv"
+    config = tmp_path / "metrics.toml"
+    config.write_text('[[metric]]\nname = "status"\nkey = ["sc_status"]\n')
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_metrics_logs = MagicMock()
+    main([str(log), str(csv_file), "metrics", "--metrics-config", str(config)])
+    args = elxr_metrics.__main__.parse_metrics_logs.call_args.args
+    assert args[:2] == (log, csv_file)
+    assert [spec.name for spec in args[2]] == ["status"]
+
+    config.write_text('[[metric]]\nname = "status"\nkey = ["no_such_field"]\n')
+    with pytest.raises(SystemExit):
+        main([str(log), str(csv_file), "metrics", "--metrics-config", str(config)])
+
+
+def test_main_bucket_width(tmp_path):
+    """test main function with a bucket width"""
+    csv_file = tmp_path / "test.csv"
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_edge_performance_logs = MagicMock()
+    main([str(log), str(csv_file), "edge_performance", "--bucket-width", "1h"])
+    elxr_metrics.__main__.parse_edge_performance_logs.assert_called_once_with(
+        log, csv_file, compress=False, bucket_width=3600
+    )
+    with pytest.raises(SystemExit):
+        main([str(log), str(csv_file), "edge_performance", "--bucket-width", "2h"])
+
+
+def test_main_sample(tmp_path):
+    """test main function to estimate metrics from a sample"""
+    csv_file = tmp_path / "test.csv"
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_mirror_elxr_dev_logs = MagicMock()
+    main([str(log), str(csv_file), "package_download", "--sample", "0.01"])
+    assert elxr_metrics.__main__.parse_mirror_elxr_dev_logs.call_args.kwargs["sample_rate"] == 0.01
+    for args in (["package_download", "--sample", "0"], ["edge_performance", "--sample", "0.5"]):
+        with pytest.raises(SystemExit):
+            main([str(log), str(csv_file), *args])
+
+
+def test_main_watch(tmp_path, mocker):
+    """test main function to watch a log directory"""
+    csv_file = tmp_path / "test.csv"
+    log = Path("tests/logs/mirror_elxr_dev")
+    watch = mocker.patch("elxr_metrics.__main__.watch")
+    assert main(["watch", str(log), str(csv_file), "package_download", "--debounce", "300"]) == 0
+    args, kwargs = watch.call_args
+    assert args[0] == log
+    assert kwargs == {"poll_interval": 10.0, "debounce": 300.0}
+
+
+def test_main_stream(tmp_path, mocker):
+    """test main function to ingest real-time logs from stdin"""
+    csv_file = tmp_path / "test.csv"
+    config = tmp_path / "fields.txt"
+    config.write_text("timestamp, c-ip, sc-status, cs-uri-stem\n")
+    ingest_stream = mocker.patch("elxr_metrics.__main__.ingest_stream")
+    args = ["stream", "-", str(csv_file), "package_download", "--field-order", str(config), "--batch-interval", "1"]
+    assert main(args) == 0
+    args, kwargs = ingest_stream.call_args
+    assert args[0] == "-"
+    assert args[2] == ("timestamp", "c-ip", "sc-status", "cs-uri-stem")
+    assert kwargs == {"batch_size": 10000, "batch_interval": 1.0, "publish_interval": 60.0}
+    with pytest.raises(SystemExit):
+        main(["stream", str(tmp_path / "missing.fifo"), str(csv_file), "package_download"])
+    config.write_text("c-ip, sc-status\n")
+    with pytest.raises(SystemExit):
+        main(["stream", "-", str(csv_file), "package_download", "--field-order", str(config)])
+
+
+def test_main_map_reduce(tmp_path, mocker):
+    """test main function to map a shard of logs into a partial and reduce partials"""
+    csv_file = tmp_path / "test.csv"
+    partial = tmp_path / "shard.json.gz"
+    log = Path("tests/logs/downloads_elxr_dev")
+    map_logs = mocker.patch("elxr_metrics.__main__.map_logs")
+    assert main(["map", str(log), str(partial), "image_download", "--completion", "0.5"]) == 0
+    map_logs.assert_called_once_with(
+        log,
+        partial,
+        "image_download",
+        city_db=None,
+        classifier=DEFAULT_CLASSIFIER,
+        dedup_window=DEDUP_WINDOW,
+        completion=0.5,
+        bucket_width=21600,
+    )
+    with pytest.raises(SystemExit):
+        main(["map", str(log), str(partial), "edge_performance"])
+
+    partial.write_bytes(b"")
+    reduce_partials = mocker.patch("elxr_metrics.__main__.reduce_partials")
+    assert main(["reduce", str(csv_file), str(partial), "--compress"]) == 0
+    reduce_partials.assert_called_once_with([partial], csv_file, compress=True, index_files=None, city_db=None)
+    reduce_partials.side_effect = ValueError("cannot merge")
+    with pytest.raises(SystemExit):
+        main(["reduce", str(csv_file), str(partial)])
+
+
+def test_main_run(tmp_path, monkeypatch):
+    """test main function to run the jobs of a jobs file at once, as separate one-shot runs would"""
+    # earlier tests replace the parse functions with mocks, which cannot be sent to a worker process
+    monkeypatch.setattr(elxr_metrics.__main__, "parse_elxr_org_logs", elxr_org_trend.parse_elxr_org_logs)
+    monkeypatch.setattr(elxr_metrics.__main__, "parse_mirror_elxr_dev_logs", elxr_package.parse_mirror_elxr_dev_logs)
+    monkeypatch.setattr(
+        elxr_metrics.__main__, "parse_downloads_elxr_dev_logs", elxr_image.parse_downloads_elxr_dev_logs
+    )
+    runs = [
+        ("tests/logs/elxr_org", "elxr_org_view.csv", "elxr_org_view"),
+        ("tests/logs/mirror_elxr_dev", "package_stats.csv", "package_download"),
+        ("tests/logs/downloads_elxr_dev", "image_stats.csv", "image_download"),
+    ]
+    (tmp_path / "expected").mkdir()
+    (tmp_path / "public").mkdir()
+    for log, csv_name, log_type in runs:
+        assert main([log, str(tmp_path / "expected" / csv_name), log_type]) == 0
+    jobs = tmp_path / "jobs.txt"
+    jobs.write_text("".join(f"{log} {tmp_path / 'public' / csv_name} {log_type}\n" for log, csv_name, log_type in runs))
+    assert main(["run", str(jobs), "--workers", "2"]) == 0
+    expected = sorted(p.name for p in (tmp_path / "expected").iterdir())
+    assert sorted(p.name for p in (tmp_path / "public").iterdir()) == expected
+    for name in expected:
+        if name.endswith(".csv"):
+            assert (tmp_path / "public" / name).read_bytes() == (tmp_path / "expected" / name).read_bytes()
+
+    jobs.write_text(
+        f"tests/logs/elxr_org {tmp_path / 'a.csv'} elxr_org_view\ntests/logs/elxr_org {tmp_path / 'a.csv'} metrics\n"
+    )
+    with pytest.raises(SystemExit):
+        main(["run", str(jobs)])
+    jobs.write_text(f"tests/logs/elxr_org {tmp_path / 'a.csv'} edge_performance --sample 0.5\n")
+    with pytest.raises(SystemExit):
+        main(["run", str(jobs)])
+    jobs.write_text(f"tests/logs/elxr_org {tmp_path / 'a.csv'} elxr_org_view\n")
+    (tmp_path / "a.csv").write_text("TimeBucket,ViewCount,UniqueUser\nnot a time,1,1\n")  # fails in the worker
+    assert main(["run", str(jobs)]) == 1
+
+
+def test_main_bot_networks(tmp_path):
+    """test main function with bot networks"""
+    csv_file = tmp_path / "test.csv"
+    networks = tmp_path / "bots.txt"
+    networks.write_text("10.0.0.0/8  # CI runners\n")
+    log = Path("tests/logs/mirror_elxr_dev")
+    elxr_metrics.__main__.parse_mirror_elxr_dev_logs = MagicMock()
+    main([str(log), str(csv_file), "package_download", "--bot-networks", str(networks)])
+    classifier = elxr_metrics.__main__.parse_mirror_elxr_dev_logs.call_args.kwargs["classifier"]
+    assert classifier.is_bot("Debian APT-HTTP/1.3 (2.6.1)", "10.1.2.3")
+
+
+def test_main_backfill(tmp_path, mocker):
+    """test main function to backfill from an archive"""
+    csv_file = tmp_path / "test.csv"
+    log = Path("tests/logs/mirror_elxr_dev")
+    backfill = mocker.patch("elxr_metrics.__main__.backfill")
+    assert main(["backfill", str(log), str(csv_file), "package_download", "--chunk-size", "10"]) == 0
+    args, kwargs = backfill.call_args
+    assert str(args[0]) == str(log)
+    assert args[2] == tmp_path / "test.csv.backfill.json"
+    assert kwargs == {"chunk_size": 10}
+    with pytest.raises(SystemExit):
+        main(["backfill", str(log), str(csv_file), "package_download", "--chunk-size", "0"])
+
+
+def test_main_s3(tmp_path):
+    """test main function to parse logs from an s3 URL"""
+    csv_file = tmp_path / "test.csv"
+    elxr_metrics.__main__.parse_downloads_elxr_dev_logs = MagicMock()
+    main(["s3://metrics/downloads_elxr_dev/", str(csv_file), "image_download"])
+    elxr_metrics.__main__.parse_downloads_elxr_dev_logs.assert_called_once_with(
+        "s3://metrics/downloads_elxr_dev/",
+        csv_file,
+        compress=False,
+        dedup_window=DEDUP_WINDOW,
+        completion=DEFAULT_COMPLETION,
+        sample_rate=1.0,
+    )
+    with pytest.raises(SystemExit):
+        main(["watch", "s3://metrics/downloads_elxr_dev/", str(csv_file), "image_download"])
 
 
 def test_main_log_type(tmp_path):
@@ -0,0 +1,142 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.elxr_package import PackageAggregator, _match_deb_download
+from elxr_metrics.log_source import read_logs
+from elxr_metrics.metric import DEFAULT_METRIC_SPECS, MetricEngine, MetricSpec, load_metric_specs, parse_metrics_logs
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+DAY = datetime.datetime(2024, 9, 20)
+
+
+def test_metric_spec_invalid():
+    """test rejecting specs of unknown fields, time buckets and names"""
+    with pytest.raises(ValueError, match="unknown log fields"):
+        MetricSpec("bad", key=("no_such_field",))
+    with pytest.raises(ValueError, match="time bucket"):
+        MetricSpec("bad", key=("sc_status",), time_bucket="2h")
+    with pytest.raises(ValueError, match="identifier"):
+        MetricSpec("bad name", key=("sc_status",))
+    with pytest.raises(ValueError, match="column name"):
+        MetricSpec("bad", key=("sc_status",), columns=("Status", "Extra"))
+    with pytest.raises(ValueError, match="at least one key"):
+        MetricSpec("bad", key=())
+    with pytest.raises(ValueError, match="double quotes"):
+        MetricSpec("bad", key=("sc_status",), columns=('Status" VARCHAR, "x',))
+    with pytest.raises(ValueError, match="double quotes"):
+        MetricSpec("bad", key=('a"b',), extractor=lambda entry: ("x",))
+
+
+def test_metric_engine():
+    """test counting several specs in one pass"""
+    specs = (
+        *DEFAULT_METRIC_SPECS,
+        MetricSpec("egress", key=("x_edge_location",), sum="sc_bytes", where={"sc_status": (200, 206)}),
+        MetricSpec("redirects", key=("cs_uri_stem",), where={"sc_status": (301,)}),
+    )
+    tables = MetricEngine(specs).feed_batch(read_logs(LOGS)).snapshot()
+    assert tables["status_trend"] == [
+        {"TimeBucket": DAY, "Status": "200", "Count": 6},
+        {"TimeBucket": DAY, "Status": "301", "Count": 1},
+    ]
+    assert tables["tls_trend"] == [
+        {"TimeBucket": DAY, "Protocol": "N/A", "Count": 1},
+        {"TimeBucket": DAY, "Protocol": "TLSv1.3", "Count": 6},
+    ]
+    assert tables["egress"] == [
+        {"x_edge_location": "SFO53-P4", "Sum": 50130601},
+        {"x_edge_location": "YUL62-P1", "Sum": 4202544},
+    ]
+    assert sum(row["Count"] for row in tables["redirects"]) == 1
+
+
+def test_metric_engine_matches_package_aggregator():
+    """test a package download spec counts the same as the package aggregator"""
+    spec = MetricSpec("downloads", key=("cs_uri_stem",), predicate=lambda entry: _match_deb_download(entry) is not None)
+    engine = MetricEngine([spec]).feed_batch(read_logs(LOGS))
+    packages = PackageAggregator().feed_batch(read_logs(LOGS)).snapshot()["package_stats"]
+    assert sum(engine.counts["downloads"].values()) == sum(row["Download"] for row in packages) > 0
+
+
+def test_metric_engine_extractor():
+    """test counting under the values of a key extractor, skipping entries it returns None for"""
+    spec = MetricSpec("debs", key=("Name", "Version", "Arch"), extractor=_match_deb_download, time_bucket="1d")
+    tables = MetricEngine([spec]).feed_batch(read_logs(LOGS)).snapshot()
+    packages = PackageAggregator().feed_batch(read_logs(LOGS)).snapshot()["package_stats_detail"]
+    assert sorted((row["Name"], row["Version"], row["Arch"], row["Count"]) for row in tables["debs"]) == sorted(
+        tuple(row.values()) for row in packages
+    )
+    assert {row["TimeBucket"] for row in tables["debs"]} == {DAY}
+
+
+def test_metric_engine_merge():
+    """test merging engines of the same specs"""
+    entries = list(read_logs(LOGS))
+    whole = MetricEngine().feed_batch(entries)
+    half = MetricEngine().feed_batch(entries[:3]).merge(MetricEngine().feed_batch(entries[3:]))
+    assert half.snapshot() == whole.snapshot()
+    with pytest.raises(ValueError):
+        whole.merge(MetricEngine([MetricSpec("other", key=("sc_status",))]))
+
+
+def test_load_metric_specs(tmp_path):
+    """test reading metric specs from a TOML file"""
+    config = tmp_path / "metrics.toml"
+    config.write_text(
+        """
+[[metric]]
+name = "html_status"
+key = ["x_edge_location", "sc_status"]
+columns = ["Location", "Status"]
+time_bucket = "6h"
+where = { sc_content_type = ["text/html"], cs_method = "GET" }
+"""
+    )
+    (spec,) = load_metric_specs(config)
+    assert spec == MetricSpec(
+        "html_status",
+        key=("x_edge_location", "sc_status"),
+        columns=("Location", "Status"),
+        time_bucket="6h",
+        where={"sc_content_type": ("text/html",), "cs_method": ("GET",)},
+    )
+    config.write_text(config.read_text() + config.read_text())
+    with pytest.raises(ValueError, match="duplicate"):
+        load_metric_specs(config)
+
+
+@pytest.mark.parametrize("init_content", [(None), (""), ("TimeBucket,Status,Count")])
+def test_parse_metrics_logs(tmp_path, init_content):
+    """test counting the default metrics into csv files twice"""
+    csv_file = tmp_path / "metrics.csv"
+    if init_content is not None:
+        (tmp_path / "status_trend.csv").write_text(init_content)
+    parse_metrics_logs(LOGS, csv_file)
+    parse_metrics_logs(LOGS, csv_file)
+    assert duckdb.read_csv(csv_file).fetchall() == [("status_trend", 2, 14), ("tls_trend", 2, 14)]
+    assert duckdb.read_csv(tmp_path / "status_trend.csv").fetchall() == [(DAY, 200, 12), (DAY, 301, 2)]
+
+
+def test_parse_metrics_logs_float_sum(tmp_path):
+    """test the sum of a float field is not truncated"""
+    csv_file = tmp_path / "metrics.csv"
+    spec = MetricSpec("time_taken", key=("x_edge_location",), sum="time_taken")
+    assert (
+        spec.value_type == "DOUBLE" and MetricSpec("egress", key=("sc_status",), sum="sc_bytes").value_type == "BIGINT"
+    )
+    parse_metrics_logs(LOGS, csv_file, [spec])
+    expected = MetricEngine([spec]).feed_batch(read_logs(LOGS)).snapshot()["time_taken"]
+    actual = duckdb.read_csv(tmp_path / "time_taken.csv").fetchall()
+    assert actual == [(row["x_edge_location"], pytest.approx(row["Sum"])) for row in expected]
+    assert any(total % 1 for _, total in actual)
@@ -0,0 +1,48 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.edge_performance import parse_edge_performance_logs
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+BUCKET = datetime.datetime(2024, 9, 20, 18, 0)
+
+
+@pytest.mark.parametrize(
+    "init_content",
+    [
+        (None),
+        (""),
+        ("TimeBucket,Location,Requests,Hits,HitRatio,EgressBytes,TtfbP50Ms,TtfbP95Ms,TtfbP99Ms"),
+    ],
+)
+def test_parse_edge_performance(tmp_path, init_content):
+    """test counting requests, hits, egress and TTFB quantiles per edge location"""
+    csv_file = tmp_path / "edge_performance.csv"
+    if init_content is not None:
+        csv_file.write_text(init_content)
+    parse_edge_performance_logs(LOGS, csv_file)
+    expected = [
+        (BUCKET, "SFO53-P4", 4, 3, 0.75, 50131252, 2.0, 2.0, 2.0),
+        (BUCKET, "YUL62-P1", 3, 3, 1.0, 4202544, 9.0, 9.0, 9.0),
+    ]
+    assert duckdb.read_csv(csv_file).fetchall() == expected
+
+    parse_edge_performance_logs(LOGS, csv_file)
+    expected = [
+        (BUCKET, "SFO53-P4", 8, 6, 0.75, 100262504, 2.0, 2.0, 2.0),
+        (BUCKET, "YUL62-P1", 6, 6, 1.0, 8405088, 9.0, 9.0, 9.0),
+    ]
+    assert duckdb.read_csv(csv_file).fetchall() == expected
+    sketch = duckdb.read_csv(tmp_path / "edge_ttfb_sketch.csv").fetchall()
+    assert sum(row[3] for row in sketch) == 14
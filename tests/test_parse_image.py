@@ -6,14 +6,24 @@
 ################################################################################
 from __future__ import annotations
 
+import datetime
+from collections import Counter
 from pathlib import Path
 
 import duckdb
 import pytest
-from pytest_mock import MockerFixture
 
 from elxr_metrics.cloudfront_log import CloudFrontLogEntry
-from elxr_metrics.elxr_image import _parse_image_name, _update_image_download, parse_downloads_elxr_dev_logs
+from elxr_metrics.completion import DownloadTracker
+from elxr_metrics.dedup import DedupWindow
+from elxr_metrics.elxr_image import (
+    ImageAggregator,
+    _parse_image_name,
+    _update_image_download,
+    ingest_image,
+    load_image,
+    parse_downloads_elxr_dev_logs,
+)
 
 
 @pytest.fixture(scope="function")
@@ -71,9 +81,10 @@ def test_parse_image(tmp_path, init_content):
     assert actual == expected
 
 
-def test_update_package_download_false(mocker: MockerFixture, log_entry: CloudFrontLogEntry):
+def test_update_package_download_false(log_entry: CloudFrontLogEntry):
     """test checking logs that do not map to deb file"""
-    conn = mocker.MagicMock(duckdb.DuckDBPyConnection)
+    downloads: Counter[str] = Counter()
+    tracker = DownloadTracker()
     params = [
         (None, None),
         ("sc_content_type", "text/html"),
@@ -94,21 +105,82 @@ def test_update_package_download_false(mocker: MockerFixture, log_entry: CloudFr
         if name:
             # log_entry.__setattr__(name, value)
             object.__setattr__(log_entry, name, value)
-        _update_image_download(conn, log_entry)
-        conn.execute.assert_not_called()
+        _update_image_download(downloads, log_entry, tracker)
+        assert not downloads
+    assert not tracker.flush()
 
 
-def test_update_image_download_true(mocker: MockerFixture, log_entry: CloudFrontLogEntry):
+def test_update_image_download_true(log_entry: CloudFrontLogEntry):
     """test checking logs that map to iso file"""
-    conn = mocker.MagicMock(duckdb.DuckDBPyConnection)
+    downloads: Counter[str] = Counter()
     params = [
         ("sc_content_type", "application/x-iso9660-image"),
         ("sc_status", 200),
         ("x_edge_result_type", "Miss"),
         ("sc_bytes", 777000000),
+        ("sc_content_len", 776999500),
         ("cs_uri_stem", "elxr-12.6.1.0-amd64-CD-1.iso"),
     ]
     for name, value in params:
         object.__setattr__(log_entry, name, value)
-    _update_image_download(conn, log_entry)
-    conn.execute.assert_called_once()
+    _update_image_download(downloads, log_entry, DownloadTracker())
+    assert downloads == {"elxr-12.6.1.0-amd64-CD-1.iso": 1}
+
+
+def _set(log_entry: CloudFrontLogEntry, **fields) -> CloudFrontLogEntry:
+    for name, value in fields.items():
+        object.__setattr__(log_entry, name, value)
+    return log_entry
+
+
+def test_update_image_download_ranges(log_entry: CloudFrontLogEntry):
+    """test an interrupted download resumed with range requests counts once it covers the image"""
+    downloads: Counter[str] = Counter()
+    tracker = DownloadTracker(completion=0.9)
+    _set(log_entry, c_ip="13.32.13.11", cs_user_agent="Mozilla/5.0", cs_uri_stem="/elxr-12.6.1.0-amd64-CD-1.iso")
+    _set(log_entry, sc_status=200, x_edge_result_type="Error", sc_bytes=400, sc_content_len=1000)
+    _update_image_download(downloads, log_entry, tracker)
+    _set(log_entry, sc_status=206, x_edge_result_type="Hit", sc_bytes=300, sc_range_start=600, sc_range_end=999)
+    _update_image_download(downloads, log_entry, tracker)
+    assert not downloads
+    _set(log_entry, sc_bytes=500, sc_range_start=350, sc_range_end=599)
+    _update_image_download(downloads, log_entry, tracker)
+    assert downloads == {"elxr-12.6.1.0-amd64-CD-1.iso": 1}
+    assert len(tracker) == 0
+
+
+def test_update_image_download_dedup(log_entry: CloudFrontLogEntry):
+    """test repeated downloads of one client within the window count once"""
+    downloads: Counter[str] = Counter()
+    tracker = DownloadTracker()
+    dedup = DedupWindow(window=60)
+    start = datetime.datetime(2024, 10, 31, 3)
+    _set(log_entry, c_ip="13.32.13.11", cs_user_agent="Mozilla/5.0", cs_uri_stem="/elxr-12.6.1.0-amd64-CD-1.iso")
+    _set(log_entry, sc_status=200, x_edge_result_type="Hit", sc_bytes=1000, sc_content_len=1000, date=start.date())
+    for seconds in (0, 10, 60, 200):
+        _set(log_entry, time=(start + datetime.timedelta(seconds=seconds)).time())
+        _update_image_download(downloads, log_entry, tracker, dedup)
+    assert downloads == {"elxr-12.6.1.0-amd64-CD-1.iso": 2}
+
+
+def test_ingest_image_rollback(tmp_path):
+    """test a failed ingest leaves the downloads in progress as they were, so a retry counts them"""
+    image = {"c_ip": "13.32.13.11", "cs_user_agent": "Mozilla/5.0", "cs_uri_stem": "/elxr-12.6.1.0-amd64-CD-1.iso"}
+    head = CloudFrontLogEntry(**image, sc_status=200, x_edge_result_type="Error", sc_bytes=400, sc_content_len=1000)
+    tail = CloudFrontLogEntry(
+        **image, sc_status=206, x_edge_result_type="Hit", sc_bytes=600, sc_range_start=400, sc_range_end=999
+    )
+
+    def broken():  # completes the download, then fails
+        yield tail
+        raise OSError("truncated log file")
+
+    conn = duckdb.connect(":memory:")
+    load_image(conn, tmp_path / "image_stats.csv")
+    aggregator = ImageAggregator()
+    ingest_image(conn, [head], aggregator)
+    with pytest.raises(OSError):
+        ingest_image(conn, broken(), aggregator)
+    ingest_image(conn, [tail], aggregator)
+    assert conn.execute("SELECT * FROM images").fetchall() == [("elxr-12.6.1.0-amd64-CD-1.iso", 1)]
+    conn.close()
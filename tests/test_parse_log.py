@@ -14,10 +14,12 @@ import pytest
 
 from elxr_metrics.cloudfront_log import (
     CloudFrontLogEntry,
+    LineFilter,
     _to_datetime,
-    _to_object,
+    log_file_time,
     parse_cloudfront_log,
-    webpage_timebucket,
+    time_bucket,
+    to_object,
 )
 
 
@@ -71,7 +73,7 @@ from elxr_metrics.cloudfront_log import (
     ],
 )
 def test_to_object(value, field, result):
-    actual = _to_object(value, field)
+    actual = to_object(value, field)
     assert actual == result
 
 
@@ -91,6 +93,29 @@ def test_timestamp_property_with_none():
     assert entry.timestamp == expected
 
 
+def test_epoch_property():
+    """Test the epoch property is the timestamp in seconds"""
+    entry = CloudFrontLogEntry(
+        date=datetime.date(2024, 1, 1), time=datetime.time(12, 34, 56, tzinfo=datetime.timezone.utc)
+    )
+    assert entry.epoch == int(entry.timestamp.timestamp())
+    assert CloudFrontLogEntry().epoch == int(CloudFrontLogEntry().timestamp.timestamp())
+
+
+@pytest.mark.parametrize(
+    "width, expected_bucket",
+    [
+        (3600, datetime.datetime(2024, 1, 1, 19, 0)),
+        (6 * 3600, datetime.datetime(2024, 1, 1, 18, 0)),
+        (24 * 3600, datetime.datetime(2024, 1, 1, 0, 0)),
+    ],
+)
+def test_time_bucket(width, expected_bucket):
+    """Test time_bucket function"""
+    t = datetime.datetime(2024, 1, 1, 19, 30, 45, tzinfo=datetime.timezone.utc)
+    assert time_bucket(int(t.timestamp()), width) == expected_bucket
+
+
 @pytest.mark.parametrize(
     "path",
     ["A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0.gz"],
@@ -108,31 +133,71 @@ def test_parse_log(path):
     assert entries[4].cs_protocol == "https"
 
 
+_RAW = (
+    b"2024-09-20\t18:39:38\tYUL62-P1\t1400848\t74.12.5.10\tGET\tabc.cloudfront.net\t{uri}\t{status}\t-\tapt\t-\t-\t"
+    b"Hit\tid\tmirror.elxr.dev\thttps\t148\t0.144\t-\tTLSv1.3\tTLS_AES_128_GCM_SHA256\tHit\tHTTP/1.1\t-\t-\t41202\t"
+    b"0.009\tHit\t{content_type}\t1400264\t-\t-"
+)
+
+
 @pytest.mark.parametrize(
-    "input_time, expected_bucket",
+    "uri, status, content_type, kept",
     [
+        (b"/elxr/pool/main/g/glib/libglib_2.74_amd64.deb", b"200", b"application/vnd.debian.binary-package", True),
+        (b"/elxr/pool/main/g/glib/libglib_2.74_amd64.deb", b"404", b"application/vnd.debian.binary-package", False),
+        (b"/elxr/pool/main/g/glib/libglib_2.74_amd64.deb", b"200", b"text/html", False),
+        (b"/elxr/dists/aria/InRelease", b"200", b"application/vnd.debian.binary-package", False),
         (
-            datetime.datetime(2024, 1, 1, 1, 30, 45),
-            datetime.datetime(2024, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc),
-        ),
-        (
-            datetime.datetime(2024, 1, 1, 7, 30, 45),
-            datetime.datetime(2024, 1, 1, 6, 0, 0, tzinfo=datetime.timezone.utc),
-        ),
-        (
-            datetime.datetime(2024, 1, 1, 13, 30, 45),
-            datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc),
-        ),
-        (
-            datetime.datetime(2024, 1, 1, 19, 30, 45),
-            datetime.datetime(2024, 1, 1, 18, 0, 0, tzinfo=datetime.timezone.utc),
+            b"/elxr%2Fpool/main/g/glib/libglib_2.74_amd64%252Edeb",
+            b"200",
+            b"application/vnd.debian.binary-package",
+            True,
         ),
     ],
 )
-def test_webpage_timebucket(input_time, expected_bucket):
-    """Test webpage_timebucket function"""
-    result = webpage_timebucket(input_time)
-    assert result == expected_bucket
+def test_line_filter(uri, status, content_type, kept):
+    """Test raw line checks of status, content type and the unquoted uri"""
+    line_filter = LineFilter(
+        any_of=("application/vnd.debian.binary-package",), statuses=range(100, 400), uri_contains=("/pool/", ".deb")
+    )
+    assert (
+        line_filter(_RAW.replace(b"{uri}", uri).replace(b"{status}", status).replace(b"{content_type}", content_type))
+        is kept
+    )
+    assert LineFilter()(b"short\tline")
+    assert LineFilter(statuses=(200,))(b"short\tline")
+
+
+def test_line_filter_sampled():
+    """Test sampling lines by the hash of a field, the same for every line of a value"""
+    lines = [
+        b"\t".join([b"2024-01-01", b"00:00:00", b"YUL62-P1", b"1", f"10.0.{i // 256}.{i % 256}".encode(), b"GET"])
+        + b"\t-\t/\t200"
+        + b"\t-" * 3
+        for i in range(2000)
+    ]
+    line_filter = LineFilter(statuses=(200,)).sampled(0.1, "c_ip")
+    kept = [line for line in lines if line_filter(line)]
+    assert 150 < len(kept) < 250
+    assert kept == [line for line in lines if LineFilter().sampled(0.1, "c_ip")(line)]
+    assert not line_filter(kept[0].replace(b"\t200", b"\t404"))
+    assert all(LineFilter().sampled(1.0, "c_ip")(line) for line in lines)
+    assert not LineFilter().sampled(0.5, "x_edge_request_id")(lines[0])  # no such column
+    for rate, field in ((0, "c_ip"), (1.5, "c_ip"), (0.1, "date"), (0.1, "unknown")):
+        with pytest.raises(ValueError):
+            LineFilter().sampled(rate, field)
+
+
+def test_parse_log_line_filter(caplog):
+    """Test parsing only the lines kept by a line filter, and reporting the share kept"""
+    path = Path(__file__).parent / "logs" / "elxr_org" / "A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0.gz"
+    line_filter = LineFilter(any_of=("text/html",))
+    entries = list(parse_cloudfront_log(path, line_filter))
+    assert [e.sc_content_type for e in entries] == ["text/html"] * len(entries)
+    assert (line_filter.lines, line_filter.kept) == (5, len(entries))
+    with caplog.at_level("INFO"):
+        line_filter.report()
+    assert f"kept {len(entries)} of 5 log lines" in caplog.text
 
 
 def test_parse_log_file_not_found():
@@ -151,6 +216,35 @@ def test_parse_log_invalid_format(tmp_path):
         list(parse_cloudfront_log(log_file))
 
 
+@pytest.mark.parametrize("suffix, trailing_newline", [(".zst", True), (".log", True), (".log", False)])
+def test_parse_log_formats(tmp_path, suffix, trailing_newline):
+    """Test zstd and plain log files are parsed the same as gzip"""
+    path = Path(__file__).parent / "logs" / "elxr_org" / "A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0.gz"
+    expected = list(parse_cloudfront_log(path))
+    content = gzip.decompress(path.read_bytes())
+    if not trailing_newline:
+        content = content.rstrip(b"\n")
+    log_file = tmp_path / f"A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0{suffix}"
+    if suffix == ".zst":
+        zstandard = pytest.importorskip("zstandard")
+        content = zstandard.ZstdCompressor().compress(content)
+    log_file.write_bytes(content)
+    assert list(parse_cloudfront_log(log_file)) == expected
+    with open(log_file, "rb") as stream:
+        assert list(parse_cloudfront_log(stream)) == expected
+    assert log_file_time(log_file) == datetime.datetime(2024, 10, 1, 18, tzinfo=datetime.timezone.utc)
+
+
+def test_parse_log_corrupt_file(tmp_path):
+    """Test a .gz file that is not gzip is not read as plain text"""
+    log_file = tmp_path / "broken.gz"
+    log_file.write_bytes(b"2024-10-01\t18:00:00\n")
+    with pytest.raises(OSError):
+        list(parse_cloudfront_log(log_file))
+    (tmp_path / "empty.log").write_bytes(b"")
+    assert not list(parse_cloudfront_log(tmp_path / "empty.log"))
+
+
 def test_parse_log_empty_file(tmp_path):
     """Test parsing empty log file"""
     log_file = tmp_path / "empty.gz"
@@ -214,22 +308,22 @@ def test_to_datetime_invalid_format():
         ("-", None),  # Empty value marker
     ],
 )
-def test_to_object_datetime(value, expected_datetime):
-    """Test _to_object function with datetime field type"""
+def test_to_object_datetime(value, expected_datetime, monkeypatch):
+    """Test to_object function with datetime field type"""
     # Create a mock Field object with datetime.datetime type
     mock_field = CloudFrontLogEntry.__dataclass_fields__["date"]  # Use existing field
-    object.__setattr__(mock_field, "type", "datetime.datetime | None")  # Override type
+    monkeypatch.setattr(mock_field, "type", "datetime.datetime | None")  # Override type for this test only
 
-    result = _to_object(value, mock_field)
+    result = to_object(value, mock_field)
     assert result == expected_datetime
     if result is not None:
         assert result.tzinfo == datetime.timezone.utc
 
 
-def test_to_object_datetime_invalid():
-    """Test _to_object function with invalid datetime values"""
+def test_to_object_datetime_invalid(monkeypatch):
+    """Test to_object function with invalid datetime values"""
     mock_field = CloudFrontLogEntry.__dataclass_fields__["date"]
-    object.__setattr__(mock_field, "type", "datetime.datetime | None")
+    monkeypatch.setattr(mock_field, "type", "datetime.datetime | None")
 
     invalid_values = [
         "invalid-datetime",
@@ -242,7 +336,7 @@ def test_to_object_datetime_invalid():
 
     for invalid_value in invalid_values:
         with pytest.raises(ValueError):
-            _to_object(invalid_value, mock_field)
+            to_object(invalid_value, mock_field)
 
 
 @pytest.fixture
@@ -269,28 +363,28 @@ def list_str_field():
     ],
 )
 def test_to_object_list_str(list_str_field, value, expected_list):
-    """Test _to_object function with list[str] field type"""
-    result = _to_object(value, list_str_field)
+    """Test to_object function with list[str] field type"""
+    result = to_object(value, list_str_field)
     assert result == expected_list
 
 
 def test_to_object_list_str_edge_cases(list_str_field):
-    """Test _to_object function with list[str] field type edge cases"""
+    """Test to_object function with list[str] field type edge cases"""
     # Test trailing comma
-    assert _to_object("item1,item2,", list_str_field) == ["item1", "item2", ""]
+    assert to_object("item1,item2,", list_str_field) == ["item1", "item2", ""]
 
     # Test leading comma
-    assert _to_object(",item1,item2", list_str_field) == ["", "item1", "item2"]
+    assert to_object(",item1,item2", list_str_field) == ["", "item1", "item2"]
 
     # Test multiple consecutive commas
-    assert _to_object("item1,,,item2", list_str_field) == ["item1", "", "", "item2"]
+    assert to_object("item1,,,item2", list_str_field) == ["item1", "", "", "item2"]
 
     # Test whitespace only items
-    assert _to_object("  ,\t,\n", list_str_field) == ["  ", "\t", "\n"]
+    assert to_object("  ,\t,\n", list_str_field) == ["  ", "\t", "\n"]
 
 
 def test_to_object_list_str_unicode(list_str_field):
-    """Test _to_object function with list[str] field type and unicode characters"""
+    """Test to_object function with list[str] field type and unicode characters"""
     # Test unicode characters
     test_cases = [
         ("español,русский,日本語", ["español", "русский", "日本語"]),
@@ -299,19 +393,33 @@ def test_to_object_list_str_unicode(list_str_field):
     ]
 
     for input_value, expected in test_cases:
-        result = _to_object(input_value, list_str_field)
+        result = to_object(input_value, list_str_field)
         assert result == expected
 
 
 def test_to_object_list_str_long_values(list_str_field):
-    """Test _to_object function with list[str] field type and long values"""
+    """Test to_object function with list[str] field type and long values"""
     # Test long strings
     long_string = "x" * 1000
     value = f"short,{long_string},medium"
-    result = _to_object(value, list_str_field)
+    result = to_object(value, list_str_field)
 
     assert len(result) == 3
     assert result[0] == "short"
     assert result[1] == long_string
     assert result[2] == "medium"
     assert len(result[1]) == 1000
+
+
+@pytest.mark.parametrize(
+    "name, hour",
+    [
+        ("A65ZZCR5KMGAR8.2024-10-01-18.2d243ee0.gz", datetime.datetime(2024, 10, 1, 18, tzinfo=datetime.timezone.utc)),
+        ("logs/E2.2024-01-02-03.abc.gz", datetime.datetime(2024, 1, 2, 3, tzinfo=datetime.timezone.utc)),
+        ("broken.gz", None),
+        ("A65ZZCR5KMGAR8.2024-10-01.2d243ee0.gz", None),
+    ],
+)
+def test_log_file_time(name, hour):
+    """test reading the log hour from file name"""
+    assert log_file_time(Path(name)) == hour
@@ -6,14 +6,23 @@
 ################################################################################
 from __future__ import annotations
 
+from collections import Counter
 from pathlib import Path
 
 import duckdb
 import pytest
-from pytest_mock import MockerFixture
 
+from elxr_metrics.bot import BotClassifier
 from elxr_metrics.cloudfront_log import CloudFrontLogEntry
-from elxr_metrics.elxr_package import _parse_deb_name, _update_package_download, parse_mirror_elxr_dev_logs
+from elxr_metrics.elxr_package import (
+    DebFile,
+    PackageAggregator,
+    _match_deb_download,
+    _parse_deb_file,
+    _parse_deb_name,
+    merge_package_download,
+    parse_mirror_elxr_dev_logs,
+)
 
 
 @pytest.fixture(scope="function")
@@ -45,6 +54,37 @@ def test_parse_deb_name(path, name):
     assert package_name == name
 
 
+@pytest.mark.parametrize(
+    "path, deb",
+    [
+        (
+            "/elxr/pool/main/z/zlib/zlib1g-dev_1.2.13.dfsg-1elxr1_arm64.deb",
+            DebFile("zlib1g-dev", "1.2.13.dfsg-1elxr1", "arm64"),
+        ),
+        ("/elxr/pool/main/e/edk2/uefi-ext4_202402-1elxr2_all.deb", DebFile("uefi-ext4", "202402-1elxr2", "all")),
+        ("/elxr/pool/main/c/curl/curl_.deb", DebFile("curl", None, None)),
+        ("/elxr/pool/main/c/curl/curl_7.68.0.deb", DebFile("curl", "7.68.0", None)),
+        ("/elxr/pool/main/c/curl/curl.deb", None),
+    ],
+)
+def test_parse_deb_file(path, deb):
+    """test parsing deb name, version and architecture"""
+    assert _parse_deb_file(path) == deb
+
+
+def test_match_deb_download(log_entry: CloudFrontLogEntry):
+    """test the combined filter returns the parsed deb file"""
+    for name, value in [
+        ("sc_content_type", "binary/octet-stream"),
+        ("sc_status", 304),
+        ("cs_uri_stem", "/elxr/pool/main/l/less/less_590-2.1~deb12u2_arm64.deb"),
+    ]:
+        object.__setattr__(log_entry, name, value)
+    assert _match_deb_download(log_entry) == DebFile("less", "590-2.1~deb12u2", "arm64")
+    object.__setattr__(log_entry, "cs_uri_stem", "/elxr/dists/aria/main/binary-arm64/less_590_arm64.deb")
+    assert _match_deb_download(log_entry) is None
+
+
 @pytest.mark.parametrize(
     "init_content",
     [
@@ -71,9 +111,64 @@ def test_parse_package(tmp_path, init_content):
     assert actual == expected
 
 
-def test_update_package_download_false(mocker: MockerFixture, log_entry: CloudFrontLogEntry):
+def test_parse_package_detail(tmp_path):
+    """test package download breakdown by version and arch"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(path, csv_file)
+    parse_mirror_elxr_dev_logs(path, csv_file)
+    expected = [
+        ("libglib2.0-0", "2.74.6-2+deb12u3", "amd64", 6),
+        ("linux-image-imx-arm64", "6.1.99-elxr2-2", "arm64", 4),
+        ("linux-image-6.1.0-23-imx-arm64", "6.1.99-elxr2-2", "arm64", 2),
+    ]
+    actual = duckdb.read_csv(tmp_path / "package_stats_detail.csv", all_varchar=True).fetchall()
+    assert [(n, v, a, int(d)) for n, v, a, d in actual] == expected
+    actual = duckdb.read_csv(tmp_path / "package_arch_stats.csv").fetchall()
+    assert actual == [("amd64", 6), ("arm64", 6)]
+
+
+def test_parse_package_bots(tmp_path):
+    """test downloads by bots are also counted into package_bot_stats.csv"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    parse_mirror_elxr_dev_logs(path, csv_file)
+    assert duckdb.read_csv(tmp_path / "package_bot_stats.csv").fetchall() == []
+    parse_mirror_elxr_dev_logs(path, csv_file, classifier=BotClassifier(["0.0.0.0/0"]))
+    expected = [("libglib2.0-0", 3), ("linux-image-imx-arm64", 2), ("linux-image-6.1.0-23-imx-arm64", 1)]
+    assert duckdb.read_csv(tmp_path / "package_bot_stats.csv").fetchall() == expected
+
+
+def test_parse_package_sample(tmp_path):
+    """test a sampled run writes estimates with confidence intervals into the estimated folder"""
+    path = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+    csv_file = tmp_path / "package_stats.csv"
+    for _ in range(2):  # an estimate replaces the previous one
+        parse_mirror_elxr_dev_logs(path, csv_file, sample_rate=0.5)
+    assert not csv_file.exists()
+    estimated = dict(duckdb.read_csv(tmp_path / "estimated" / "package_stats.csv").fetchall())
+    rows = duckdb.read_csv(tmp_path / "estimated" / "estimate.csv").fetchall()
+    stats = {
+        key: (n, estimate, low, high) for metric, key, n, estimate, low, high in rows if metric == "stats.Download"
+    }
+    assert 0 < sum(n for n, _, _, _ in stats.values()) < 6
+    assert estimated == {key: estimate for key, (_, estimate, _, _) in stats.items()}
+    assert all(n <= low <= estimate <= high and estimate == 2 * n for n, estimate, low, high in stats.values())
+
+
+def test_parse_package_sample_failed(tmp_path, mocker):
+    """test a failed sampled run publishes no estimate.csv and leaves no estimated folder behind"""
+    mocker.patch("elxr_metrics.elxr_package.save_package", side_effect=RuntimeError("disk full"))
+    with pytest.raises(RuntimeError):
+        parse_mirror_elxr_dev_logs(
+            Path(__file__).parent / "logs" / "mirror_elxr_dev", tmp_path / "package_stats.csv", sample_rate=0.5
+        )
+    assert not (tmp_path / "estimated").exists()
+
+
+def test_update_package_download_false(log_entry: CloudFrontLogEntry):
     """test checking logs that do not map to deb file"""
-    conn = mocker.MagicMock(duckdb.DuckDBPyConnection)
+    aggregator = PackageAggregator()
     params = [
         (None, None),
         ("sc_content_type", "text/html"),
@@ -90,13 +185,12 @@ def test_update_package_download_false(mocker: MockerFixture, log_entry: CloudFr
         if name:
             # log_entry.__setattr__(name, value)
             object.__setattr__(log_entry, name, value)
-        _update_package_download(conn, log_entry)
-        conn.execute.assert_not_called()
+        aggregator.feed(log_entry)
+        assert not aggregator.downloads
 
 
-def test_update_package_download_true(mocker: MockerFixture, log_entry: CloudFrontLogEntry):
+def test_update_package_download_true(log_entry: CloudFrontLogEntry):
     """test checking logs that map to deb file"""
-    conn = mocker.MagicMock(duckdb.DuckDBPyConnection)
     params = [
         ("sc_content_type", "application/vnd.debian.binary-package"),
         ("sc_status", 200),
@@ -104,5 +198,23 @@ def test_update_package_download_true(mocker: MockerFixture, log_entry: CloudFro
     ]
     for name, value in params:
         object.__setattr__(log_entry, name, value)
-    _update_package_download(conn, log_entry)
-    conn.execute.assert_called_once()
+    aggregator = PackageAggregator().feed_batch([log_entry])
+    assert aggregator.downloads == Counter({("less", "590-2.1~deb12u2", "arm64"): 1})
+
+
+def test_merge_package_download(conn):
+    """test merging counted downloads into stats tables"""
+    conn.execute("CREATE TABLE stats (Name VARCHAR PRIMARY KEY, Download INTEGER);")
+    conn.execute(
+        "CREATE TABLE stats_detail (Name VARCHAR, Version VARCHAR, Arch VARCHAR, Download INTEGER, "
+        "PRIMARY KEY (Name, Version, Arch));"
+    )
+    conn.execute("INSERT INTO stats VALUES ('curl', 5);")
+    downloads = Counter({DebFile("curl", "8.0", "amd64"): 2, DebFile("curl", "8.0", "arm64"): 1, DebFile("zsh"): 1})
+    merge_package_download(conn, downloads)
+    assert conn.execute("SELECT * FROM stats ORDER BY Name").fetchall() == [("curl", 8), ("zsh", 1)]
+    assert conn.execute("SELECT * FROM stats_detail ORDER BY Name, Arch").fetchall() == [
+        ("curl", "8.0", "amd64", 2),
+        ("curl", "8.0", "arm64", 1),
+        ("zsh", "N/A", "N/A", 1),
+    ]
@@ -7,13 +7,29 @@
 from __future__ import annotations
 
 import datetime
+import json
+import logging
+import shutil
 from pathlib import Path
 
 import duckdb
 import maxminddb
 import pytest
 
-from elxr_metrics.elxr_org_trend import _country_lookup, parse_elxr_org_logs
+from elxr_metrics import elxr_org_trend
+from elxr_metrics.bot import BotClassifier
+from elxr_metrics.cloudfront_log import CloudFrontLogEntry
+from elxr_metrics.elxr_org_trend import (
+    TrendAggregator,
+    _country_lookup,
+    _pack_ip,
+    _trend_shards,
+    ingest_trend,
+    load_trend,
+    parse_elxr_org_logs,
+)
+from elxr_metrics.log_source import LocalLogSource, read_logs
+from elxr_metrics.pipeline import get_pipeline
 
 
 @pytest.mark.parametrize(
@@ -83,6 +99,263 @@ def test_parse_trend_log(tmp_path):
     assert (datetime.datetime(2074, 9, 25, 18, 0), 6, 4) in actual_set
 
 
+def test_parse_trend_listed_newest_first(tmp_path, monkeypatch):
+    """test log files are read in the order of their hour, so a late view never reopens a flushed bucket"""
+    listed = LocalLogSource.keys
+    monkeypatch.setattr(LocalLogSource, "keys", lambda self: sorted(listed(self), reverse=True))
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(Path(__file__).parent / "logs" / "elxr_org", csv_file)
+    actual = duckdb.read_csv(csv_file).fetchall()
+    assert (datetime.datetime(2074, 9, 22, 18, 0), 3, 2) in actual
+    assert (datetime.datetime(2074, 9, 25, 18, 0), 3, 2) in actual
+
+
+def test_parse_trend_bucket_width(tmp_path):
+    """test views are bucketed by the given width"""
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(path, csv_file, bucket_width=24 * 3600)
+    actual = duckdb.read_csv(csv_file).fetchall()
+    assert (datetime.datetime(2074, 9, 22), 3, 2) in actual
+    assert all(t.hour == 0 for t, _, _ in actual)
+
+
+def test_parse_trend_other_bucket_width(tmp_path):
+    """test history of another bucket width is rejected"""
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(path, csv_file)
+    assert json.loads((tmp_path / "elxr_org_view" / "index.json").read_text())["7d"]["resolution"] == "6h"
+    assert json.loads((tmp_path / "elxr_org_view.meta.json").read_text()) == {"bucket_width": 21600}
+    with pytest.raises(ValueError, match="another width"):
+        parse_elxr_org_logs(path, csv_file, bucket_width=3600)
+    # without the recorded width, 6h buckets, which are 1h aligned as well, are still told from 1h buckets
+    shutil.rmtree(tmp_path / "elxr_org_view")
+    (tmp_path / "elxr_org_view.meta.json").unlink()
+    with pytest.raises(ValueError, match="another width"):
+        parse_elxr_org_logs(path, csv_file, bucket_width=3600)
+    csv_file.write_text("TimeBucket,ViewCount,UniqueUser\n2074-09-22 19:00:00,1,1\n")
+    for f in ("elxr_org_bot_view.csv", "country_trend.csv"):
+        (tmp_path / f).unlink()
+    with pytest.raises(ValueError, match="another width"):
+        parse_elxr_org_logs(path, csv_file)
+    parse_elxr_org_logs(path, csv_file, bucket_width=3600)
+    assert json.loads((tmp_path / "elxr_org_view" / "index.json").read_text())["7d"]["resolution"] == "1h"
+    assert json.loads((tmp_path / "elxr_org_view.meta.json").read_text()) == {"bucket_width": 3600}
+
+
+def test_parse_trend_sample(tmp_path):
+    """test a sampled run scales views and unique users up"""
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(path, csv_file)
+    exact = {t: (views, users) for t, views, users in duckdb.read_csv(csv_file).fetchall()}
+    parse_elxr_org_logs(path, csv_file, sample_rate=0.999)
+    estimated = {
+        t: (views, users) for t, views, users in duckdb.read_csv(tmp_path / "estimated" / csv_file.name).fetchall()
+    }
+    assert estimated == exact
+    assert duckdb.read_csv(csv_file).fetchall() == [(t, *exact[t]) for t in sorted(exact)]
+    metrics = {row[0] for row in duckdb.read_csv(tmp_path / "estimated" / "estimate.csv").fetchall()}
+    assert {"trend.ViewCount", "trend.UniqueUser", "country.Count"} <= metrics
+
+
+def test_parse_trend_sample_coordinates(tmp_path, mocker):
+    """test the estimated country.csv takes the coordinates of countries.csv next to the exact counts"""
+    mocker.patch.object(elxr_org_trend, "_country_lookup", return_value=("CA", "Canada"))
+    (tmp_path / "countries.csv").write_text("country,latitude,longitude,name\nCA,56.13,-106.35,Canada\n")
+    parse_elxr_org_logs(Path(__file__).parent / "logs" / "elxr_org", tmp_path / "elxr_org_view.csv", sample_rate=0.999)
+    assert duckdb.read_csv(tmp_path / "estimated" / "country.csv").fetchall() == [("CA", 8, 56.13, -106.35, "Canada")]
+
+
+def _view(hour: int, ip: str) -> CloudFrontLogEntry:
+    return CloudFrontLogEntry(
+        date=datetime.date(2024, 1, 1), time=datetime.time(hour, 30), c_ip=ip, sc_content_type="text/html"
+    )
+
+
+def test_pack_ip():
+    """test IPs are packed into distinct integers"""
+    ips = ["1.2.3.4", "::102:304", "2001:db8::1", "", None, "not an ip"]
+    packed = [_pack_ip(ip) for ip in ips]
+    assert packed[0] == 0x01020304
+    assert len(set(packed)) == len(ips)
+    assert all(p < 0 for p in packed[3:])
+    assert packed[5] == -3342087295  # the same in every process
+
+
+def test_trend_aggregator_pop_closed():
+    """test closed time buckets are handed over and dropped"""
+    trend = TrendAggregator(bucket_width=3600, lateness=2700)
+    for hour, ip in ((0, "1.1.1.1"), (0, "2.2.2.2"), (1, "1.1.1.1"), (2, "1.1.1.1")):
+        trend.feed(_view(hour, ip))
+    closed = trend.pop_closed()  # 02:30 is 30 min past the end of 01:00, but 90 min past the end of 00:00
+    assert closed.rows() == [(datetime.datetime(2024, 1, 1, 0), 2, 2)]
+    assert [t.hour for t, _, _ in trend.rows()] == [1, 2]
+    assert not trend.pop_closed().views
+
+
+def test_ingest_trend_flushes_closed_buckets(mocker):
+    """test ingesting keeps only the open buckets in memory and counts the same views"""
+    mocker.patch("elxr_metrics.elxr_org_trend._country_lookup", return_value=("N/A", "N/A"))
+    merge = mocker.spy(elxr_org_trend, "merge_elxr_org")
+    conn = duckdb.connect(":memory:")
+    load_trend(conn, Path("no.csv"))
+    views = [_view(hour, ip) for hour in range(24) for ip in ("1.1.1.1", "2.2.2.2")]
+    ingest_trend(conn, views, TrendAggregator(bucket_width=3600), flush=True)
+    assert max(len(call.args[1].views) for call in merge.call_args_list) <= 2
+    rows = conn.execute("SELECT * FROM trend ORDER BY TimeBucket").fetchall()
+    assert rows == [(datetime.datetime(2024, 1, 1, hour), 2, 2) for hour in range(24)]
+
+
+def test_ingest_trend_drops_late_views(mocker, caplog):
+    """test a view of a bucket already merged is dropped and logged, not counting its users twice"""
+    mocker.patch("elxr_metrics.elxr_org_trend._country_lookup", return_value=("US", "United States"))
+    conn = duckdb.connect(":memory:")
+    load_trend(conn, Path("no.csv"))
+    trend = TrendAggregator(bucket_width=3600)
+    ingest_trend(conn, [_view(hour, "1.1.1.1") for hour in range(4)], trend)
+    assert conn.execute("SELECT * FROM trend ORDER BY TimeBucket").fetchall() == [
+        (datetime.datetime(2024, 1, 1, 0), 1, 1),
+        (datetime.datetime(2024, 1, 1, 1), 1, 1),
+    ]
+    with caplog.at_level(logging.WARNING):
+        ingest_trend(conn, [_view(0, "2.2.2.2"), _view(3, "2.2.2.2")], trend, flush=True)
+    assert trend.late == 1
+    assert "dropped 1 views" in caplog.text
+    rows = conn.execute("SELECT * FROM trend ORDER BY TimeBucket").fetchall()
+    assert rows[0] == (datetime.datetime(2024, 1, 1, 0), 1, 1)
+    assert rows[-1] == (datetime.datetime(2024, 1, 1, 3), 2, 2)
+    assert conn.execute("SELECT SUM(Count) FROM country").fetchone() == (5,)
+
+
+def test_trend_pipeline_users_across_ingests(tmp_path, mocker):
+    """test a user viewing in two ingests of the pipeline counts once, and open buckets are published"""
+    mocker.patch("elxr_metrics.elxr_org_trend._country_lookup", return_value=("N/A", "N/A"))
+    csv_file = tmp_path / "elxr_org_view.csv"
+    pipeline = get_pipeline("elxr_org_view", csv_file)
+    conn = duckdb.connect(":memory:")
+    state = pipeline.load(conn)
+    for entry in read_logs(Path(__file__).parent / "logs" / "elxr_org"):
+        pipeline.ingest(conn, [entry])
+    state = pipeline.save(conn, state)
+    assert (datetime.datetime(2074, 9, 22, 18, 0), 3, 2) in duckdb.read_csv(csv_file).fetchall()
+    # the open bucket of the latest view is published, but left out of the table until it closes
+    assert (datetime.datetime(2074, 9, 25, 18, 0), 3, 2) in duckdb.read_csv(csv_file).fetchall()
+    assert conn.execute("SELECT * FROM trend WHERE TimeBucket = '2074-09-25 18:00:00'").fetchall() == []
+
+    def broken():  # closes the open bucket, then fails
+        yield CloudFrontLogEntry(
+            date=datetime.date(2074, 10, 2), time=datetime.time(0, 30), c_ip="1.1.1.1", sc_content_type="text/html"
+        )
+        raise OSError("truncated log file")
+
+    with pytest.raises(OSError):
+        pipeline.ingest(conn, broken())
+    conn.rollback()
+    pipeline.save(conn, state)
+    assert (datetime.datetime(2074, 9, 25, 18, 0), 3, 2) in duckdb.read_csv(csv_file).fetchall()
+    conn.close()
+
+
+def test_parse_trend_bots(tmp_path):
+    """test views by bots are also counted into elxr_org_bot_view.csv"""
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(path, csv_file, classifier=BotClassifier(["33.0.0.0/8"]))
+    actual = duckdb.read_csv(tmp_path / "elxr_org_bot_view.csv").fetchall()
+    assert (datetime.datetime(2074, 9, 22, 18, 0), 2, 1) in actual
+    assert (datetime.datetime(2074, 9, 22, 18, 0), 3, 2) in duckdb.read_csv(csv_file).fetchall()
+
+
+def test_parse_trend_shards(tmp_path):
+    """test dashboard JSON shards are written beside the csv file"""
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    parse_elxr_org_logs(path, csv_file)
+    shard_dir = tmp_path / "elxr_org_view"
+    index = json.loads((shard_dir / "index.json").read_text())
+    assert list(index) == ["7d", "30d", "90d", "2074", "all"]
+    assert index["7d"]["end"] == "2074-09-25 18:00:00"
+    shard = json.loads((shard_dir / "2074.json").read_text())
+    assert shard["TimeBucket"] == ["2074-09-22 18:00:00", "2074-09-25 18:00:00"]
+    assert shard["ViewCount"] == [3, 3]
+    assert shard["UniqueUser"] == [2, 2]
+    # a year out of the published window is removed with its siblings, the listed shards are kept
+    for name in ("2001.json", "2001.json.gz"):
+        (shard_dir / name).write_text("{}")
+    parse_elxr_org_logs(path, csv_file)
+    assert sorted(f.name for f in shard_dir.iterdir()) == sorted(f"{name}.json" for name in ["index", *index])
+
+
+def test_trend_shards(conn):
+    """test range, year and downsampled shards"""
+    conn.execute(
+        """
+        CREATE TABLE published_trend AS
+        SELECT TIMESTAMP '2023-12-01 00:00:00' + i * INTERVAL 6 HOUR AS TimeBucket, i + 1 AS ViewCount, 1 AS UniqueUser
+        FROM range(400) t(i);"""
+    )
+    shards = _trend_shards(conn)
+    assert list(shards) == ["7d", "30d", "90d", "2023", "2024", "all"]
+    assert shards["7d"]["rows"] == 28
+    assert shards["7d"]["end"] == "2024-03-09 18:00:00"
+    assert shards["7d"]["max"]["ViewCount"] == 400
+    assert shards["30d"]["rows"] == 120
+    assert shards["2023"]["rows"] == 124
+    assert shards["2023"]["min"] == {"ViewCount": 1, "UniqueUser": 1}
+    assert shards["all"]["resolution"] == "1d"
+    assert shards["all"]["rows"] == 100
+    assert shards["all"]["ViewCount"][0] == 1 + 2 + 3 + 4
+    assert shards["all"]["UniqueUser"][0] == 4
+
+
+def test_parse_trend_geo(tmp_path, mocker):
+    """test country trend, city and server-side coordinates of country views"""
+    mocker.patch.object(elxr_org_trend, "_country_lookup", return_value=("CA", "Canada"))
+    city = mocker.patch.object(elxr_org_trend, "_city_lookup", return_value=("CA", "Ontario", "Ottawa", 45.4, -75.7))
+    path = Path(__file__).parent / "logs" / "elxr_org"
+    csv_file = tmp_path / "elxr_org_view.csv"
+    (tmp_path / "countries.csv").write_text("country,latitude,longitude,name\nCA,56.13,-106.35,Canada\n")
+    city_db = tmp_path / "GeoLite2-City.mmdb"
+
+    parse_elxr_org_logs(path, csv_file, city_db=city_db)
+    parse_elxr_org_logs(path, csv_file, city_db=city_db)
+
+    assert duckdb.read_csv(tmp_path / "country.csv").fetchall() == [("CA", 8, 56.13, -106.35, "Canada")]
+    assert duckdb.read_csv(tmp_path / "country_trend.csv").fetchall() == [
+        (datetime.datetime(2074, 9, 22, 18, 0), "CA", "Canada", 6),
+        (datetime.datetime(2074, 9, 25, 18, 0), "CA", "Canada", 6),
+    ]
+    assert duckdb.read_csv(tmp_path / "city.csv").fetchall() == [("CA", "Ontario", "Ottawa", 45.4, -75.7, 8)]
+    city.assert_called_with(city_db, mocker.ANY)
+
+
+def test_trend_pipeline_city_across_ingests(tmp_path, mocker):
+    """test a city viewed in two ingests of the pipeline is one row of city.csv"""
+    mocker.patch.object(elxr_org_trend, "_country_lookup", return_value=("CA", "Canada"))
+    mocker.patch.object(elxr_org_trend, "_city_lookup", return_value=("CA", "Ontario", "Ottawa", 45.4, -75.7))
+    csv_file = tmp_path / "elxr_org_view.csv"
+    pipeline = get_pipeline("elxr_org_view", csv_file, city_db=tmp_path / "GeoLite2-City.mmdb")
+    conn = duckdb.connect(":memory:")
+    state = pipeline.load(conn)
+    for entry in read_logs(Path(__file__).parent / "logs" / "elxr_org"):
+        pipeline.ingest(conn, [entry])
+    pipeline.save(conn, state)
+    conn.close()
+    assert duckdb.read_csv(tmp_path / "city.csv").fetchall() == [("CA", "Ontario", "Ottawa", 45.4, -75.7, 8)]
+
+
+def test_parse_trend_without_city_db(tmp_path, mocker):
+    """test city.csv is only written with a City database"""
+    mocker.patch.object(elxr_org_trend, "_country_lookup", return_value=("CA", "Canada"))
+    city = mocker.patch.object(elxr_org_trend, "_city_lookup")
+    parse_elxr_org_logs(Path(__file__).parent / "logs" / "elxr_org", tmp_path / "elxr_org_view.csv")
+    assert not (tmp_path / "city.csv").exists()
+    assert (tmp_path / "country_trend.csv").exists()
+    city.assert_not_called()
+
+
 @pytest.mark.parametrize(
     "ip, code",
     [
@@ -0,0 +1,135 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import gzip
+import json
+import shutil
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.bot import BotClassifier
+from elxr_metrics.elxr_image import parse_downloads_elxr_dev_logs
+from elxr_metrics.elxr_org_trend import parse_elxr_org_logs
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.partial import PARTIAL_VERSION, map_logs, read_partial, reduce_partials, write_partial
+
+LOGS = Path(__file__).parent / "logs"
+
+
+def _shards(tmp_path: Path, folder: str, files: list[list[int]]) -> list[Path]:
+    """copy the log files of folder into shard folders, by their index in each shard"""
+    logs = sorted((LOGS / folder).glob("*.gz"))
+    shards = []
+    for i, indexes in enumerate(files):
+        shard = tmp_path / f"shard{i}"
+        shard.mkdir()
+        for k, j in enumerate(indexes):
+            shutil.copy(logs[j], shard / f"{k}.{logs[j].name}")
+        shards.append(shard)
+    return shards
+
+
+def _read(csv_file: Path) -> list[tuple]:
+    return duckdb.read_csv(csv_file).fetchall()
+
+
+@pytest.mark.parametrize(
+    "folder, log_type, parse, csv_name, compared",
+    [
+        ("elxr_org", "elxr_org_view", parse_elxr_org_logs, "elxr_org_view.csv", "elxr_org_view.csv"),
+        (
+            "mirror_elxr_dev",
+            "package_download",
+            parse_mirror_elxr_dev_logs,
+            "package_stats.csv",
+            "package_stats_detail.csv",
+        ),
+        ("downloads_elxr_dev", "image_download", parse_downloads_elxr_dev_logs, "image_stats.csv", "image_stats.csv"),
+    ],
+)
+def test_reduce_matches_one_run(
+    tmp_path, folder, log_type, parse, csv_name, compared
+):  # pylint: disable=too-many-arguments
+    """test reducing the partials of shards gives the csv files of one run over all logs"""
+    (tmp_path / "all").mkdir()
+    (tmp_path / "expected").mkdir()
+    parse(_shards(tmp_path / "all", folder, [[0, 1]])[0], tmp_path / "expected" / csv_name)
+    partials = []
+    for i, shard in enumerate(_shards(tmp_path, folder, [[0], [1]])):
+        partials.append(tmp_path / f"{i}.json.gz")
+        map_logs(shard, partials[-1], log_type)
+    (tmp_path / "public").mkdir()
+    reduce_partials(partials, tmp_path / "public" / csv_name)
+    assert _read(tmp_path / "public" / compared) == _read(tmp_path / "expected" / compared)
+
+
+def test_reduce_unique_users(tmp_path):
+    """test users seen in two shards count once, where adding the csv files of the shards counts them twice"""
+    shards = _shards(tmp_path, "elxr_org", [[0, 1], [0, 1]])
+    partials = [tmp_path / "a.json.gz", tmp_path / "b.json.gz"]
+    for shard, partial in zip(shards, partials):
+        map_logs(shard, partial, "elxr_org_view")
+    csv_file = tmp_path / "elxr_org_view.csv"
+    reduce_partials(partials, csv_file)
+    assert _read(csv_file) == [(t, 2 * views, users) for t, views, users in _once(tmp_path, shards[0])]
+
+
+def _once(tmp_path: Path, shard: Path) -> list[tuple]:
+    csv_file = tmp_path / "once" / "elxr_org_view.csv"
+    csv_file.parent.mkdir()
+    parse_elxr_org_logs(shard, csv_file)
+    return _read(csv_file)
+
+
+def test_partial_merge_associative(tmp_path):
+    """test merging partials in any grouping and order writes the same bytes"""
+    shards = _shards(tmp_path, "elxr_org", [[0], [1], [0, 1]])
+    files = [tmp_path / f"{i}.json.gz" for i in range(3)]
+    for shard, partial in zip(shards, files):
+        map_logs(shard, partial, "elxr_org_view")
+    a, b, c = (read_partial(f) for f in files)
+    write_partial(a.merge(b).merge(c), tmp_path / "left.json.gz")
+    a, b, c = (read_partial(f) for f in files)
+    write_partial(c.merge(b.merge(a)), tmp_path / "right.json.gz")
+    assert (tmp_path / "left.json.gz").read_bytes() == (tmp_path / "right.json.gz").read_bytes()
+
+
+def test_read_partial_invalid(tmp_path):
+    """test files that are not partials, of another version, or of other options are rejected"""
+    partial = tmp_path / "partial.json.gz"
+    partial.write_bytes(b"not gzip")
+    with pytest.raises(ValueError, match="not a partial"):
+        read_partial(partial)
+    partial.write_bytes(gzip.compress(json.dumps({"format": "elxr-metrics-partial", "version": 0}).encode()))
+    with pytest.raises(ValueError, match="version"):
+        read_partial(partial)
+
+    shard = _shards(tmp_path, "downloads_elxr_dev", [[0]])[0]
+    map_logs(shard, tmp_path / "a.json.gz", "image_download")
+    map_logs(shard, tmp_path / "b.json.gz", "image_download", completion=0.5)
+    document = json.loads(gzip.decompress((tmp_path / "a.json.gz").read_bytes()))
+    assert (document["version"], document["options"]) == (PARTIAL_VERSION, {"completion": 0.9, "dedup_window": 3600})
+    with pytest.raises(ValueError, match="cannot merge"):
+        reduce_partials([tmp_path / "a.json.gz", tmp_path / "b.json.gz"], tmp_path / "image_stats.csv")
+    with pytest.raises(ValueError):
+        reduce_partials([], tmp_path / "image_stats.csv")
+    with pytest.raises(ValueError):
+        map_logs(shard, tmp_path / "c.json.gz", "edge_performance")
+
+
+def test_partial_bot_networks(tmp_path):
+    """test partials counted with different bot networks are refused"""
+    shard = _shards(tmp_path, "mirror_elxr_dev", [[0]])[0]
+    map_logs(shard, tmp_path / "a.json.gz", "package_download")
+    map_logs(shard, tmp_path / "b.json.gz", "package_download", classifier=BotClassifier(["10.0.0.0/8"]))
+    document = json.loads(gzip.decompress((tmp_path / "b.json.gz").read_bytes()))
+    assert document["options"] == {"bot_networks": ["10.0.0.0/8"]}
+    with pytest.raises(ValueError, match="cannot merge"):
+        reduce_partials([tmp_path / "a.json.gz", tmp_path / "b.json.gz"], tmp_path / "package_stats.csv")
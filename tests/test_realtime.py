@@ -0,0 +1,193 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import calendar
+import datetime
+import gzip
+import io
+import os
+import socket
+import threading
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.cloudfront_log import parse_cloudfront_log
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.pipeline import get_pipeline
+from elxr_metrics.realtime import (
+    DEFAULT_FIELD_ORDER,
+    RealtimeParser,
+    StreamIngester,
+    ingest_stream,
+    load_field_order,
+    open_stream,
+)
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+
+
+def _standard_fields() -> list[str]:
+    with gzip.open(next(LOGS.glob("*.gz")), "rt") as f:
+        header = next(line for line in f if line.startswith("#Fields:"))
+    return [name.replace("(", "-").replace(")", "").lower() for name in header.split()[1:]]
+
+
+# the fields of the sample logs, with a timestamp in place of date and time, in a custom order
+FIELD_ORDER = ["timestamp"] + _standard_fields()[2:]
+
+
+def _records() -> list[bytes]:
+    """the sample logs as real-time log records of FIELD_ORDER"""
+    records = []
+    for file in sorted(LOGS.glob("*.gz")):
+        with gzip.open(file, "rt") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                col = line.rstrip("\n").split("\t")
+                t = datetime.datetime.fromisoformat(f"{col[0]}T{col[1]}")
+                records.append("\t".join([f"{calendar.timegm(t.timetuple())}.123"] + col[2:]).encode() + b"\n")
+    return records
+
+
+def _read(csv_file: Path) -> list[tuple]:
+    return duckdb.read_csv(csv_file).fetchall()
+
+
+class FakeClock:
+    """a clock advanced by the test"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_parser():
+    """test records are mapped onto the same entries as the standard log lines"""
+    parser = RealtimeParser(FIELD_ORDER)
+    expected = [e for f in sorted(LOGS.glob("*.gz")) for e in parse_cloudfront_log(f)]
+    assert [parser(r.decode()) for r in _records()] == expected
+
+
+def test_parser_default_order():
+    """test a record of all fields, those without an entry field are skipped"""
+    values = {name: "-" for name in DEFAULT_FIELD_ORDER}
+    values.update(
+        {
+            "timestamp": "1726857578.563",
+            "c-ip": "74.12.5.10",
+            "sc-status": "200",
+            "cs-referer": "https://elxr.org/",
+            "c-country": "CA",
+            "cs-headers-count": "5",
+        }
+    )
+    entry = RealtimeParser()("\t".join(values[name] for name in DEFAULT_FIELD_ORDER))
+    assert entry.date == datetime.date(2024, 9, 20)
+    assert entry.time == datetime.time(18, 39, 38, tzinfo=datetime.timezone.utc)
+    assert entry.c_ip == "74.12.5.10"
+    assert entry.sc_status == 200
+    assert entry.cs_referrer == "https://elxr.org/"
+    with pytest.raises(ValueError):
+        RealtimeParser()("1726857578.563\t74.12.5.10")
+
+
+def test_load_field_order(tmp_path):
+    """test the field order is read from a comma or space separated list"""
+    config = tmp_path / "fields.txt"
+    config.write_text("# mirror.elxr.dev\nTimestamp, c-ip,sc-status\n  cs-uri-stem sc-content-type\n")
+    assert load_field_order(config) == ("timestamp", "c-ip", "sc-status", "cs-uri-stem", "sc-content-type")
+    config.write_text("c-ip, sc-status\n")
+    with pytest.raises(ValueError):
+        load_field_order(config)
+    config.write_text("timestamp, c-ip, c-ip\n")
+    with pytest.raises(ValueError):
+        load_field_order(config)
+
+
+def test_stream_ingester(tmp_path):
+    """test records are ingested in micro-batches and published like a one-shot run"""
+    expected = tmp_path / "expected.csv"
+    parse_mirror_elxr_dev_logs(LOGS, expected)
+    csv_file = tmp_path / "package_stats.csv"
+    records = _records()
+    stream = io.BytesIO(b"".join(records) + b"\nnot a record\n")
+    ingester = StreamIngester(get_pipeline("package_download", csv_file), RealtimeParser(FIELD_ORDER), batch_size=2)
+    ingester.run(stream)
+    assert ingester.records == len(records)
+    assert ingester.skipped == 1
+    assert _read(csv_file) == _read(expected)
+    ingester.close()
+
+
+def test_stream_ingester_intervals(tmp_path):
+    """test a batch is ingested after batch_interval and published after publish_interval"""
+    csv_file = tmp_path / "package_stats.csv"
+    clock = FakeClock()
+    ingester = StreamIngester(
+        get_pipeline("package_download", csv_file),
+        RealtimeParser(FIELD_ORDER),
+        batch_interval=0,
+        publish_interval=60,
+        clock=clock,
+    )
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as stream, open(write_fd, "wb", buffering=0) as pipe:
+        runner = threading.Thread(target=ingester.run, args=(stream,))
+        runner.start()
+        pipe.write(_records()[0])
+        while not ingester.records:
+            runner.join(0.01)
+        assert not csv_file.exists()
+        clock.now = 60
+        pipe.write(_records()[1])  # wakes the loop waiting for a record
+        while not csv_file.exists():
+            runner.join(0.01)
+    runner.join()
+    ingester.close()
+    assert _read(csv_file)
+
+
+def test_ingest_stream_socket(tmp_path):
+    """test records are read from a Unix socket"""
+    expected = tmp_path / "expected.csv"
+    parse_mirror_elxr_dev_logs(LOGS, expected)
+    config = tmp_path / "fields.txt"
+    config.write_text(", ".join(FIELD_ORDER))
+    path = str(tmp_path / "realtime.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen(1)
+
+        def send():
+            conn, _ = server.accept()
+            with conn:
+                conn.sendall(b"".join(_records()))
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        csv_file = tmp_path / "package_stats.csv"
+        ingest_stream(path, get_pipeline("package_download", csv_file), load_field_order(config))
+        sender.join()
+    assert _read(csv_file) == _read(expected)
+
+
+def test_open_stream(tmp_path, monkeypatch):
+    """test stdin and files are opened as binary streams"""
+    stdin = io.TextIOWrapper(io.BytesIO(b"record\n"))
+    monkeypatch.setattr("sys.stdin", stdin)
+    with open_stream("-") as stream:
+        assert stream.read() == b"record\n"
+    log = tmp_path / "records.log"
+    log.write_bytes(b"record\n")
+    with open_stream(str(log)) as stream:
+        assert list(stream) == [b"record\n"]
@@ -0,0 +1,48 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from elxr_metrics.sketch import DDSketch
+
+
+def test_ddsketch_relative_accuracy():
+    """test quantiles are within the relative accuracy of the exact ones"""
+    rng = random.Random(7)
+    values = sorted(rng.lognormvariate(-4, 1.5) for _ in range(10000))
+    sketch = DDSketch(relative_accuracy=0.01)
+    for v in values:
+        sketch.add(v)
+    assert sketch.count == len(values)
+    for q in (0.0, 0.5, 0.95, 0.99, 1.0):
+        exact = values[int(q * (len(values) - 1))]
+        assert sketch.quantile(q) == pytest.approx(exact, rel=0.01)
+    assert len(sketch.bins) < 1500
+
+
+def test_ddsketch_merge():
+    """test merged sketches estimate the quantiles of all values"""
+    a, b, whole = DDSketch(), DDSketch(), DDSketch()
+    for i in range(1, 1001):
+        (a if i % 2 else b).add(i / 1000)
+        whole.add(i / 1000)
+    a.merge(b)
+    assert a.bins == whole.bins
+    assert a.quantile(0.5) == whole.quantile(0.5)
+    with pytest.raises(ValueError):
+        a.merge(DDSketch(relative_accuracy=0.05))
+
+
+def test_ddsketch_empty_and_zero():
+    """test an empty sketch has no quantile and zero values are kept in the lowest bin"""
+    sketch = DDSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add(0.0, count=3)
+    assert sketch.quantile(0.5) == pytest.approx(1e-6, rel=0.01)
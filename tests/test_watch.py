@@ -0,0 +1,133 @@
+################################################################################
+# Copyright (c) 2024 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+################################################################################
+from __future__ import annotations
+
+import datetime
+import os
+import shutil
+import signal
+import time
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from elxr_metrics.elxr_package import parse_mirror_elxr_dev_logs
+from elxr_metrics.interrupt import interrupt_on_sigterm
+from elxr_metrics.pipeline import get_pipeline
+from elxr_metrics.watch import Watcher, watch
+
+LOGS = Path(__file__).parent / "logs" / "mirror_elxr_dev"
+
+
+class FakeClock:
+    """a clock advanced by the test"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def log_folder(tmp_path):
+    folder = tmp_path / "logs"
+    folder.mkdir()
+    return folder
+
+
+def _read(csv_file: Path) -> list[tuple]:
+    return duckdb.read_csv(csv_file).fetchall()
+
+
+def test_watcher_debounce(tmp_path, log_folder):
+    """test new files are ingested once settled and published after the debounce interval"""
+    expected = tmp_path / "expected.csv"
+    parse_mirror_elxr_dev_logs(LOGS, expected)
+    csv_file = tmp_path / "package_stats.csv"
+    clock = FakeClock()
+    watcher = Watcher(log_folder, get_pipeline("package_download", csv_file), debounce=60, clock=clock)
+    for f in LOGS.glob("*.gz"):
+        shutil.copy(f, log_folder)
+
+    assert not watcher.step()  # sizes recorded, not settled yet
+    clock.now = 10
+    assert not watcher.step()  # ingested
+    assert watcher.latest == datetime.datetime(2024, 9, 20, 18, tzinfo=datetime.timezone.utc)
+    assert not csv_file.exists()
+    clock.now = 70
+    assert watcher.step()
+    assert _read(csv_file) == _read(expected)
+
+    # a new file is counted on top of the published counts
+    shutil.copy(next(LOGS.glob("*.gz")), log_folder / "B1T7TZB2ZQO6VP.2024-09-21-18.00000000.gz")
+    clock.now = 80
+    assert not watcher.step()
+    clock.now = 90
+    assert not watcher.step()
+    assert watcher.latest == datetime.datetime(2024, 9, 21, 18, tzinfo=datetime.timezone.utc)
+    watcher.close()
+    assert sum(row[1] for row in _read(csv_file)) > sum(row[1] for row in _read(expected))
+
+
+def test_watcher_max_delay(tmp_path, log_folder):
+    """test a steady stream of files is published after max_delay"""
+    csv_file = tmp_path / "image_stats.csv"
+    clock = FakeClock()
+    watcher = Watcher(log_folder, get_pipeline("image_download", csv_file), debounce=60, max_delay=100, clock=clock)
+    logs = sorted((Path(__file__).parent / "logs" / "downloads_elxr_dev").glob("*.gz"))
+    for i, f in enumerate(logs * 3):
+        shutil.copy(f, log_folder / f"{i}.{f.name}")
+        watcher.step()
+        clock.now += 30
+        watcher.step()
+        clock.now += 30
+    assert csv_file.exists()
+    watcher.close()
+
+
+def test_watcher_broken_file(tmp_path, log_folder):
+    """test a broken file is skipped and the other files are still counted"""
+    expected = tmp_path / "expected.csv"
+    parse_mirror_elxr_dev_logs(LOGS, expected)
+    csv_file = tmp_path / "package_stats.csv"
+    for f in LOGS.glob("*.gz"):
+        shutil.copy(f, log_folder)
+    (log_folder / "broken.gz").write_bytes(b"not gzip")
+    watcher = Watcher(log_folder, get_pipeline("package_download", csv_file))
+    watcher.step()
+    watcher.step()
+    watcher.close()
+    assert _read(csv_file) == _read(expected)
+
+
+def test_watch_trend(tmp_path, log_folder):
+    """test watch publishes pending counts when it stops"""
+    for f in (Path(__file__).parent / "logs" / "elxr_org").glob("*.gz"):
+        shutil.copy(f, log_folder)
+    csv_file = tmp_path / "elxr_org_view.csv"
+    pipeline = get_pipeline("elxr_org_view", csv_file)
+    watch(log_folder, pipeline, poll_interval=0, debounce=3600, cycles=2)
+    watch(log_folder, pipeline, poll_interval=0, debounce=3600, cycles=2)
+    assert (datetime.datetime(2074, 9, 22, 18, 0), 6, 4) in _read(csv_file)
+
+
+def test_get_pipeline_unknown(tmp_path):
+    """test unknown log type"""
+    with pytest.raises(ValueError):
+        get_pipeline("unknown", tmp_path / "test.csv")
+
+
+def test_interrupt_on_sigterm():
+    """test SIGTERM raises KeyboardInterrupt within the block, and the previous handler is restored"""
+    previous = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(KeyboardInterrupt):
+        with interrupt_on_sigterm():
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(1)
+    assert signal.getsignal(signal.SIGTERM) is previous